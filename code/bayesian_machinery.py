@@ -10,6 +10,15 @@ import cPickle as pickle
 import itertools
 import string
 import sqlite3
+import os
+import errno
+import socket
+import random
+import threading
+import contextlib
+import hashlib
+import multiprocessing
+import ctypes
 import scipy
 from scipy import special, interpolate
 import scipy.ndimage
@@ -24,6 +33,9 @@ rc('text', usetex=True)
 
 # Local repo imports
 import debias
+import pixel_data
+import stage_timing
+import fused_posterior
 
 # Other repo imports (RHT helper code)
 import sys 
@@ -56,11 +68,14 @@ class BayesianComponent():
         
         return integrated_field
     
-    def get_psi0_sampling_grid(self, hp_index, verbose = True, returnzerotheta=False):
+    def get_psi0_sampling_grid(self, hp_index, verbose = True, returnzerotheta=False, data_provider=None):
         # Create psi0 sampling grid
         wlen = 75
-        psi0_sample_db = sqlite3.connect("theta_bin_0_wlen"+str(wlen)+"_db.sqlite")
-        psi0_sample_cursor = psi0_sample_db.cursor()    
+        if data_provider is None:
+            psi0_sample_db = sqlite3.connect("theta_bin_0_wlen"+str(wlen)+"_db.sqlite")
+            psi0_sample_cursor = psi0_sample_db.cursor()    
+        else:
+            psi0_sample_cursor = data_provider.psi0_sample_cursor
         
         zero_theta = psi0_sample_cursor.execute("SELECT zerotheta FROM theta_bin_0_wlen75 WHERE id = ?", (hp_index,)).fetchone()
         
@@ -86,21 +101,24 @@ class BayesianComponent():
         
         return rolled_rht, rolled_sample_psi
         
-    def get_adaptive_p_grid(self, hp_index):
-        # Planck TQU database
-        planck_tqu_db = sqlite3.connect("planck_TQU_gal_2048_db.sqlite")
-        planck_tqu_cursor = planck_tqu_db.cursor()
+    def get_adaptive_p_grid(self, hp_index, data_provider = None):
+        if data_provider is None:
+            # Planck TQU database
+            planck_tqu_db = sqlite3.connect("planck_TQU_gal_2048_db.sqlite")
+            planck_tqu_cursor = planck_tqu_db.cursor()
+        
+            # Planck covariance database
+            planck_cov_db = sqlite3.connect("planck_cov_gal_2048_db.sqlite")
+            planck_cov_cursor = planck_cov_db.cursor()
     
-        (self.hp_index, self.T, self.Q, self.U) = planck_tqu_cursor.execute("SELECT * FROM Planck_Nside_2048_TQU_Galactic WHERE id = ?", (self.hp_index,)).fetchone()
+            (self.hp_index, self.T, self.Q, self.U) = planck_tqu_cursor.execute("SELECT * FROM Planck_Nside_2048_TQU_Galactic WHERE id = ?", (self.hp_index,)).fetchone()
+            (self.hp_index, self.TT, self.TQ, self.TU, self.TQa, self.QQ, self.QU, self.TUa, self.QUa, self.UU) = planck_cov_cursor.execute("SELECT * FROM Planck_Nside_2048_cov_Galactic WHERE id = ?", (self.hp_index,)).fetchone()
+        else:
+            (self.T, self.Q, self.U) = data_provider.get_planck_tqu_pixel(self.hp_index)
+            (self.TT, self.TQ, self.TU, self.TQa, self.QQ, self.QU, self.TUa, self.QUa, self.UU) = data_provider.get_planck_cov_pixel(self.hp_index)
         
         pmeas = np.sqrt(self.Q**2 + self.U**2)/self.T
         
-        # Planck covariance database
-        planck_cov_db = sqlite3.connect("planck_cov_gal_2048_db.sqlite")
-        planck_cov_cursor = planck_cov_db.cursor()
-        
-        (self.hp_index, self.TT, self.TQ, self.TU, self.TQa, self.QQ, self.QU, self.TUa, self.QUa, self.UU) = planck_cov_cursor.execute("SELECT * FROM Planck_Nside_2048_cov_Galactic WHERE id = ?", (self.hp_index,)).fetchone()
-        
         # from Planck Intermediate Results XIX eq. B.2. Taking I0 to be perfectly known
         sigpsq = (1/(pmeas**2*self.T**4))*(self.Q**2*self.QQ + self.U**2*self.UU + 2*self.Q*self.U*self.QU)
         sigmameas = np.sqrt(sigpsq)
@@ -128,6 +146,18 @@ class BayesianComponent():
         
         return pgrid
         
+    def set_separable_prior(self, npsample):
+        """
+        Normalize the 1D prior along psi0 (self.prior_1d) over the (p0, psi0) domain. The 2D integral is
+        (p0 range) x (integral over psi0), so only 1D integrals are needed. prior and normed_prior are
+        (npsi, npsample) read-only broadcast views, not copies.
+        """
+        self.integrated_over_p_and_psi = (npsample - 1)*self.p_dx*np.trapz(self.prior_1d, dx = self.psi_dx)
+        self.normed_prior_1d = self.prior_1d/self.integrated_over_p_and_psi
+        
+        self.prior = np.broadcast_to(self.prior_1d[:, np.newaxis], (len(self.prior_1d), npsample))
+        self.normed_prior = np.broadcast_to(self.normed_prior_1d[:, np.newaxis], (len(self.prior_1d), npsample))
+    
     def get_thetaRHT_hat(self, sample_psi0, rht_data):
         """
         get theta^_RHT from psis and rht spectrum
@@ -144,11 +174,15 @@ class Prior(BayesianComponent):
     Class for building RHT Priors
     """
     
+    @stage_timing.timed("prior")
     def __init__(self, hp_index, sample_p0, reverse_RHT = False, verbose = False, region = "SC_241", 
-                 rht_cursor = None, gausssmooth = False, deltafuncprior = False, baseprioramp=1E-8):
+                 rht_cursor = None, gausssmooth = False, deltafuncprior = False, baseprioramp=1E-8, data_provider = None):
     
         BayesianComponent.__init__(self, hp_index, verbose = verbose)
         
+        # Set if the prior cannot be constructed for this pixel
+        self.quarantined = False
+        
         # Planck-projected RHT database
         #rht_cursor, tablename = get_rht_cursor(region = region)
         
@@ -176,7 +210,7 @@ class Prior(BayesianComponent):
         
             # Get sample psi data
             #self.sample_psi0 = self.get_psi0_sampling_grid(hp_index, verbose = verbose)
-            self.sample_psi0, self.zero_theta = self.get_psi0_sampling_grid(hp_index, verbose = verbose, returnzerotheta=True)
+            self.sample_psi0, self.zero_theta = self.get_psi0_sampling_grid(hp_index, verbose = verbose, returnzerotheta=True, data_provider=data_provider)
         
             self.unrolled_thetaRHT = self.get_thetaRHT_hat(self.sample_psi0, self.rht_data)
             
@@ -197,19 +231,21 @@ class Prior(BayesianComponent):
                 self.rht_data = self.rht_data[::-1]
                 self.sample_psi0 = self.sample_psi0[::-1]
             
+            # The prior is constant in p0, so it is kept 1D along psi0
+            rht_data = np.asarray(self.rht_data, np.float_)
             if baseprioramp is None:
-                self.prior = (np.array([self.rht_data]*npsample).T + 0.7)*75
+                self.prior_1d = (rht_data + 0.7)*75
             elif baseprioramp is "variable":
-                self.prior = (np.array([self.rht_data]*npsample).T + (1 - self.maxrht))
+                self.prior_1d = rht_data + (1 - self.maxrht)
             elif baseprioramp is "median_var":
-                self.prior = (np.array([self.rht_data]*npsample).T + max(0.25 - self.maxrht, 0))
+                self.prior_1d = rht_data + max(0.25 - self.maxrht, 0)
                 if max(0.25 - self.maxrht, 0) < 0:
                     print('help: {}'.format(max(0.25 - self.maxrht, 0)))
             elif baseprioramp is "max_var":
                  globalmaxval = 4.2041096687316895
-                 self.prior = (np.array([self.rht_data]*npsample).T + max(globalmaxval - self.maxrht, 0))
+                 self.prior_1d = rht_data + max(globalmaxval - self.maxrht, 0)
             else:
-                self.prior = (np.array([self.rht_data]*npsample).T + baseprioramp) # only adding a (small) fixed amount to keep it nonzero. baseprioramp must be > 0
+                self.prior_1d = rht_data + baseprioramp # only adding a (small) fixed amount to keep it nonzero. baseprioramp must be > 0
             
             self.psi_dx = self.sample_psi0[1] - self.sample_psi0[0]
             self.p_dx = self.sample_p0[1] - self.sample_p0[0]
@@ -222,13 +258,10 @@ class Prior(BayesianComponent):
             if verbose is True:
                 print("psi dx is {}, p dx is {}".format(self.psi_dx, self.p_dx))
             
-            self.integrated_over_psi = self.integrate_highest_dimension(self.prior, dx = self.psi_dx)
-            self.integrated_over_p_and_psi = self.integrate_highest_dimension(self.integrated_over_psi, dx = self.p_dx)
-    
-            # Normalize prior over domain
-            self.normed_prior = self.prior/self.integrated_over_p_and_psi
+            self.set_separable_prior(npsample)
 
         except TypeError:
+            self.quarantined = True
             if self.rht_data is None:
                 print("Index {} not found".format(hp_index))
             else:
@@ -239,10 +272,15 @@ class PriorThetaRHT(BayesianComponent):
     Class for building RHT priors which are defined by theta_RHT and corresponding error
     """
     
+    @stage_timing.timed("prior")
     def __init__(self, hp_index, sample_p0, reverse_RHT = False, verbose = False, region = "SC_241", QU_QUsq_RHT_cursor = None, smoothprior = False, fixwidth=False):
     
         BayesianComponent.__init__(self, hp_index, verbose = verbose)
         
+        # Set if the prior cannot be constructed for this pixel
+        self.quarantined = False
+        self.QRHT = None
+        
         # Load Q_RHT, U_RHT, and errors 
         #QRHT_cursor, URHT_cursor, sig_QRHT_cursor, sig_URHT_cursor = get_rht_QU_cursors()
         
@@ -275,10 +313,9 @@ class PriorThetaRHT(BayesianComponent):
             #vonmises = np.exp(kappa*np.cos(self.sample_psi0 - self.psimeas))/(2*np.pi*special.iv(0, kappa))
             axialvonmises = np.cosh(kappa*np.cos(self.sample_psi0 - self.psimeas))/(np.pi*special.iv(0, kappa))
         
-            # Create correct prior geometry
+            # Create correct prior geometry: constant in p0, so it is kept 1D along psi0
             npsample = len(self.sample_p0)
-            #self.prior = np.array([gaussian]*npsample).T
-            self.prior = np.array([axialvonmises]*npsample).T
+            self.prior_1d = axialvonmises
         
             #self.psi_dx = self.sample_psi0[1] - self.sample_psi0[0]
             self.psi_dx = polarization_tools.angle_residual(self.sample_psi0[1], self.sample_psi0[0], degrees=False)
@@ -291,29 +328,115 @@ class PriorThetaRHT(BayesianComponent):
             if verbose is True:
                 print("psi dx is {}, p dx is {}".format(self.psi_dx, self.p_dx))
         
-            self.integrated_over_psi = self.integrate_highest_dimension(self.prior, dx = self.psi_dx)
-            self.integrated_over_p_and_psi = self.integrate_highest_dimension(self.integrated_over_psi, dx = self.p_dx)
-
-            # Normalize prior over domain
-            self.normed_prior = self.prior/self.integrated_over_p_and_psi
+            self.set_separable_prior(npsample)
         
         except TypeError:
+            self.quarantined = True
             if self.QRHT is None:
                 print("Index {} not found".format(hp_index))
             else:
                 print("Unknown TypeError when constructing RHT prior for index {}".format(hp_index))
         
                
+# cos(2 theta), sin(2 theta) tables for the RHT theta bins, by wlen
+thets_trig_tables = {}
+
+def get_psi0_trig_tables(sample_psi0):
+    """
+    cos(2 psi0) and sin(2 psi0) along the last axis of sample_psi0
+    """
+    return np.cos(2*sample_psi0), np.sin(2*sample_psi0)
+
+def get_thets_trig_tables(wlen = 75, verbose = False):
+    """
+    RHT theta bins and their cos(2 theta), sin(2 theta). Computed once per wlen and shared by all pixels.
+    """
+    if wlen not in thets_trig_tables:
+        thets = RHT_tools.get_thets(wlen, save = False, verbose = verbose)
+        thets_trig_tables[wlen] = (thets, np.cos(2*thets), np.sin(2*thets))
+    
+    return thets_trig_tables[wlen]
+
+def rotate_thets_trig_tables(zero_theta, cos2thets, sin2thets):
+    """
+    cos(2 psi0), sin(2 psi0) for psi0 = zero_theta - thets, from the shared theta tables.
+    zero_theta may be a scalar or an array of N pixels, giving (N, ntheta) tables.
+    """
+    zero_theta = np.asarray(zero_theta)[..., np.newaxis]
+    cos2zero = np.cos(2*zero_theta)
+    sin2zero = np.sin(2*zero_theta)
+    
+    cos2psi0 = cos2zero*cos2thets + sin2zero*sin2thets
+    sin2psi0 = sin2zero*cos2thets - cos2zero*sin2thets
+    
+    return cos2psi0, sin2psi0
+
+@stage_timing.timed("likelihood")
+def factorized_likelihood(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, p0_all, cos2psi0, sin2psi0):
+    """
+    Planck likelihood on a (psi0, p0) grid, built from outer products rather than a 2x2 quadratic form at every point.
+    With d = meas - p0 (cos 2psi0, sin 2psi0), d^T invsig d = K - 2 p0 L(psi0) + p0^2 M(psi0), where K depends on
+    neither p0 nor psi0. Leading dimensions of the inputs are broadcast, so this works for one pixel ((npsi, np) output)
+    or a stack of pixels ((N, npsi, np) output).
+    """
+    # Construct measured part
+    measpart0 = pmeas*np.cos(2*psimeas)
+    measpart1 = pmeas*np.sin(2*psimeas)
+    
+    Kpart = invsig_QQ*measpart0**2 + 2*invsig_QU*measpart0*measpart1 + invsig_UU*measpart1**2
+    Lcos = np.asarray(invsig_QQ*measpart0 + invsig_QU*measpart1)[..., np.newaxis]
+    Lsin = np.asarray(invsig_QU*measpart0 + invsig_UU*measpart1)[..., np.newaxis]
+    Lpart = Lcos*cos2psi0 + Lsin*sin2psi0
+    Mpart = np.asarray(invsig_QQ)[..., np.newaxis]*cos2psi0**2 + 2*np.asarray(invsig_QU)[..., np.newaxis]*cos2psi0*sin2psi0 + np.asarray(invsig_UU)[..., np.newaxis]*sin2psi0**2
+    
+    # Normalization folded into the exponent so that there is one exp per grid point
+    lnnorm = np.asarray(np.log(1.0/(np.pi*sigpGsq)) - 0.5*Kpart)[..., np.newaxis, np.newaxis]
+    p0 = p0_all[..., np.newaxis, :]
+    
+    likelihood = np.exp(lnnorm + p0*Lpart[..., np.newaxis] - 0.5*p0**2*Mpart[..., np.newaxis])
+    
+    return likelihood
+
+@stage_timing.timed("likelihood")
+def lnlikelihood_grid(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, p0_all, cos2psi0, sin2psi0, dtype = np.float32):
+    """
+    Log of the Planck likelihood on a (psi0, p0) grid, evaluated in dtype. Broadcasts like factorized_likelihood.
+    Works with the residuals d = meas - p0 (cos 2psi0, sin 2psi0) directly: the expanded K - 2 p0 L + p0^2 M form
+    cancels terms of order SNR^2 near the peak, which single precision cannot afford.
+    """
+    measpart0 = np.asarray(pmeas*np.cos(2*psimeas), dtype)[..., np.newaxis, np.newaxis]
+    measpart1 = np.asarray(pmeas*np.sin(2*psimeas), dtype)[..., np.newaxis, np.newaxis]
+    p0 = np.asarray(p0_all, dtype)[..., np.newaxis, :]
+    
+    dQ = measpart0 - p0*np.asarray(cos2psi0, dtype)[..., np.newaxis]
+    dU = measpart1 - p0*np.asarray(sin2psi0, dtype)[..., np.newaxis]
+    
+    invsig_QQ = np.asarray(invsig_QQ, dtype)[..., np.newaxis, np.newaxis]
+    invsig_QU = np.asarray(invsig_QU, dtype)[..., np.newaxis, np.newaxis]
+    invsig_UU = np.asarray(invsig_UU, dtype)[..., np.newaxis, np.newaxis]
+    lnnorm = np.asarray(np.log(1.0/(np.pi*sigpGsq)), dtype)[..., np.newaxis, np.newaxis]
+    
+    lnlikelihood = lnnorm - 0.5*(invsig_QQ*dQ**2 + 2*invsig_QU*dQ*dU + invsig_UU*dU**2)
+    
+    return lnlikelihood
+
 class Likelihood(BayesianComponent):
     """
     Class for building Planck-based likelihood
     Currently assumes I = I_0, and sigma_I = 0
     """
     
-    def __init__(self, hp_index, planck_tqu_cursor, planck_cov_cursor, p0_all, psi0_all):
+    @stage_timing.timed("likelihood")
+    def __init__(self, hp_index, planck_tqu_cursor, planck_cov_cursor, p0_all, psi0_all, psi0_trig = None, data_provider = None):
         BayesianComponent.__init__(self, hp_index)      
-        (self.hp_index, self.T, self.Q, self.U) = planck_tqu_cursor.execute("SELECT * FROM Planck_Nside_2048_TQU_Galactic WHERE id = ?", (self.hp_index,)).fetchone()
-        (self.hp_index, self.TT, self.TQ, self.TU, self.TQa, self.QQ, self.QU, self.TUa, self.QUa, self.UU) = planck_cov_cursor.execute("SELECT * FROM Planck_Nside_2048_cov_Galactic WHERE id = ?", (self.hp_index,)).fetchone()
+        
+        # Read from the cursors, or from a data provider (SQLite or memory-mapped backend) if one is given
+        if data_provider is None:
+            (self.hp_index, self.T, self.Q, self.U) = planck_tqu_cursor.execute("SELECT * FROM Planck_Nside_2048_TQU_Galactic WHERE id = ?", (self.hp_index,)).fetchone()
+            (self.hp_index, self.TT, self.TQ, self.TU, self.TQa, self.QQ, self.QU, self.TUa, self.QUa, self.UU) = planck_cov_cursor.execute("SELECT * FROM Planck_Nside_2048_cov_Galactic WHERE id = ?", (self.hp_index,)).fetchone()
+        else:
+            (self.T, self.Q, self.U) = data_provider.get_planck_tqu_pixel(self.hp_index)
+            (self.TT, self.TQ, self.TU, self.TQa, self.QQ, self.QU, self.TUa, self.QUa, self.UU) = data_provider.get_planck_cov_pixel(self.hp_index)
         
         # Naive psi
         self.naive_psi = np.mod(0.5*np.arctan2(self.U, self.Q), np.pi)
@@ -340,47 +463,24 @@ class Likelihood(BayesianComponent):
     
         # invert sigma_p
         invsig = np.linalg.inv(self.sigma_p)
-    
-        # Sample grid
-        nsample = len(p0_all)
-        p0_psi0_grid = np.asarray(np.meshgrid(p0_all, psi0_all))
-
-        # isig array of size (2, 2, nsample*nsample)
-        outfast = np.zeros(nsample*nsample, np.float_)
-    
-        # Construct measured part
-        measpart0 = pmeas*np.cos(2*psimeas)
-        measpart1 = pmeas*np.sin(2*psimeas)
-    
-        p0pairs = p0_psi0_grid[0, ...].ravel()
-        psi0pairs = p0_psi0_grid[1, ...].ravel()
-    
-        # These have length nsample*nsample
-        truepart0 = p0pairs*np.cos(2*psi0pairs)
-        truepart1 = p0pairs*np.sin(2*psi0pairs)
-    
-        rharrbig = np.zeros((2, 1, nsample*nsample), np.float_)
-        lharrbig = np.zeros((1, 2, nsample*nsample), np.float_)
-    
-        rharrbig[0, 0, :] = measpart0 - truepart0
-        rharrbig[1, 0, :] = measpart1 - truepart1
-        lharrbig[0, 0, :] = measpart0 - truepart0
-        lharrbig[0, 1, :] = measpart1 - truepart1
-
-        self.likelihood = (1.0/(np.pi*self.sigpGsq))*np.exp(-0.5*np.einsum('ij...,jk...->ik...', lharrbig, np.einsum('ij...,jk...->ik...', invsig, rharrbig)))
-        self.likelihood = self.likelihood.reshape(nsample, nsample)
+        
+        if psi0_trig is None:
+            psi0_trig = get_psi0_trig_tables(psi0_all)
+        cos2psi0, sin2psi0 = psi0_trig
+        
+        self.likelihood = factorized_likelihood(pmeas, psimeas, invsig[0, 0], invsig[0, 1], invsig[1, 1], self.sigpGsq, p0_all, cos2psi0, sin2psi0)
 
 class Posterior(BayesianComponent):
     """
     Class for building a posterior composed of a Planck-based likelihood and an RHT prior
     """
     
-    def __init__(self, hp_index, sample_p0 = None, adaptivep0 = False, region = "SC_241", useprior = "RHTPrior", rht_cursor = None, QU_QUsq_RHT_cursor = None, gausssmooth_prior = False, deltafuncprior = False, testpsiproj=False, baseprioramp=1E-8, smoothprior=False, fixwidth=False):
+    def __init__(self, hp_index, sample_p0 = None, adaptivep0 = False, region = "SC_241", useprior = "RHTPrior", rht_cursor = None, QU_QUsq_RHT_cursor = None, gausssmooth_prior = False, deltafuncprior = False, testpsiproj=False, baseprioramp=1E-8, smoothprior=False, fixwidth=False, data_provider=None):
         BayesianComponent.__init__(self, hp_index)  
         
         if sample_p0 is None:
             if adaptivep0 is True:
-                self.sample_p0 = self.get_adaptive_p_grid(hp_index)
+                self.sample_p0 = self.get_adaptive_p_grid(hp_index, data_provider = data_provider)
             else:
                 self.sample_p0 = np.linspace(0, 1, 165)
         else:
@@ -388,22 +488,32 @@ class Posterior(BayesianComponent):
         
         # Instantiate posterior components
         if useprior is "RHTPrior":
-            prior = Prior(hp_index, self.sample_p0, reverse_RHT = True, region = region, rht_cursor = rht_cursor, gausssmooth = gausssmooth_prior, deltafuncprior = deltafuncprior, baseprioramp=baseprioramp)
+            prior = Prior(hp_index, self.sample_p0, reverse_RHT = True, region = region, rht_cursor = rht_cursor, gausssmooth = gausssmooth_prior, deltafuncprior = deltafuncprior, baseprioramp=baseprioramp, data_provider=data_provider)
         elif useprior is "ThetaRHT":
             prior = PriorThetaRHT(hp_index, self.sample_p0, reverse_RHT = True, region = region, QU_QUsq_RHT_cursor = QU_QUsq_RHT_cursor, smoothprior=smoothprior, fixwidth=fixwidth)
+        
+        # No posterior without a prior: leave it to the caller to quarantine this pixel
+        self.prior_obj = prior
+        self.quarantined = prior.quarantined
+        if self.quarantined:
+            return
             
         self.sample_psi0 = prior.sample_psi0
         
-        # Planck covariance database
-        planck_cov_db = sqlite3.connect("planck_cov_gal_2048_db.sqlite")
-        planck_cov_cursor = planck_cov_db.cursor()
-    
-        # Planck TQU database
-        planck_tqu_db = sqlite3.connect("planck_TQU_gal_2048_db.sqlite")
-        planck_tqu_cursor = planck_tqu_db.cursor()
+        if data_provider is None:
+            # Planck covariance database
+            planck_cov_db = sqlite3.connect("planck_cov_gal_2048_db.sqlite")
+            planck_cov_cursor = planck_cov_db.cursor()
+
+            # Planck TQU database
+            planck_tqu_db = sqlite3.connect("planck_TQU_gal_2048_db.sqlite")
+            planck_tqu_cursor = planck_tqu_db.cursor()
+        else:
+            planck_cov_cursor = None
+            planck_tqu_cursor = None
         
         # Planck-based likelihood
-        likelihood = Likelihood(hp_index, planck_tqu_cursor, planck_cov_cursor, self.sample_p0, self.sample_psi0)
+        likelihood = Likelihood(hp_index, planck_tqu_cursor, planck_cov_cursor, self.sample_p0, self.sample_psi0, data_provider = data_provider)
         
         self.naive_psi = likelihood.naive_psi
         self.psimeas = likelihood.psimeas
@@ -417,17 +527,18 @@ class Posterior(BayesianComponent):
             self.normed_posterior = self.normed_prior
         else:
             #self.posterior = np.einsum('ij,jk->ik', self.planck_likelihood, self.normed_prior)
-            self.posterior = self.planck_likelihood*self.normed_prior
+            self.posterior = self.planck_likelihood*prior.normed_prior_1d[:, np.newaxis]
         
             #psi_dx = polarization_tools.angle_residual(self.sample_psi0[1], self.sample_psi0[0], degrees=False)
             p_dx = self.sample_p0[1] - self.sample_p0[0]
             self.psi_dx = prior.psi_dx
             self.p_dx = p_dx
         
-            self.posterior_integrated_over_psi = self.integrate_highest_dimension(self.posterior, dx = self.psi_dx)
-            self.posterior_integrated_over_p_and_psi = self.integrate_highest_dimension(self.posterior_integrated_over_psi, dx = p_dx)
-        
-            self.normed_posterior = self.posterior/self.posterior_integrated_over_p_and_psi
+            with stage_timing.stage("normalization"):
+                self.posterior_integrated_over_psi = self.integrate_highest_dimension(self.posterior, dx = self.psi_dx)
+                self.posterior_integrated_over_p_and_psi = self.integrate_highest_dimension(self.posterior_integrated_over_psi, dx = p_dx)
+            
+                self.normed_posterior = self.posterior/self.posterior_integrated_over_p_and_psi
         
         self.prior_obj = prior
         
@@ -435,17 +546,17 @@ class PlanckPosterior(BayesianComponent):
     """
     Class for building a posterior that is only a Planck-based likelihood
     """
-    def __init__(self, hp_index, planck_tqu_cursor, planck_cov_cursor, p0_all, psi0_all, adaptivep0 = True):
+    def __init__(self, hp_index, planck_tqu_cursor, planck_cov_cursor, p0_all, psi0_all, adaptivep0 = True, psi0_trig = None, data_provider = None):
         BayesianComponent.__init__(self, hp_index)      
     
         # Planck-based likelihood
         if adaptivep0 is True:
-            self.sample_p0 = self.get_adaptive_p_grid(hp_index)
+            self.sample_p0 = self.get_adaptive_p_grid(hp_index, data_provider = data_provider)
         else:
             self.sample_p0 = p0_all
         self.sample_psi0 = psi0_all
         
-        likelihood = Likelihood(hp_index, planck_tqu_cursor, planck_cov_cursor, self.sample_p0, self.sample_psi0)
+        likelihood = Likelihood(hp_index, planck_tqu_cursor, planck_cov_cursor, self.sample_p0, self.sample_psi0, psi0_trig = psi0_trig, data_provider = data_provider)
         self.posterior = likelihood.likelihood
     
         self.naive_psi = likelihood.naive_psi
@@ -461,10 +572,11 @@ class PlanckPosterior(BayesianComponent):
         self.psi_dx = psi_dx
         self.p_dx = p_dx
     
-        self.posterior_integrated_over_psi = self.integrate_highest_dimension(self.posterior, dx = psi_dx)
-        self.posterior_integrated_over_p_and_psi = self.integrate_highest_dimension(self.posterior_integrated_over_psi, dx = p_dx)
-    
-        self.normed_posterior = self.posterior/self.posterior_integrated_over_p_and_psi
+        with stage_timing.stage("normalization"):
+            self.posterior_integrated_over_psi = self.integrate_highest_dimension(self.posterior, dx = psi_dx)
+            self.posterior_integrated_over_p_and_psi = self.integrate_highest_dimension(self.posterior_integrated_over_psi, dx = p_dx)
+        
+            self.normed_posterior = self.posterior/self.posterior_integrated_over_p_and_psi
         
 class DummyPosterior(BayesianComponent):
       """
@@ -508,7 +620,388 @@ class DummyPosterior(BayesianComponent):
         self.normed_posterior = self.planck_likelihood/self.integrated_over_p_and_psi
         
         self.normed_prior = np.ones(self.normed_posterior.shape, np.float_)
+
+def get_pixel_snr(T, Q, U, QQ, QU, UU):
+    """
+    pmeas, sigma_p and the signal to noise pmeas/sigma_p, for scalars or arrays of pixels
+    """
+    pmeas = np.sqrt(Q**2 + U**2)/T
+    
+    # from Planck Intermediate Results XIX eq. B.2. Taking I0 to be perfectly known
+    sigpsq = (1/(pmeas**2*T**4))*(Q**2*QQ + U**2*UU + 2*Q*U*QU)
+    sigmameas = np.sqrt(sigpsq)
+    
+    return pmeas, sigmameas, pmeas/sigmameas
+
+def get_adaptive_p_bounds(T, Q, U, QQ, QU, UU):
+    """
+    Bounds of the adaptive p0 grid, pmeas +/- 7 sigma_p bounded by [0, 1], for scalars or arrays of pixels
+    """
+    pmeas, sigmameas, snr = get_pixel_snr(T, Q, U, QQ, QU, UU)
+
+    pgridmin = np.maximum(0, pmeas - 7*sigmameas)
+    pgridmax = np.minimum(1, pmeas + 7*sigmameas)
+    
+    return pgridmin, pgridmax
+
+def get_p_grids(pgridmin, pgridmax, npsample = 165):
+    """
+    (N, npsample) p0 grids from arrays of bounds, the same construction as np.linspace, row by row
+    """
+    step = (pgridmax - pgridmin)/(npsample - 1)
+    pgrid = pgridmin[:, np.newaxis] + step[:, np.newaxis]*np.arange(npsample)
+    pgrid[:, -1] = pgridmax
+
+    return pgrid
+
+def get_planck_inverse_covariances(T, QQ, QU, UU):
+    """
+    Analytic inverse of sigma_p, and sigpGsq, for scalars or arrays of pixels.
+    Returns invsig_QQ, invsig_QU, invsig_UU, sigpGsq.
+    """
+    # sigma_p as defined in arxiv:1407.0178v1 Eqn 3
+    sig_QQ = QQ/T**2
+    sig_QU = QU/T**2
+    sig_UU = UU/T**2
+    det_sigma_p = sig_QQ*sig_UU - sig_QU**2
+    sigpGsq = np.sqrt(det_sigma_p)
+
+    invsig_QQ = sig_UU/det_sigma_p
+    invsig_QU = -sig_QU/det_sigma_p
+    invsig_UU = sig_QQ/det_sigma_p
+    
+    return invsig_QQ, invsig_QU, invsig_UU, sigpGsq
+
+def get_covariance_ellipticity(QQ, QU, UU):
+    """
+    Ellipticity of the Q, U noise covariance: square root of the ratio of its largest to its smallest eigenvalue,
+    1 for circular noise (Planck Intermediate Results XIX eq. A.1), for scalars or arrays of pixels
+    """
+    trace = QQ + UU
+    eigdiff = np.sqrt((QQ - UU)**2 + 4*QU**2)
+    
+    return np.sqrt((trace + eigdiff)/(trace - eigdiff))
+
+def get_planck_derived_quantities(T, Q, U, QQ, QU, UU):
+    """
+    Everything that follows from a pixel's Planck T, Q, U and covariance alone, for scalars or arrays of pixels, as a dictionary
+    keyed by pixel_data.planck_derived_columns: sigpsq (Planck XIX eq. B.2), pmeas, psimeas, snr, ellipticity, sigpGsq,
+    the inverse of sigma_p and the adaptive p0 grid bounds
+    """
+    derived = {}
+    derived["pmeas"], sigmameas, derived["snr"] = get_pixel_snr(T, Q, U, QQ, QU, UU)
+    derived["sigpsq"] = sigmameas**2
+    derived["psimeas"] = np.mod(0.5*np.arctan2(U, Q), np.pi)
+    derived["ellipticity"] = get_covariance_ellipticity(QQ, QU, UU)
+    derived["invsig_QQ"], derived["invsig_QU"], derived["invsig_UU"], derived["sigpGsq"] = get_planck_inverse_covariances(T, QQ, QU, UU)
+    derived["pgridmin"], derived["pgridmax"] = get_adaptive_p_bounds(T, Q, U, QQ, QU, UU)
+    
+    return derived
+
+def get_block_planck_quantities(block, found = None, adaptivep0 = True):
+    """
+    pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax for the found pixels (all if found is None)
+    of a get_pixel_data block. Read from the block if it holds the derived map products (see planck_memmap_to_derived),
+    computed from T, Q, U and covariance otherwise. Without adaptivep0 the bounds are [0, 1].
+    """
+    if found is None:
+        found = slice(None)
+    
+    if "invsig_QQ" in block:
+        (pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, 
+         pgridmin, pgridmax) = [block[name][found] for name in ["pmeas", "psimeas", "invsig_QQ", "invsig_QU", "invsig_UU", "sigpGsq", "pgridmin", "pgridmax"]]
+    else:
+        T, Q, U, QQ, QU, UU = [block[name][found] for name in ["T", "Q", "U", "QQ", "QU", "UU"]]
+        psimeas = np.mod(0.5*np.arctan2(U, Q), np.pi)
+        pmeas = np.sqrt(Q**2 + U**2)/T
+        invsig_QQ, invsig_QU, invsig_UU, sigpGsq = get_planck_inverse_covariances(T, QQ, QU, UU)
+        if adaptivep0 is True:
+            pgridmin, pgridmax = get_adaptive_p_bounds(T, Q, U, QQ, QU, UU)
+    
+    if adaptivep0 is not True:
+        pgridmin, pgridmax = np.zeros(len(pmeas)), np.ones(len(pmeas))
+    
+    return pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax
+
+def get_batch_posterior_planck_kwargs(block, found, adaptivep0 = True, npsample = 165):
+    """
+    BatchPosterior keyword arguments that take the p0 grids and inverse covariances of the found pixels from a block
+    holding the derived map products (see planck_memmap_to_derived). Empty for other blocks.
+    """
+    if "invsig_QQ" not in block:
+        return {}
+    
+    kwargs = {"inverse_covariances": tuple(block[name][found] for name in ["invsig_QQ", "invsig_QU", "invsig_UU", "sigpGsq"])}
+    if adaptivep0 is True:
+        kwargs["sample_p0"] = get_p_grids(block["pgridmin"][found], block["pgridmax"][found], npsample = npsample)
+    
+    return kwargs
+
+def get_rolled_psi0_grids(zero_theta, reverse_RHT = True, wlen = 75, verbose = False):
+    """
+    psi0 grids for (N,) zero thetas, in the order Prior leaves them (rolled to [0, pi), optionally reversed).
+    Returns sample_psi0, cos(2 psi0), sin(2 psi0), and the indices into the RHT theta bins, all (N, ntheta).
+    """
+    zero_theta = np.asarray(zero_theta, np.float_)
+    
+    # Create array of projected thetas from theta = 0
+    thets, cos2thets, sin2thets = get_thets_trig_tables(wlen, verbose = verbose)
+    sample_psi0 = np.mod(zero_theta[:, np.newaxis] - thets, np.pi)
+    cos2psi0, sin2psi0 = rotate_thets_trig_tables(zero_theta, cos2thets, sin2thets)
+
+    # Roll to [0, pi), as in roll_RHT_zero_to_pi. Needs 1 extra roll element to be monotonic
+    npsi = len(thets)
+    psi_0_indx = np.abs(sample_psi0).argmin(axis=1)
+    rollindx = np.mod(np.arange(npsi) + psi_0_indx[:, np.newaxis] + 1, npsi)
+    if reverse_RHT is True:
+        rollindx = rollindx[:, ::-1]
+    rows = np.arange(len(zero_theta))[:, np.newaxis]
+    
+    return sample_psi0[rows, rollindx], cos2psi0[rows, rollindx], sin2psi0[rows, rollindx], rollindx
+
+@stage_timing.timed("prior")
+def get_rht_prior_profiles(rht_data, zero_theta, reverse_RHT = True, gausssmooth = False, deltafuncprior = False, baseprioramp = 1E-8, wlen = 75, verbose = False):
+    """
+    Vectorized Prior along psi0 (it is constant in p0), for (N, ntheta) RHT data. Not normalized.
+    Returns psi0 grids, prior, and cos(2 psi0), sin(2 psi0), all (N, ntheta).
+    """
+    rht_data = np.array(rht_data, np.float_)
+    zero_theta = np.asarray(zero_theta, np.float_)
+    npix, npsi = rht_data.shape
+
+    # get max(R(theta)). theoretical maximum is 1
+    maxrht = np.max(rht_data, axis=1)
+
+    if deltafuncprior:
+        rht_data[:, :] = 0
+        rht_data[:, 80] = 100.0
+
+    if gausssmooth is True:
+        # Gaussian smooth with sigma = 3, wrapped boundaries for filter
+        rht_data = scipy.ndimage.gaussian_filter1d(rht_data, 3, mode = "wrap", axis = 1)
+
+    sample_psi0, cos2psi0, sin2psi0, rollindx = get_rolled_psi0_grids(zero_theta, reverse_RHT = reverse_RHT, wlen = wlen, verbose = verbose)
+    rht_data = rht_data[np.arange(npix)[:, np.newaxis], rollindx]
+
+    if baseprioramp is None:
+        prior = (rht_data + 0.7)*75
+    elif baseprioramp == "variable":
+        prior = rht_data + (1 - maxrht)[:, np.newaxis]
+    elif baseprioramp == "median_var":
+        prior = rht_data + np.maximum(0.25 - maxrht, 0)[:, np.newaxis]
+    elif baseprioramp == "max_var":
+        globalmaxval = 4.2041096687316895
+        prior = rht_data + np.maximum(globalmaxval - maxrht, 0)[:, np.newaxis]
+    else:
+        prior = rht_data + baseprioramp
+        
+    return sample_psi0, prior, cos2psi0, sin2psi0
+
+@stage_timing.timed("prior")
+def get_thetarht_prior_profiles(QRHT, URHT, QRHTsq, URHTsq, sample_psi0, fixwidth = False):
+    """
+    Vectorized PriorThetaRHT along psi0 (it is constant in p0): axial von Mises distributions centered on theta_RHT,
+    for arrays of pixels. Bessel functions are exponentially scaled, so concentrated pixels do not overflow.
+    Returns (N, npsi) priors (normalized over psi0 up to quadrature), theta_RHT and kappa.
+    """
+    QRHT = np.asarray(QRHT, np.float_)
+    URHT = np.asarray(URHT, np.float_)
+    
+    psimeas = np.asarray(polarization_tools.polarization_angle(QRHT, URHT, negU = False), np.float_)
+    
+    if fixwidth:
+        kappa = np.zeros(len(QRHT)) + 1/0.063165468166971897
+    else:
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            sig_psi, sig_P = polarization_tools.sigma_psi_P(QRHT, URHT, np.asarray(QRHTsq, np.float_), np.asarray(URHTsq, np.float_), degrees = False)
+            kappa = 1/np.asarray(sig_psi, np.float_)**2
+    
+    # cosh(kappa cos)/(pi I0(kappa)) = (exp(kappa (cos - 1)) + exp(-kappa (cos + 1)))/(2 pi ive(0, kappa)), all exponents <= 0
+    cosdiff = np.cos(sample_psi0[np.newaxis, :] - psimeas[:, np.newaxis])
+    with np.errstate(invalid = "ignore"):
+        prior = (np.exp(kappa[:, np.newaxis]*(cosdiff - 1)) + np.exp(-kappa[:, np.newaxis]*(cosdiff + 1)))/(2*np.pi*special.ive(0, kappa)[:, np.newaxis])
+    
+    return prior, psimeas, kappa
+
+def get_thetarht_tablename(smoothprior = False):
+    if smoothprior:
+        return "QURHT_QURHTsq_Gal_pol_ang_chS1004_1043_sig30"
+    else:
+        return "QURHT_QURHTsq_Gal_pol_ang_chS1004_1043"
+
+def get_thetarht_priors(ids, QU_QUsq_RHT_cursor, smoothprior = False, fixwidth = False, npsisample = 165):
+    """
+    theta_RHT priors for an array of ids (e.g. the whole sky), normalized over psi0 on the PlanckPosterior psi0 grid.
+    Q_RHT, U_RHT and their squares are read as arrays rather than row by row.
+    Returns (len(ids), npsisample) priors and found mask, False where the data are missing or give no finite prior.
+    """
+    (QRHT, URHT, QRHTsq, URHTsq), found = pixel_data.fetch_rows(QU_QUsq_RHT_cursor, get_thetarht_tablename(smoothprior), ids, 4)
+    
+    sample_psi0 = np.linspace(0, np.pi, npsisample, endpoint=False)
+    psi_dx = sample_psi0[1] - sample_psi0[0]
+    prior, psimeas, kappa = get_thetarht_prior_profiles(QRHT, URHT, QRHTsq, URHTsq, sample_psi0, fixwidth = fixwidth)
+    with np.errstate(invalid = "ignore"):
+        normed_prior = prior/(psi_dx*np.trapz(prior, axis=1))[:, np.newaxis]
+    
+    found &= np.all(np.isfinite(normed_prior), axis=1)
+    
+    return normed_prior, found
+
+class BatchPosterior(BayesianComponent):
+    """
+    Class for building posteriors for many pixels at once.
+    Equivalent to Posterior (useprior = "RHTPrior" or "ThetaRHT") or PlanckPosterior (useprior = None),
+    but evaluated on an (N, npsi, np) stack from arrays of Planck and RHT data.
+    
+    precision = "float32" builds the grids in single precision in log space: log-prior + log-likelihood,
+    shifted by each pixel's maximum before exponentiating. This halves the memory per grid, and high-SNR
+    pixels whose float64 likelihood underflows to zero everywhere still get a well-defined posterior.
+    
+    normed_prior_psi0 (N, ntheta) are RHT priors already normalized over psi0 (see precompute_rht_priors).
+    If given, they are used instead of building priors from rht_data; zero_theta is still needed.
+    With useprior = "ThetaRHT", normed_prior_psi0 are the theta_RHT priors (see get_thetarht_priors) on the PlanckPosterior psi0 grid.
+    inverse_covariances (invsig_QQ, invsig_QU, invsig_UU, sigpGsq), if given, are used instead of inverting sigma_p
+    (e.g. from the derived map products, see get_batch_posterior_planck_kwargs).
+    """
+
+    def __init__(self, hp_indices, T, Q, U, QQ, QU, UU, rht_data = None, zero_theta = None, sample_p0 = None, adaptivep0 = True,
+                 useprior = "RHTPrior", reverse_RHT = True, gausssmooth_prior = False, deltafuncprior = False, baseprioramp = 1E-8,
+                 npsample = 165, npsisample = 165, wlen = 75, verbose = False, precision = "float64", normed_prior_psi0 = None,
+                 inverse_covariances = None):
+        BayesianComponent.__init__(self, np.asarray(hp_indices), verbose = verbose)
+        
+        if precision not in ["float64", "float32"]:
+            raise ValueError("precision must be 'float64' or 'float32'")
+        self.precision = precision
+
+        self.T = np.asarray(T, np.float_)
+        self.Q = np.asarray(Q, np.float_)
+        self.U = np.asarray(U, np.float_)
+        self.QQ = np.asarray(QQ, np.float_)
+        self.QU = np.asarray(QU, np.float_)
+        self.UU = np.asarray(UU, np.float_)
+        self.inverse_covariances = inverse_covariances
+        npix = len(self.T)
+
+        # measured polarization angle and fraction
+        self.psimeas = np.mod(0.5*np.arctan2(self.U, self.Q), np.pi)
+        self.pmeas = np.sqrt(self.Q**2 + self.U**2)/self.T
+        self.naive_psi = self.psimeas
+
+        # one p0 grid per pixel
+        if sample_p0 is None:
+            if adaptivep0 is True:
+                self.sample_p0 = self.get_adaptive_p_grids(npsample = npsample)
+            else:
+                self.sample_p0 = np.tile(np.linspace(0, 1, npsample), (npix, 1))
+        else:
+            self.sample_p0 = np.tile(sample_p0, (npix, 1)) if np.ndim(sample_p0) == 1 else np.asarray(sample_p0)
+        self.p_dx = self.sample_p0[:, 1] - self.sample_p0[:, 0]
+
+        with stage_timing.stage("prior"):
+            if (useprior == "RHTPrior") and (normed_prior_psi0 is not None):
+                self.sample_psi0, self.cos2psi0, self.sin2psi0, rollindx = get_rolled_psi0_grids(zero_theta, reverse_RHT = reverse_RHT, wlen = wlen)
+                self.psi_dx = np.abs(self.sample_psi0[:, 1] - self.sample_psi0[:, 0])
+                prange = self.sample_p0[:, -1] - self.sample_p0[:, 0]
+                self.normed_prior_1d = np.asarray(normed_prior_psi0, np.float_)/prange[:, np.newaxis]
+            elif useprior == "RHTPrior":
+                self.sample_psi0, self.normed_prior_1d, self.psi_dx = self.get_rht_priors(rht_data, zero_theta, reverse_RHT = reverse_RHT,
+                                                        gausssmooth = gausssmooth_prior, deltafuncprior = deltafuncprior,
+                                                        baseprioramp = baseprioramp, wlen = wlen)
+            else:
+                # Flat (or given theta_RHT) prior on the PlanckPosterior psi0 grid
+                psi0_all = np.linspace(0, np.pi, npsisample, endpoint=False)
+                self.sample_psi0 = np.tile(psi0_all, (npix, 1))
+                self.cos2psi0, self.sin2psi0 = get_psi0_trig_tables(psi0_all)
+                self.psi_dx = np.abs(self.sample_psi0[:, 1] - self.sample_psi0[:, 0])
+                if (useprior == "ThetaRHT") and (normed_prior_psi0 is not None):
+                    prange = self.sample_p0[:, -1] - self.sample_p0[:, 0]
+                    self.normed_prior_1d = np.asarray(normed_prior_psi0, np.float_)/prange[:, np.newaxis]
+                else:
+                    self.normed_prior_1d = np.ones(self.sample_psi0.shape, np.float_)
+
+        # Prior is constant in p0, so broadcast it along the p axis rather than storing a copy
+        self.normed_prior = self.normed_prior_1d[:, :, np.newaxis]
+        
+        if precision == "float32":
+            self.lnposterior = self.get_lnlikelihoods(dtype = np.float32)
+        else:
+            self.planck_likelihood = self.get_likelihoods()
+        
+        with stage_timing.stage("normalization"):
+            if precision == "float32":
+                # log-sum-exp style: the shifted posterior peaks at 1 in every pixel
+                self.lnposterior += np.log(self.normed_prior).astype(np.float32)
+                self.lnposterior_max = np.max(self.lnposterior, axis = (1, 2))
+                self.lnposterior -= self.lnposterior_max[:, np.newaxis, np.newaxis]
+                self.posterior = np.exp(self.lnposterior)
+            else:
+                self.posterior = self.planck_likelihood*self.normed_prior
+            
+            self.posterior_integrated_over_psi = self.integrate_highest_dimension(self.posterior)*self.psi_dx[:, np.newaxis]
+            self.posterior_integrated_over_p_and_psi = self.integrate_highest_dimension(self.posterior_integrated_over_psi)*self.p_dx
+    
+            self.normed_posterior = self.posterior/self.posterior_integrated_over_p_and_psi.astype(self.posterior.dtype)[:, np.newaxis, np.newaxis]
+
+    def get_adaptive_p_grids(self, npsample = 165):
+        """
+        Vectorized get_adaptive_p_grid: p0 grid spanning pmeas +/- 7 sigma_p, bounded by [0, 1]
+        """
+        pgridmin, pgridmax = get_adaptive_p_bounds(self.T, self.Q, self.U, self.QQ, self.QU, self.UU)
+
+        return get_p_grids(pgridmin, pgridmax, npsample = npsample)
+
+    def get_rht_priors(self, rht_data, zero_theta, reverse_RHT = True, gausssmooth = False, deltafuncprior = False, baseprioramp = 1E-8, wlen = 75):
+        """
+        Vectorized Prior. Returns psi0 grids, 1D normalized priors along psi0, and psi0 spacing.
+        """
+        sample_psi0, prior, self.cos2psi0, self.sin2psi0 = get_rht_prior_profiles(rht_data, zero_theta, reverse_RHT = reverse_RHT, gausssmooth = gausssmooth, 
+                                                                                  deltafuncprior = deltafuncprior, baseprioramp = baseprioramp, wlen = wlen, verbose = self.verbose)
+
+        psi_dx = np.abs(sample_psi0[:, 1] - sample_psi0[:, 0])
+
+        # Prior is flat in p0, so the 2D integral is (p range) x (integral over psi0)
+        prange = self.sample_p0[:, -1] - self.sample_p0[:, 0]
+        integrated_over_p_and_psi = prange*psi_dx*np.trapz(prior, axis=1)
+        normed_prior = prior/integrated_over_p_and_psi[:, np.newaxis]
+
+        return sample_psi0, normed_prior, psi_dx
+
+    def get_inverse_covariances(self):
+        """
+        Inverse of sigma_p for every pixel, as (invsig_QQ, invsig_QU, invsig_UU). Also sets sigpGsq.
+        """
+        if self.inverse_covariances is not None:
+            invsig_QQ, invsig_QU, invsig_UU, self.sigpGsq = self.inverse_covariances
+        else:
+            invsig_QQ, invsig_QU, invsig_UU, self.sigpGsq = get_planck_inverse_covariances(self.T, self.QQ, self.QU, self.UU)
         
+        return invsig_QQ, invsig_QU, invsig_UU
+
+    @stage_timing.timed("likelihood")
+    def get_likelihoods(self):
+        """
+        Vectorized Likelihood. Returns (N, npsi, np) stack.
+        """
+        invsig_QQ, invsig_QU, invsig_UU = self.get_inverse_covariances()
+
+        likelihood = factorized_likelihood(self.pmeas, self.psimeas, invsig_QQ, invsig_QU, invsig_UU, self.sigpGsq,
+                                           self.sample_p0, self.cos2psi0, self.sin2psi0)
+
+        return likelihood
+    
+    @stage_timing.timed("likelihood")
+    def get_lnlikelihoods(self, dtype = np.float32):
+        """
+        Vectorized log Likelihood in dtype. Returns (N, npsi, np) stack.
+        """
+        invsig_QQ, invsig_QU, invsig_UU = self.get_inverse_covariances()
+
+        lnlikelihood = lnlikelihood_grid(self.pmeas, self.psimeas, invsig_QQ, invsig_QU, invsig_UU, self.sigpGsq,
+                                         self.sample_p0, self.cos2psi0, self.sin2psi0, dtype = dtype)
+
+        return lnlikelihood
+
 def lnlikelihood(hp_index, T, Q, U, QQ, QU, UU, p0, psi0):    
         
     # sigma_p as defined in arxiv:1407.0178v1 Eqn 3.
@@ -669,6 +1162,115 @@ def MCMC_posterior(hp_index, region="SC_241", rht_cursor = None, adaptivep0 = Tr
         #print(pmed16, pmed84, psimed16, psimed84)
     
     return pmed, psimed, sampler, startpos, posout
+
+def get_periodic_interpolant(sample_psi0, values, period = np.pi):
+    """
+    Sorted knots for periodic linear interpolation in psi0, padded by one wrapped point at each end,
+    so that np.interp(np.mod(psi0, period), knots, knot_values) matches np.interp(psi0, sample_psi0, values, period = period)
+    """
+    sample_psi0 = np.mod(sample_psi0, period)
+    order = np.argsort(sample_psi0)
+    knots = sample_psi0[order]
+    knot_values = np.asarray(values)[order]
+    
+    knots = np.concatenate(([knots[-1] - period], knots, [knots[0] + period]))
+    knot_values = np.concatenate(([knot_values[-1]], knot_values, [knot_values[0]]))
+    
+    return knots, knot_values
+
+def lnposterior_vectorized(p0psi0, lowerp0bound, upperp0bound, pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, prior_knots, prior_values):
+    """
+    ln posterior for a whole (nwalkers, 2) ensemble of (p0, psi0) at once, for emcee with vectorize = True.
+    Equivalent to lnposterior, with the inverse covariance and the normalized prior interpolant precomputed.
+    """
+    p0 = p0psi0[:, 0]
+    psi0 = p0psi0[:, 1]
+    
+    # residual between measured and true (Q, U)/I
+    dQ = pmeas*np.cos(2*psimeas) - p0*np.cos(2*psi0)
+    dU = pmeas*np.sin(2*psimeas) - p0*np.sin(2*psi0)
+    
+    lnlike = np.log(1.0/(np.pi*sigpGsq)) - 0.5*(invsig_QQ*dQ**2 + 2*invsig_QU*dQ*dU + invsig_UU*dU**2)
+    lnpriorout = np.log(np.interp(np.mod(psi0, np.pi), prior_knots, prior_values))
+    
+    inbounds = (p0 <= upperp0bound) & (p0 >= lowerp0bound)
+    
+    return np.where(inbounds, lnlike + lnpriorout, -np.inf)
+
+def MCMC_posterior_vectorized(hp_index, region="SC_241", rht_cursor = None, adaptivep0 = True, verbose=False, local=False, proposal_scale=2.0, 
+                              data_provider=None, gausssmooth=True, nwalkers=250, nburn=50, nsteps=250):
+    """
+    MCMC_posterior with every per-pixel quantity computed once: Planck data, inverse covariance, and the normalized
+    prior as a periodic interpolant in psi0. Each step evaluates the whole walker ensemble in one call (requires emcee >= 3).
+    data_provider : if not None, Planck, zero-theta and RHT data are read from it instead of opening databases
+    """
+    ndim = 2
+    
+    if data_provider is None:
+        data_provider = get_data_provider(region = region)
+        if local is True:
+            rht_data = rht_cursor.execute("SELECT * FROM RHT_weights WHERE id = ?", (hp_index,)).fetchone()[1:]
+        else:
+            rht_data = rht_cursor.execute("SELECT * FROM RHT_weights_allsky WHERE id = ?", (hp_index,)).fetchone()[1:]
+    else:
+        rht_data = data_provider.get_rht_weights([hp_index])[0][0]
+    
+    # Get planck data once
+    (T, Q, U) = data_provider.get_planck_tqu_pixel(hp_index)
+    (TT, TQ, TU, TQa, QQ, QU, TUa, QUa, UU) = data_provider.get_planck_cov_pixel(hp_index)
+    
+    if adaptivep0 is True:
+        lowerp0bound, upperp0bound = get_adaptive_p_bounds(T, Q, U, QQ, QU, UU)
+    else:
+        lowerp0bound = 0.0
+        upperp0bound = 1.0 
+    
+    if verbose is True:
+        print("lower {}, upper {}".format(lowerp0bound, upperp0bound))
+    
+    # Normalized prior, as in lnprior
+    rht_data = np.asarray(rht_data, np.float_)
+    if gausssmooth is True:
+        rht_data = scipy.ndimage.gaussian_filter1d(rht_data, 3, mode = "wrap")
+    
+    bayesiantool = BayesianComponent(hp_index, verbose = verbose)
+    sample_psi0 = bayesiantool.get_psi0_sampling_grid(hp_index, verbose = verbose, data_provider = data_provider)
+    prior = (rht_data + 0.7)*75
+    psi_dx = sample_psi0[1] - sample_psi0[0]
+    normed_prior = (prior/np.trapz(prior, dx = -psi_dx))/(upperp0bound - lowerp0bound)
+    prior_knots, prior_values = get_periodic_interpolant(sample_psi0, normed_prior)
+    
+    invsig_QQ, invsig_QU, invsig_UU, sigpGsq = get_planck_inverse_covariances(T, QQ, QU, UU)
+    
+    # measured naive polarization angle and polarization fraction
+    psimeas = np.mod(0.5*np.arctan2(U, Q), np.pi)
+    pmeas = np.sqrt(Q**2 + U**2)/T
+    
+    if verbose is True:
+        print("naive p: {}, naive psi: {}".format(pmeas, psimeas))
+    
+    # walkers begin clustered around naive values
+    startpos = np.array([pmeas, psimeas]) + 1e-2*np.random.randn(nwalkers, ndim)
+    startpos[:, 1] = np.mod(startpos[:, 1], np.pi)
+    
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnposterior_vectorized, moves = emcee.moves.StretchMove(a = proposal_scale), vectorize = True,
+                                    args = [lowerp0bound, upperp0bound, pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, prior_knots, prior_values])
+    state = sampler.run_mcmc(startpos, nburn)
+    posout = np.copy(state.coords)
+    sampler.reset()
+    posout[:, 1] = np.mod(posout[:, 1], np.pi)
+    sampler.run_mcmc(posout, nsteps)
+    
+    flatchain = sampler.get_chain(flat = True)
+    flatchain[:, 1] = np.mod(flatchain[:, 1], np.pi)
+    pmed, psimed = np.percentile(flatchain, 50, axis=0)
+    
+    if verbose is True:
+        print(np.mean(flatchain, axis=0))
+        print("Mean acceptance fraction: {0:.3f}".format(np.mean(sampler.acceptance_fraction)))
+        print(pmed, psimed)
+    
+    return pmed, psimed, sampler, startpos, posout
       
 def lnposterior_interpolated(pt, bayesian_object, lowerp0bound, upperp0bound):
     
@@ -714,10 +1316,91 @@ def MCMC_posterior_interpolated(bayesian_object):
     
     #return pmed, psimed, 
 
-def latex_formatter(x, pos):
-    return "${0:.1f}$".format(x)
+def get_periodic_posterior_interpolant(sample_psi0, sample_p0, lnposterior_grid, period = np.pi):
+    """
+    Tables for bilinear interpolation of a gridded (npsi, np) ln posterior, periodic in psi0. Built once per pixel.
+    Returns sorted psi0 knots padded by one wrapped row at each end, p0 knots, and the matching (npsi + 2, np) grid.
+    """
+    sample_psi0 = np.mod(sample_psi0, period)
+    order = np.argsort(sample_psi0)
+    knots = sample_psi0[order]
+    lnposterior_grid = lnposterior_grid[order, :]
+    
+    # wrap one row at each end in psi0
+    knots = np.concatenate(([knots[-1] - period], knots, [knots[0] + period]))
+    lnposterior_grid = np.concatenate((lnposterior_grid[-1:, :], lnposterior_grid, lnposterior_grid[:1, :]), axis=0)
+    
+    return knots, np.asarray(sample_p0), lnposterior_grid
 
-def plot_bayesian_component_from_posterior(posterior_obj, component = "posterior", ax = None, cmap = "cubehelix"):
+def bilinear_interpolation(psi0, p0, psi_knots, p_knots, grid):
+    """
+    Bilinear interpolation of grid at arrays of points (psi0, p0), which must lie within the knots
+    """
+    i = np.clip(np.searchsorted(psi_knots, psi0) - 1, 0, len(psi_knots) - 2)
+    j = np.clip(np.searchsorted(p_knots, p0) - 1, 0, len(p_knots) - 2)
+    
+    tpsi = (psi0 - psi_knots[i])/(psi_knots[i + 1] - psi_knots[i])
+    tp = (p0 - p_knots[j])/(p_knots[j + 1] - p_knots[j])
+    
+    return ((1 - tpsi)*((1 - tp)*grid[i, j] + tp*grid[i, j + 1]) + 
+            tpsi*((1 - tp)*grid[i + 1, j] + tp*grid[i + 1, j + 1]))
+
+def lnposterior_interpolated_vectorized(pts, psi_knots, p_knots, lnposterior_grid, lowerp0bound, upperp0bound):
+    """
+    lnposterior_interpolated for a whole (nwalkers, 2) ensemble of (p0, psi0) at once, for emcee with vectorize = True
+    """
+    p0 = pts[:, 0]
+    psi0 = pts[:, 1]
+    
+    inbounds = (p0 <= upperp0bound) & (p0 >= lowerp0bound)
+    lnpost = bilinear_interpolation(np.mod(psi0, np.pi), np.clip(p0, lowerp0bound, upperp0bound), psi_knots, p_knots, lnposterior_grid)
+    
+    # zeros in the gridded posterior interpolate to nan in log space
+    lnpost[~inbounds | np.isnan(lnpost)] = -np.inf
+    
+    return lnpost
+
+def MCMC_posterior_interpolated_vectorized(bayesian_object, nwalkers = 250, nburn = 50, nsteps = 500, verbose = False):
+    """
+    MCMC_posterior_interpolated with one periodic 2D interpolation table of the gridded posterior, reused for the
+    whole chain, and whole walker ensembles evaluated per call (requires emcee >= 3).
+    Returns median p0, psi0 and the sampler.
+    """
+    ndim = 2
+    
+    lowerp0bound = np.nanmin(bayesian_object.sample_p0)
+    upperp0bound = np.nanmax(bayesian_object.sample_p0)
+    
+    psi_knots, p_knots, lnposterior_grid = get_periodic_posterior_interpolant(bayesian_object.sample_psi0, bayesian_object.sample_p0, np.log(bayesian_object.normed_posterior))
+    
+    # walkers begin clustered around naive values
+    startpos = np.array([bayesian_object.pmeas, bayesian_object.psimeas]) + 1e-2*np.random.randn(nwalkers, ndim)
+    startpos[:, 1] = np.mod(startpos[:, 1], np.pi)
+    
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnposterior_interpolated_vectorized, vectorize = True, args = [psi_knots, p_knots, lnposterior_grid, lowerp0bound, upperp0bound])
+    state = sampler.run_mcmc(startpos, nburn)
+    posout = np.copy(state.coords)
+    sampler.reset()
+    posout[:, 1] = np.mod(posout[:, 1], np.pi)
+    sampler.run_mcmc(posout, nsteps)
+    
+    flatchain = sampler.get_chain(flat = True)
+    pmed, psimed = np.percentile(flatchain, 50, axis=0)
+    
+    if verbose is True:
+        pmed16, psimed16 = np.percentile(flatchain, 16, axis=0)
+        pmed84, psimed84 = np.percentile(flatchain, 84, axis=0)
+        print(np.mean(flatchain, axis=0))
+        print("Mean acceptance fraction: {0:.3f}".format(np.mean(sampler.acceptance_fraction)))
+        print(pmed, psimed)
+        print(pmed16, pmed84, psimed16, psimed84)
+    
+    return pmed, psimed, sampler
+
+def latex_formatter(x, pos):
+    return "${0:.1f}$".format(x)
+
+def plot_bayesian_component_from_posterior(posterior_obj, component = "posterior", ax = None, cmap = "cubehelix"):
     
     if ax is None:
         fig = plt.figure()
@@ -977,6 +1660,7 @@ def circular_integration(xpoints, ypoints, endpoint_included=False, axis=0):
     
     return intdata
     
+@stage_timing.timed("estimator")
 def maximum_a_posteriori(posterior_obj, verbose = False):
     """
     MAP estimator
@@ -1122,6 +1806,7 @@ def compare_ludo(save=False):
     print(2447655, pplanckMB2447655, psiplanckMB2447655)
     print(3400757, pplanckMB3400757, psiplanckMB3400757)
     
+@stage_timing.timed("estimator")
 def mean_bayesian_posterior(posterior_obj, center = "naive", verbose = True, tol=0.1):#1E-5):
     """
     Integrated first order moments of the posterior PDF
@@ -1153,9 +1838,360 @@ def mean_bayesian_posterior(posterior_obj, center = "naive", verbose = True, tol
     psiMB = 0.5*np.arctan2(np.sum(sin_nocenter_pdf), np.sum(cos_nocenter_pdf))
     
     psiMB = np.mod(psiMB, np.pi)
-    
+
     return pMB, psiMB#, psi0_ludo_new
+
+@stage_timing.timed("estimator")
+def mean_bayesian_posterior_batch(posterior_obj):
+    """
+    Integrated first order moments of a stack of posterior PDFs (BatchPosterior).
+    Same estimator as mean_bayesian_posterior, one pixel per leading index.
+    Grid-sized products are formed in the precision of the posterior.
+    """
+    posterior = posterior_obj.normed_posterior
+    dtype = posterior.dtype
+
+    sample_p0 = posterior_obj.sample_p0
+    sample_psi0 = posterior_obj.sample_psi0
+
+    # Sampling widths
+    pdx = sample_p0[:, 1] - sample_p0[:, 0]
+    psidx = sample_psi0[:, 1] - sample_psi0[:, 0]
+
+    # determine pMB
+    pMB_integrand = posterior*sample_p0.astype(dtype)[:, np.newaxis, :]
+    pMB_integrated_over_psi0 = posterior_obj.integrate_highest_dimension(pMB_integrand)*psidx[:, np.newaxis]
+    pMB = posterior_obj.integrate_highest_dimension(pMB_integrated_over_psi0)*pdx
+
+    # determine psiMB
+    sin_nocenter_pdf = np.trapz(posterior*np.sin(2*sample_psi0).astype(dtype)[:, :, np.newaxis], axis=1)*pdx[:, np.newaxis]
+    cos_nocenter_pdf = np.trapz(posterior*np.cos(2*sample_psi0).astype(dtype)[:, :, np.newaxis], axis=1)*pdx[:, np.newaxis]
+    psiMB = 0.5*np.arctan2(np.sum(sin_nocenter_pdf, axis=1), np.sum(cos_nocenter_pdf, axis=1))
+
+    psiMB = np.mod(psiMB, np.pi)
+
+    return pMB, psiMB
+
+@stage_timing.timed("likelihood")
+def get_likelihood_p0_moments(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, sample_p0, cos2psi0, sin2psi0):
+    """
+    Reductions over p0 of an (N, npsi, np) likelihood stack that mean_bayesian_posterior_batch needs for any prior
+    that is constant in p0. Each likelihood is scaled by its maximum, which cancels in the estimators.
+    Returns (N, npsi) trapz_p(L), trapz_p(L p0) and sum_p(L).
+    """
+    lnlikelihood = lnlikelihood_grid(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, sample_p0, cos2psi0, sin2psi0, dtype = np.float_)
+    lnlikelihood -= np.max(lnlikelihood, axis = (1, 2))[:, np.newaxis, np.newaxis]
+    likelihood = np.exp(lnlikelihood)
+    
+    p_weights = np.ones(likelihood.shape[2])
+    p_weights[[0, -1]] = 0.5
+    
+    L_int = np.einsum("nij,j->ni", likelihood, p_weights)
+    Lp_int = np.einsum("nij,nj->ni", likelihood, p_weights*sample_p0)
+    L_sum = np.sum(likelihood, axis = 2)
+    
+    return L_int, Lp_int, L_sum
+
+@stage_timing.timed("likelihood")
+def get_likelihood_p0_integrals(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, pgridmin, pgridmax, cos2psi0, sin2psi0):
+    """
+    Closed-form integrals over p0 in [pgridmin, pgridmax] of the Planck likelihood, for (N, npsi) psi0 grids.
+    At fixed psi0 the likelihood is a Gaussian in p0, exp(-chi2min/2) exp(-M (p0 - mu)^2/2), so the integrals are error
+    functions. Tails are evaluated with erfcx so that pixels whose p0 peak lies outside the bounds stay accurate.
+    Each pixel is scaled by its smallest chi2min, which cancels in the estimators.
+    Returns (N, npsi) int L dp0 and int L p0 dp0, in the place of trapz_p(L) and trapz_p(L p0) from get_likelihood_p0_moments.
+    """
+    measpart0 = (pmeas*np.cos(2*psimeas))[:, np.newaxis]
+    measpart1 = (pmeas*np.sin(2*psimeas))[:, np.newaxis]
+    invsig_QQ = np.asarray(invsig_QQ)[:, np.newaxis]
+    invsig_QU = np.asarray(invsig_QU)[:, np.newaxis]
+    invsig_UU = np.asarray(invsig_UU)[:, np.newaxis]
+    a = np.asarray(pgridmin, np.float_)[:, np.newaxis]
+    b = np.asarray(pgridmax, np.float_)[:, np.newaxis]
+    
+    # chi2(p0) = K - 2 p0 L + p0^2 M at every psi0
+    Kpart = invsig_QQ*measpart0**2 + 2*invsig_QU*measpart0*measpart1 + invsig_UU*measpart1**2
+    Lpart = (invsig_QQ*measpart0 + invsig_QU*measpart1)*cos2psi0 + (invsig_QU*measpart0 + invsig_UU*measpart1)*sin2psi0
+    Mpart = invsig_QQ*cos2psi0**2 + 2*invsig_QU*cos2psi0*sin2psi0 + invsig_UU*sin2psi0**2
+    mu = Lpart/Mpart
+    chi2min = np.maximum(Kpart - Lpart*mu, 0)
+    chi2min -= np.min(chi2min, axis = 1)[:, np.newaxis]
+    
+    r = np.sqrt(0.5*Mpart)
+    x_lo = (a - mu)*r
+    x_hi = (b - mu)*r
+    
+    # int exp(-M (p0 - mu)^2/2) dp0 = sqrt(pi)/(2 r) (erf(x_hi) - erf(x_lo)), with the tails pulled out of erfcx
+    above = x_lo >= 0
+    below = x_hi <= 0
+    lnscale = -0.5*chi2min - np.where(above, x_lo**2, 0) - np.where(below, x_hi**2, 0)
+    with np.errstate(over = "ignore", invalid = "ignore"):
+        bracket = np.where(above, special.erfcx(x_lo) - special.erfcx(x_hi)*np.exp(x_lo**2 - x_hi**2),
+                  np.where(below, special.erfcx(-x_hi) - special.erfcx(-x_lo)*np.exp(x_hi**2 - x_lo**2),
+                           special.erf(x_hi) - special.erf(x_lo)))
+    L_int = 0.5*np.sqrt(np.pi)/r*np.exp(lnscale)*bracket
+    
+    # int p0 L dp0 = mu int L dp0 + (L(pgridmin) - L(pgridmax))/M
+    Lp_int = mu*L_int + (np.exp(-0.5*chi2min - x_lo**2) - np.exp(-0.5*chi2min - x_hi**2))/Mpart
+    
+    return L_int, Lp_int
+
+@stage_timing.timed("estimator")
+def mean_bayesian_posterior_separable(L_int, Lp_int, L_sum, prior, cos2psi0, sin2psi0):
+    """
+    pMB, psiMB of posteriors likelihood x prior from get_likelihood_p0_moments and (N, npsi) priors along psi0,
+    with the same quadrature as mean_bayesian_posterior_batch. The priors need not be normalized.
+    """
+    psi_weights = np.ones(prior.shape[1])
+    psi_weights[[0, -1]] = 0.5
+    weighted_prior = prior*psi_weights
+    
+    # normalization, which can be negative for baseprioramp = "variable"
+    norm = np.sum(weighted_prior*L_int, axis=1)
+    
+    pMB = np.sum(weighted_prior*Lp_int, axis=1)/norm
+    psiMB = 0.5*np.arctan2(np.sum(weighted_prior*L_sum*sin2psi0, axis=1)/norm, np.sum(weighted_prior*L_sum*cos2psi0, axis=1)/norm)
+    
+    return pMB, np.mod(psiMB, np.pi)
+
+@stage_timing.timed("fused posterior")
+def mean_bayesian_posterior_fused(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, sample_p0, cos2psi0, sin2psi0, prior, backend = None):
+    """
+    pMB, psiMB of likelihood x prior for (N, npsi) priors along psi0, without building posterior grids.
+    backend : "numba" (fused_posterior.mean_bayes_kernel, one pass per pixel that never stores the grid), "numpy"
+              (get_likelihood_p0_moments and mean_bayesian_posterior_separable), or None for numba when it is installed.
+    Same quadrature as mean_bayesian_posterior_batch. The priors need not be normalized.
+    """
+    if backend is None:
+        backend = "numba" if fused_posterior.have_numba else "numpy"
+    
+    if backend == "numba":
+        if not fused_posterior.have_numba:
+            raise ValueError("backend 'numba' requires numba")
+        npix = len(pmeas)
+        pMB = np.zeros(npix)
+        psiMB = np.zeros(npix)
+        fused_posterior.mean_bayes_kernel(np.ascontiguousarray(pmeas*np.cos(2*psimeas), np.float_), np.ascontiguousarray(pmeas*np.sin(2*psimeas), np.float_), 
+                                          np.ascontiguousarray(invsig_QQ, np.float_), np.ascontiguousarray(invsig_QU, np.float_), np.ascontiguousarray(invsig_UU, np.float_), 
+                                          np.ascontiguousarray(sample_p0, np.float_), np.ascontiguousarray(cos2psi0, np.float_), np.ascontiguousarray(sin2psi0, np.float_), 
+                                          np.ascontiguousarray(prior, np.float_), pMB, psiMB)
+        return pMB, psiMB
+    elif backend == "numpy":
+        L_int, Lp_int, L_sum = get_likelihood_p0_moments(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, sample_p0, cos2psi0, sin2psi0)
+        
+        return mean_bayesian_posterior_separable(L_int, Lp_int, L_sum, prior, cos2psi0, sin2psi0)
+    else:
+        raise ValueError("backend must be 'numba', 'numpy' or None")
+
+def interpolate_quantiles(x, cdf, quantiles):
+    """
+    x at each of quantiles, linearly interpolated, for (N, n) rows of x and nondecreasing cdf.
+    Returns (N, len(quantiles)).
+    """
+    rows = np.arange(x.shape[0])
+    out = np.zeros((x.shape[0], len(quantiles)), np.float_)
+    for k, q in enumerate(quantiles):
+        hi = np.clip(np.sum(cdf < q, axis=1), 1, x.shape[1] - 1)
+        lo = hi - 1
+        dcdf = cdf[rows, hi] - cdf[rows, lo]
+        frac = np.clip(np.where(dcdf > 0, (q - cdf[rows, lo])/np.where(dcdf > 0, dcdf, 1), 0), 0, 1)
+        out[:, k] = x[rows, lo] + frac*(x[rows, hi] - x[rows, lo])
+    
+    return out
+
+@stage_timing.timed("estimator")
+def posterior_summary_batch(posterior_obj):
+    """
+    Point estimates and uncertainties for a stack of posterior PDFs (BatchPosterior), reading each posterior once:
+    both marginals and the MAP index come from the grid, everything else from the marginals.
+    Returns a dictionary of (N,) arrays:
+    pMB, psiMB     : as mean_bayesian_posterior_batch
+    pMAP, psiMAP   : as maximum_a_posteriori
+    sigma_p        : standard deviation of the p0 marginal
+    sigma_psi      : circular standard deviation of the psi0 marginal about psiMB
+    p68_lo, p68_hi, p95_lo, p95_hi         : equal-tailed credible intervals in p0
+    psi68_lo, psi68_hi, psi95_lo, psi95_hi : equal-tailed credible intervals in psi0 about psiMB, mod pi
+    """
+    posterior = posterior_obj.normed_posterior
+    dtype = posterior.dtype
+    nbatch, npsi, npgrid = posterior.shape
+    rows = np.arange(nbatch)
+
+    sample_p0 = posterior_obj.sample_p0
+    sample_psi0 = posterior_obj.sample_psi0
+
+    # Sampling widths
+    pdx = sample_p0[:, 1] - sample_p0[:, 0]
+    psidx = sample_psi0[:, 1] - sample_psi0[:, 0]
+    
+    # trapezoid weights
+    psi_weights = np.ones(npsi, dtype)
+    psi_weights[[0, -1]] = 0.5
+    p_weights = np.ones(npgrid, dtype)
+    p_weights[[0, -1]] = 0.5
+    
+    # The only passes over the grids
+    p_marginal = np.einsum("nij,i->nj", posterior, psi_weights).astype(np.float_)*psidx[:, np.newaxis]
+    psi_marginal = np.einsum("nij,j->ni", posterior, p_weights).astype(np.float_)*pdx[:, np.newaxis]
+    map_indx = np.argmax(posterior.reshape(nbatch, -1), axis=1)
+    
+    # argmax stops at nans, so redo those pixels ignoring them
+    for n in np.where(np.any(np.isnan(p_marginal), axis=1))[0]:
+        if np.all(np.isnan(posterior[n])):
+            map_indx[n] = -1
+        else:
+            map_indx[n] = np.nanargmax(posterior[n])
+    
+    summary = {}
+    psi_map_indx, p_map_indx = np.unravel_index(np.maximum(map_indx, 0), (npsi, npgrid))
+    summary["pMAP"] = np.where(map_indx >= 0, sample_p0[rows, p_map_indx], np.nan)
+    summary["psiMAP"] = np.where(map_indx >= 0, sample_psi0[rows, psi_map_indx], np.nan)
+    
+    # p0 moments and credible intervals from the p0 marginal
+    norm = np.trapz(p_marginal, axis=1)*pdx
+    summary["pMB"] = np.trapz(p_marginal*sample_p0, axis=1)*pdx
+    p2MB = np.trapz(p_marginal*sample_p0**2, axis=1)*pdx
+    summary["sigma_p"] = np.sqrt(np.maximum(p2MB/norm - (summary["pMB"]/norm)**2, 0))
+    
+    p_cdf = np.zeros(p_marginal.shape, np.float_)
+    p_cdf[:, 1:] = np.cumsum(0.5*(p_marginal[:, 1:] + p_marginal[:, :-1]), axis=1)
+    p_cdf /= p_cdf[:, -1:]
+    p_bounds = interpolate_quantiles(sample_p0, p_cdf, [0.16, 0.84, 0.025, 0.975])
+    summary["p68_lo"], summary["p68_hi"], summary["p95_lo"], summary["p95_hi"] = p_bounds.T
+    
+    # psiMB with the same weights as mean_bayesian_posterior_batch: trapz over psi0, plain sum over p0
+    psiMB_weights = psi_weights*(psi_marginal/pdx[:, np.newaxis] + 0.5*(posterior[:, :, 0] + posterior[:, :, -1]))
+    psiMB = 0.5*np.arctan2(np.sum(psiMB_weights*np.sin(2*sample_psi0), axis=1), np.sum(psiMB_weights*np.cos(2*sample_psi0), axis=1))
+    summary["psiMB"] = np.mod(psiMB, np.pi)
+    
+    # psi0 uncertainties and credible intervals from the psi0 marginal, about psiMB
+    
+    dpsi = np.mod(sample_psi0 - summary["psiMB"][:, np.newaxis] + np.pi/2, np.pi) - np.pi/2
+    psi_norm = np.sum(psi_marginal, axis=1)
+    summary["sigma_psi"] = np.sqrt(np.sum(psi_marginal*dpsi**2, axis=1)/psi_norm)
+    
+    order = np.argsort(dpsi, axis=1)
+    dpsi = dpsi[rows[:, np.newaxis], order]
+    psi_marginal = psi_marginal[rows[:, np.newaxis], order]
+    psi_cdf = (np.cumsum(psi_marginal, axis=1) - 0.5*psi_marginal)/psi_norm[:, np.newaxis]
+    psi_bounds = np.mod(summary["psiMB"][:, np.newaxis] + interpolate_quantiles(dpsi, psi_cdf, [0.16, 0.84, 0.025, 0.975]), np.pi)
+    summary["psi68_lo"], summary["psi68_hi"], summary["psi95_lo"], summary["psi95_hi"] = psi_bounds.T
+    
+    return summary
+
+def get_mass_window(mass, circular = False):
+    """
+    Smallest run of consecutive samples holding every True entry of mass, padded by one sample on each side.
+    If circular, the run may wrap around the end of the array. Returns (first, count); count may exceed len(mass) - 1
+    only when the whole array is needed.
+    """
+    nsamp = len(mass)
+    indx = np.nonzero(mass)[0]
+    if circular:
+        # The window is the complement of the largest circular gap between flagged samples
+        gaps = np.diff(np.concatenate((indx, [indx[0] + nsamp])))
+        largest = np.argmax(gaps)
+        first = indx[(largest + 1) % len(indx)]
+        count = nsamp - gaps[largest] + 1
+    else:
+        first = indx[0]
+        count = indx[-1] - indx[0] + 1
     
+    return first - 1, count + 2
+
+@stage_timing.timed("estimator")
+def adaptive_mean_bayesian_posterior(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax, cos2psi0, sin2psi0, prior_psi0, 
+                                     tol = 1E-5, npcoarse = 33, psistride = 8, maxlevel = 10, threshold = 1E-12, verbose = False):
+    """
+    Coarse-to-fine mean Bayesian pMB, psiMB for one pixel.
+    Starts on a coarse (p0, psi0) grid: npcoarse points in [pgridmin, pgridmax] and every psistride'th psi0 sample.
+    Each level keeps only the psi0 window where the posterior exceeds threshold x its peak (plus one sample either side)
+    and halves the psi0 spacing there, until psi0 is sampled at the full resolution of the given grid, on which the (RHT)
+    prior prior_psi0 is defined (cos2psi0, sin2psi0 give cos(2 psi0), sin(2 psi0) on that grid). The p0 window is then
+    trimmed the same way, and its spacing halved. Trapezoid errors along p0 fall at least as (spacing)^2, so each halving
+    is combined with the previous one in a Richardson step, and refinement stops when successive raw or extrapolated
+    pMB and psiMB change by less than tol.
+    Integrals over psi0 use the trapezoid weights of mean_bayesian_posterior on the given psi0 grid (its first and last
+    samples count half), so refinement converges to the same estimator as a fine p0 grid would give. Integrals over p0
+    are trapezoidal throughout, for the Richardson step.
+    The likelihood is shifted by its maximum in log space before exponentiating, so a coarse grid that misses a narrow
+    peak still sees where the mass is.
+    Returns pMB, psiMB, the total number of grid points evaluated, and whether tol was met within maxlevel refinements
+    (if not, pMB and psiMB are those of the finest grid).
+    """
+    npsi = len(prior_psi0)
+    psi_start, psi_len = 0, npsi
+    plo, phi = pgridmin, pgridmax
+    stride = psistride
+    npsample = npcoarse
+    ptrimmed = False
+    
+    pMB_old = psiMB_old = None
+    pMB_extrap = psiMB_extrap = None
+    nevals = 0
+    converged = False
+    for level in xrange(maxlevel + 1):
+        psi_indx = np.mod(psi_start + np.arange(0, psi_len, stride), npsi)
+        sample_p0 = np.linspace(plo, phi, npsample)
+        
+        lnlikelihood = lnlikelihood_grid(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, sample_p0, cos2psi0[psi_indx], sin2psi0[psi_indx], dtype = np.float_)
+        posterior = np.exp(lnlikelihood - np.max(lnlikelihood))*prior_psi0[psi_indx, np.newaxis]
+        nevals += posterior.size
+        
+        # psi0 samples are equally spaced, so their spacing cancels between moments and normalization
+        psi_weights = np.where((psi_indx == 0) | (psi_indx == npsi - 1), 0.5, 1.0)
+        norm = np.dot(psi_weights, np.trapz(posterior, sample_p0, axis=1))
+        pMB = np.dot(psi_weights, np.trapz(posterior*sample_p0, sample_p0, axis=1))/norm
+        p_integrated = psi_weights*np.trapz(posterior, sample_p0, axis=1)
+        psiMB = np.mod(0.5*np.arctan2(np.dot(p_integrated, sin2psi0[psi_indx]), np.dot(p_integrated, cos2psi0[psi_indx])), np.pi)
+        
+        if verbose is True:
+            print("level {}: {} x {} grid, pMB = {}, psiMB = {}".format(level, len(psi_indx), len(sample_p0), pMB, psiMB))
+        
+        if stride > 1:
+            # Shrink the psi0 window to where the mass is, and halve the psi0 spacing
+            mass = np.any(posterior > threshold*np.max(posterior), axis=1)
+            psifirst, psicount = get_mass_window(mass, circular = (psi_len == npsi))
+            if (psicount - 1)*stride + 1 < psi_len:
+                psi_start = np.mod(psi_start + psifirst*stride, npsi)
+                psi_len = (psicount - 1)*stride + 1
+            stride = stride//2
+        elif not ptrimmed:
+            # The p0 window is only trimmed once psi0 is resolved: at an offset psi0 the likelihood peaks at lower p0
+            mass = np.any(posterior > threshold*np.max(posterior), axis=0)
+            pfirst, pcount = get_mass_window(mass)
+            ptrimmed = True
+            if (pfirst <= 0) and (pfirst + pcount - 1 >= len(sample_p0) - 1):
+                # Nothing to trim: this grid is the first step of the p0 refinement
+                pMB_old, psiMB_old = pMB, psiMB
+                npsample = 2*(npsample - 1) + 1
+            else:
+                # The trimmed window is narrower, so restart the p0 refinement from a coarser grid
+                plo = sample_p0[max(pfirst, 0)]
+                phi = sample_p0[min(pfirst + pcount - 1, len(sample_p0) - 1)]
+                npsample = (npsample - 1)//2 + 1
+        else:
+            pMB_raw, psiMB_raw = pMB, psiMB
+            if pMB_old is not None:
+                # Richardson extrapolation from this and the previous p0 spacing
+                pMB = pMB_raw + (pMB_raw - pMB_old)/3.0
+                psiMB = np.mod(psiMB_raw + angle_residual(psiMB_raw, psiMB_old, degrees = False)/3.0, np.pi)
+                # Either the raw estimates have already settled (smooth, well-contained posteriors), or the extrapolated ones have
+                if (np.abs(pMB_raw - pMB_old) < tol) and (np.abs(angle_residual(psiMB_raw, psiMB_old, degrees = False)) < tol):
+                    converged = True
+                    break
+                if (pMB_extrap is not None) and (np.abs(pMB - pMB_extrap) < tol) and (np.abs(angle_residual(psiMB, psiMB_extrap, degrees = False)) < tol):
+                    converged = True
+                    break
+                pMB_extrap, psiMB_extrap = pMB, psiMB
+            pMB_old, psiMB_old = pMB_raw, psiMB_raw
+            npsample = 2*(npsample - 1) + 1
+    
+    if (not converged) and (verbose is True):
+        print("Not converged to tol {} after {} levels".format(tol, maxlevel))
+    
+    return pMB, psiMB, nevals, converged
+
 def mean_bayesian_posterior_old(posterior_obj, center = "naive", verbose = True, tol=0.1):#1E-5):
     """
     Integrated first order moments of the posterior PDF
@@ -1408,7 +2444,285 @@ def get_rht_QU_cursors(local = False, smoothprior=False, sig=30):
 
     return QU_QUsq_RHT_cursor
 
-def sample_all_rht_points(all_ids, adaptivep0=True, rht_cursor=None, region="SC_241", useprior="RHTPrior", gausssmooth_prior=False, tol=1E-5, sampletype="mean_bayes", verbose=False, mcmc=False, deltafuncprior=False, testpsiproj=False, testthetas=False, baseprioramp=1E-8):
+def get_data_provider(rht_cursor = None, region = "SC_241", planck_memmap_root = None):
+    """
+    PixelDataProvider holding Planck, zero-theta and (if given) RHT connections open for a whole run.
+    If planck_memmap_root is given, Planck data are read from the memory-mapped arrays written by pixel_data.planck_db_to_memmap,
+    along with the derived map products written by planck_memmap_to_derived if they are there and up to date
+    """
+    if region == "allsky":
+        rht_tablename = "RHT_weights_allsky"
+    else:
+        rht_tablename = "RHT_weights"
+    
+    if planck_memmap_root is None:
+        return pixel_data.PixelDataProvider(rht_cursor = rht_cursor, rht_tablename = rht_tablename)
+    else:
+        return pixel_data.MemmapPixelDataProvider(planck_memmap_root, rht_cursor = rht_cursor, rht_tablename = rht_tablename)
+
+def planck_memmap_to_derived(planck_memmap_root = "", planck_derived_root = None, chunksize = 1000000, overwrite = False):
+    """
+    One vectorized pass over the memory-mapped Planck arrays (pixel_data.planck_db_to_memmap), writing the derived map products
+    of get_planck_derived_quantities (sigma_p^2, pmeas, psimeas, SNR, ellipticity, inverse covariance, adaptive p0 grid bounds)
+    as one .npy array each under planck_derived_root (default planck_memmap_root). Pixels missing from the Planck data are NaN.
+    MemmapPixelDataProvider adds them to every block, so posterior runs read grid bounds and inverse covariances instead of recomputing them.
+    Existing products newer than the Planck arrays are kept unless overwrite is True.
+    """
+    if planck_derived_root is None:
+        planck_derived_root = planck_memmap_root
+    
+    if pixel_data.have_planck_derived(planck_memmap_root, planck_derived_root) and (overwrite is False):
+        print("Derived Planck maps in {} are up to date".format(planck_derived_root))
+        return
+    
+    planck = [np.load(pixel_data.planck_memmap_fn(planck_memmap_root, name), mmap_mode = "r") for name in ["T", "Q", "U", "QQ", "QU", "UU"]]
+    Npix = len(planck[0])
+    
+    # Written under temporary names and renamed when complete, so an interrupted pass never leaves products that look up to date
+    derived_fns = {}
+    derived = {}
+    for name in pixel_data.planck_derived_columns:
+        derived_fns[name] = pixel_data.planck_derived_fn(planck_derived_root, name)
+        derived[name] = np.lib.format.open_memmap(derived_fns[name] + ".tmp", mode = "w+", dtype = np.float_, shape = (Npix,))
+    
+    update_progress(0.0)
+    for start in xrange(0, Npix, chunksize):
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            chunk = get_planck_derived_quantities(*[np.asarray(column[start:start+chunksize]) for column in planck])
+        for name in pixel_data.planck_derived_columns:
+            derived[name][start:start+chunksize] = chunk[name]
+        
+        update_progress(min(start+chunksize, Npix)/Npix, message='Deriving: ', final_message='Finished Deriving: ')
+    
+    for name in pixel_data.planck_derived_columns:
+        derived[name].flush()
+        del derived[name]
+        os.rename(derived_fns[name] + ".tmp", derived_fns[name])
+
+def iter_pixel_blocks(all_ids, data_provider, batchsize = 256, rht = True, prior_store = None, extend_block = None, prefetch_threads = 0, prefetch_mb = 256):
+    """
+    (start, batch_ids, block) for every batchsize slice of all_ids, with blocks from data_provider.get_pixel_data.
+    With a prior_store, blocks also hold its normed_prior and zero_theta, and found covers them.
+    Every id must be in the prior_store (see pixel_data.PriorStore.check_ids).
+    extend_block : if not None, extend_block(provider, batch_ids, block) adds further data to each block as it is read,
+                   and narrows block["found"] to the pixels that have it
+    prefetch_threads : if > 0, blocks are read ahead on this many threads while the caller computes on the current one
+                       (pixel_data.BlockPrefetcher), with at most about prefetch_mb MB of blocks waiting. Each reader opens
+                       its own connections to data_provider's databases (PixelDataProvider.reopen).
+    """
+    def get_fetch(provider):
+        def fetch(batch_ids):
+            block = provider.get_pixel_data(batch_ids, rht = rht)
+            if prior_store is not None:
+                block["normed_prior"], block["zero_theta"], found_prior = prior_store.get_priors(batch_ids)
+                block["found"] &= found_prior
+            if extend_block is not None:
+                extend_block(provider, batch_ids, block)
+            return block
+        return fetch
+    
+    id_batches = [np.array([_id[0] for _id in all_ids[start:start+batchsize]]) for start in xrange(0, len(all_ids), batchsize)]
+    if prior_store is not None:
+        prior_store.check_ids([_id[0] for _id in all_ids])
+    if prefetch_threads > 0:
+        fetchers = [get_fetch(data_provider.reopen()) for i in xrange(prefetch_threads)]
+        blocks = pixel_data.BlockPrefetcher(fetchers, id_batches, max_bytes = prefetch_mb*1024**2)
+    else:
+        fetch = get_fetch(data_provider)
+        blocks = ((batch_ids, fetch(batch_ids)) for batch_ids in id_batches)
+    
+    for i, (batch_ids, block) in enumerate(blocks):
+        yield i*batchsize, batch_ids, block
+
+def sample_pixel_blocks(all_ids, data_provider, estimate_block, batchsize = 256, rht = True, prior_store = None, extend_block = None, quarantine = None,
+                        outputs = ("pMB", "psiMB"), shape = (), fill = 0.0, prefetch_threads = 0, prefetch_mb = 256):
+    """
+    Block loop shared by the block samplers. Blocks come from iter_pixel_blocks (with its rht, prior_store, extend_block and
+    prefetch_threads, prefetch_mb). Pixels that are not found are reported, and appended to quarantine if it is a list.
+    estimate_block(batch_ids, block, found) returns a dictionary of estimates for the found pixels of a block, each an array
+    with those pixels along its last axis.
+    outputs : estimates allocated before the first block, so they exist even if no pixel is found. Others are allocated
+              when first returned. Each is shape + (len(all_ids),), and fill where there is no estimate.
+    Returns the dictionary of estimates for all_ids.
+    """
+    def new_output():
+        output = np.zeros(shape + (len(all_ids),))
+        output[...] = fill
+        return output
+    results = dict((name, new_output()) for name in outputs)
+
+    update_progress(0.0)
+    for start, batch_ids, block in iter_pixel_blocks(all_ids, data_provider, batchsize = batchsize, rht = rht, prior_store = prior_store, extend_block = extend_block,
+                                                     prefetch_threads = prefetch_threads, prefetch_mb = prefetch_mb):
+        found = block["found"]
+        for _id in batch_ids[~found]:
+            print("Index {} not found".format(_id))
+            if quarantine is not None:
+                quarantine.append(int(_id))
+
+        if np.any(found):
+            indx = start + np.nonzero(found)[0]
+            for name, values in estimate_block(batch_ids, block, found).items():
+                if name not in results:
+                    results[name] = new_output()
+                results[name][..., indx] = values
+
+        update_progress(min(start+batchsize, len(all_ids))/len(all_ids), message='Sampling: ', final_message='Finished Sampling: ')
+
+    return results
+
+def get_rht_prior_config(rht_cursor, rht_tablename, gausssmooth_prior = False, deltafuncprior = False, baseprioramp = 1E-8, reverse_RHT = True, wlen = 75):
+    """
+    Everything that determines the RHT priors, as a dictionary. Precomputed priors are stored under a hash of it.
+    The RHT database is identified by its path, size and modification time, so a rewritten database gets a new store.
+    """
+    rht_db_fn = rht_cursor.execute("PRAGMA database_list").fetchone()[2]
+    rht_db_stat = os.stat(rht_db_fn)
+    
+    return {"useprior": "RHTPrior", "rht_db": os.path.abspath(rht_db_fn), "rht_db_size": rht_db_stat.st_size, "rht_db_mtime": rht_db_stat.st_mtime, 
+            "rht_tablename": rht_tablename, "gausssmooth_prior": gausssmooth_prior, "deltafuncprior": deltafuncprior, "baseprioramp": baseprioramp, 
+            "reverse_RHT": reverse_RHT, "wlen": wlen}
+
+def precompute_rht_priors(all_ids, prior_store_root = "", rht_cursor = None, region = "SC_241", gausssmooth_prior = False, deltafuncprior = False, baseprioramp = 1E-8, 
+                          reverse_RHT = True, blocksize = 4096, data_provider = None, dtype = np.float32, overwrite = False):
+    """
+    Prior stage: build the RHT prior of every pixel in all_ids once (smoothing, baseprioramp, roll, normalization over psi0)
+    and store them under prior_store_root, keyed by the prior configuration and the set of ids. Pixels without RHT or zero-theta
+    data are stored as NaN. Existing stores for the same configuration and ids are reused unless overwrite is True.
+    Returns the store directory, to be opened with pixel_data.PriorStore.
+    """
+    if data_provider is None:
+        if rht_cursor is None:
+            print("Loading default rht_cursor by region because it was not provided")
+            rht_cursor, tablename = get_rht_cursor(region = region)
+        data_provider = get_data_provider(rht_cursor = rht_cursor, region = region)
+    
+    config = get_rht_prior_config(data_provider.rht_cursor, data_provider.rht_tablename, gausssmooth_prior = gausssmooth_prior, deltafuncprior = deltafuncprior, 
+                                  baseprioramp = baseprioramp, reverse_RHT = reverse_RHT, wlen = data_provider.wlen)
+    all_ids = np.unique(np.asarray([_id[0] for _id in all_ids], np.int64))
+    config["ids_sha1"] = hashlib.sha1(all_ids.tobytes()).hexdigest()
+    prior_store_dir = pixel_data.prior_store_fn(prior_store_root, config)
+    
+    # config.p is written last, so its presence marks a complete store
+    if os.path.isfile(prior_store_dir + "config.p") and not overwrite:
+        print("Using precomputed priors in {}".format(prior_store_dir))
+        return prior_store_dir
+    if not os.path.isdir(prior_store_dir):
+        os.makedirs(prior_store_dir)
+    elif os.path.isfile(prior_store_dir + "config.p"):
+        os.remove(prior_store_dir + "config.p")
+    
+    # Written straight to disk, so the whole sky need not fit in memory
+    np.save(prior_store_dir + "ids.npy", all_ids)
+    all_normed_prior = np.lib.format.open_memmap(prior_store_dir + "normed_prior.npy", mode = "w+", dtype = dtype, shape = (len(all_ids), data_provider.nthets))
+    all_zero_theta = np.lib.format.open_memmap(prior_store_dir + "zero_theta.npy", mode = "w+", dtype = np.float_, shape = (len(all_ids),))
+    
+    update_progress(0.0)
+    for start in xrange(0, len(all_ids), blocksize):
+        block_ids = all_ids[start:start+blocksize]
+        zero_theta, found_zero = data_provider.get_zero_theta(block_ids)
+        rht_data, found_rht = data_provider.get_rht_weights(block_ids)
+        found = found_zero & found_rht
+        all_normed_prior[start:start+blocksize] = np.nan
+        all_zero_theta[start:start+blocksize] = np.nan
+        
+        if np.any(found):
+            sample_psi0, prior, cos2psi0, sin2psi0 = get_rht_prior_profiles(rht_data[found], zero_theta[found], reverse_RHT = reverse_RHT, gausssmooth = gausssmooth_prior, 
+                                                                            deltafuncprior = deltafuncprior, baseprioramp = baseprioramp, wlen = data_provider.wlen)
+            psi_dx = np.abs(sample_psi0[:, 1] - sample_psi0[:, 0])
+            all_normed_prior[start + np.nonzero(found)[0]] = prior/(psi_dx*np.trapz(prior, axis=1))[:, np.newaxis]
+            all_zero_theta[start + np.nonzero(found)[0]] = zero_theta[found]
+        
+        update_progress(min(start+blocksize, len(all_ids))/len(all_ids), message='Computing priors: ', final_message='Finished computing priors: ')
+    
+    all_normed_prior.flush()
+    all_zero_theta.flush()
+    pickle.dump(config, open(prior_store_dir + "config.p", "wb"))
+    
+    return prior_store_dir
+
+# Options each block sampler takes, besides the one that selects it (see get_block_sampler)
+block_sampler_options = {"analytic_p0": ["batchsize", "prior_store", "prefetch_threads"],
+                         "adaptivegrid": ["batchsize", "prior_store", "prefetch_threads"],
+                         "batched": ["batchsize", "precision", "prior_store", "fused", "fastpath", "prefetch_threads", "summary"],
+                         "ThetaRHT_batched": ["batchsize", "precision"]}
+
+def get_block_sampler(useprior = "RHTPrior", per_pixel_options = (), batchsize = None, precision = "float64", adaptivegrid = False, prior_store = None, fused = False,
+                      analytic_p0 = False, fastpath = False, prefetch_threads = 0, summary = False):
+    """
+    The block sampler selected by these options: "analytic_p0", "adaptivegrid", "batched" (BatchPosterior, or fused),
+    "ThetaRHT_batched", or None for the per-pixel samplers. Option combinations that no sampler supports raise ValueError
+    rather than some of them being ignored.
+    useprior          : "RHTPrior", "ThetaRHT", or None for the Planck likelihood alone
+    per_pixel_options : names of the options given that only the per-pixel samplers take (e.g. mcmc, sampletype = "MAP")
+    """
+    options = {"batchsize": batchsize is not None, "precision": precision != "float64", "adaptivegrid": adaptivegrid, "prior_store": prior_store is not None,
+               "fused": fused, "analytic_p0": analytic_p0, "fastpath": fastpath, "prefetch_threads": prefetch_threads > 0, "summary": summary}
+    given = sorted(name for name, value in options.items() if value)
+    if len(given) == 0:
+        return None
+    if len(per_pixel_options) > 0:
+        raise ValueError("Per-pixel sampler options ({}) cannot be combined with block sampler options ({})".format(", ".join(per_pixel_options), ", ".join(given)))
+
+    if analytic_p0 and adaptivegrid:
+        raise ValueError("analytic_p0 and adaptivegrid are alternative estimators")
+    if useprior == "ThetaRHT":
+        sampler = "ThetaRHT_batched"
+    elif analytic_p0:
+        sampler = "analytic_p0"
+    elif adaptivegrid:
+        sampler = "adaptivegrid"
+    elif useprior == "RHTPrior":
+        sampler = "batched"
+    else:
+        raise ValueError("The Planck likelihood sampler takes {} only with analytic_p0 or adaptivegrid".format(", ".join(given)))
+
+    unsupported = [name for name in given if (name != sampler) and (name not in block_sampler_options[sampler])]
+    if len(unsupported) > 0:
+        raise ValueError("{} not supported by the {} sampler".format(", ".join(unsupported), sampler))
+    if fused and (precision != "float64"):
+        raise ValueError("fused estimates are float64 only")
+    if fused and summary:
+        raise ValueError("fused estimates do not include posterior summaries")
+    if fastpath and summary:
+        raise ValueError("fast path estimates do not include posterior summaries")
+
+    return sampler
+
+def sample_all_rht_points(all_ids, adaptivep0=True, rht_cursor=None, region="SC_241", useprior="RHTPrior", gausssmooth_prior=False, tol=1E-5, sampletype="mean_bayes", verbose=False, mcmc=False, deltafuncprior=False, testpsiproj=False, testthetas=False, baseprioramp=1E-8, batchsize=None, data_provider=None, planck_memmap_root=None, quarantine=None, precision="float64", adaptivegrid=False, prior_store=None, fused=False, analytic_p0=False, fastpath=False, fastpath_snr=10.0, fastpath_concentration=0.3, fastpath_ids=None, prefetch_threads=0, prefetch_mb=256):
+    """
+    Sample pMB, psiMB (or MAP) for RHT prior + Planck likelihood posteriors of all_ids
+    quarantine   : if a list, ids of pixels whose prior could not be constructed are appended to it
+    The options below select a block sampler (see get_block_sampler), for RHT prior mean bayes estimates only, with batchsize
+    pixels at a time (256 if not given). Combinations that no block sampler supports raise ValueError.
+    batchsize    : if not None, BatchPosterior posterior grids (see sample_all_rht_points_batched)
+    precision    : "float32" for single precision log-domain posteriors. Batched path only.
+    adaptivegrid : if True, estimates come from coarse-to-fine grids refined until they change by less than tol
+    prior_store  : if not None, precomputed priors (see precompute_rht_priors)
+    fused        : if True, batched estimates skip the posterior grids (see mean_bayesian_posterior_fused). Batched path only.
+    analytic_p0  : if True, estimates integrate over p0 in closed form (see sample_all_points_analytic_p0)
+    fastpath     : if True, high signal to noise pixels with broad priors get asymptotic estimates (see sample_all_rht_points_batched).
+                   Batched path only. fastpath_ids collects their ids if a list.
+    prefetch_threads, prefetch_mb : read blocks ahead while computing (see sample_pixel_blocks)
+    """
+    per_pixel_options = [name for name, value in [("sampletype", sampletype != "mean_bayes"), ("mcmc", mcmc), ("testpsiproj", testpsiproj), ("testthetas", testthetas)] if value]
+    block_sampler = get_block_sampler(useprior = useprior, per_pixel_options = per_pixel_options, batchsize = batchsize, precision = precision, adaptivegrid = adaptivegrid,
+                                      prior_store = prior_store, fused = fused, analytic_p0 = analytic_p0, fastpath = fastpath, prefetch_threads = prefetch_threads)
+    if (block_sampler is not None) and (useprior != "RHTPrior"):
+        raise ValueError("Block samplers here are for useprior = 'RHTPrior' only (see sample_all_rht_points_ThetaRHTPrior, sample_all_planck_points)")
+
+    if block_sampler == "analytic_p0":
+        return sample_all_points_analytic_p0(all_ids, useprior=useprior, adaptivep0=adaptivep0, rht_cursor=rht_cursor, region=region, gausssmooth_prior=gausssmooth_prior, deltafuncprior=deltafuncprior,
+                                             baseprioramp=baseprioramp, batchsize=(batchsize or 256), data_provider=data_provider, planck_memmap_root=planck_memmap_root, quarantine=quarantine,
+                                             prior_store=prior_store, prefetch_threads=prefetch_threads, prefetch_mb=prefetch_mb)
+    elif block_sampler == "adaptivegrid":
+        return sample_all_points_adaptive_grid(all_ids, useprior=useprior, adaptivep0=adaptivep0, rht_cursor=rht_cursor, region=region, gausssmooth_prior=gausssmooth_prior, deltafuncprior=deltafuncprior,
+                                               baseprioramp=baseprioramp, tol=tol, blocksize=(batchsize or 256), data_provider=data_provider, planck_memmap_root=planck_memmap_root, quarantine=quarantine, verbose=verbose,
+                                               prior_store=prior_store, prefetch_threads=prefetch_threads, prefetch_mb=prefetch_mb)
+    elif block_sampler == "batched":
+        return sample_all_rht_points_batched(all_ids, adaptivep0=adaptivep0, rht_cursor=rht_cursor, region=region, gausssmooth_prior=gausssmooth_prior, deltafuncprior=deltafuncprior, baseprioramp=baseprioramp, batchsize=(batchsize or 256), data_provider=data_provider, planck_memmap_root=planck_memmap_root, quarantine=quarantine, precision=precision, 
+                                             prior_store=prior_store, fused=fused, fastpath=fastpath, fastpath_snr=fastpath_snr, fastpath_concentration=fastpath_concentration, fastpath_ids=fastpath_ids, 
+                                             prefetch_threads=prefetch_threads, prefetch_mb=prefetch_mb)
     
     all_pMB = np.zeros(len(all_ids))
     all_psiMB = np.zeros(len(all_ids))
@@ -1423,15 +2737,21 @@ def sample_all_rht_points(all_ids, adaptivep0=True, rht_cursor=None, region="SC_
     if rht_cursor is None:
         print("Loading default rht_cursor by region because it was not provided")
         rht_cursor, tablename = get_rht_cursor(region = region)
+    
+    if data_provider is None:
+        data_provider = get_data_provider(rht_cursor = rht_cursor, region = region, planck_memmap_root = planck_memmap_root)
         
     update_progress(0.0)
     for i, _id in enumerate(all_ids):
         #if _id[0] in [18691216, 306125]:#[3400757, 793551, 2447655]:
     
         if mcmc is False:
-            posterior_obj = Posterior(_id[0], adaptivep0 = adaptivep0, region = region, useprior = useprior, rht_cursor = rht_cursor, gausssmooth_prior = gausssmooth_prior, deltafuncprior = deltafuncprior, testpsiproj=testpsiproj, baseprioramp=baseprioramp)
+            posterior_obj = Posterior(_id[0], adaptivep0 = adaptivep0, region = region, useprior = useprior, rht_cursor = rht_cursor, gausssmooth_prior = gausssmooth_prior, deltafuncprior = deltafuncprior, testpsiproj=testpsiproj, baseprioramp=baseprioramp, data_provider=data_provider)
     
-            if testthetas is True:
+            if posterior_obj.quarantined:
+                if quarantine is not None:
+                    quarantine.append(_id[0])
+            elif testthetas is True:
                 all_preroll_thetaRHTs[i] = posterior_obj.prior_obj.maxrht
                 #all_preroll_thetaRHTs[i] = posterior_obj.prior_obj.unrolled_thetaRHT
                 #all_postroll_thetaRHTs[i] = posterior_obj.prior_obj.rolled_thetaRHT
@@ -1443,7 +2763,7 @@ def sample_all_rht_points(all_ids, adaptivep0=True, rht_cursor=None, region="SC_
                 elif sampletype is "MAP":
                     all_pMB[i], all_psiMB[i] = maximum_a_posteriori(posterior_obj, verbose = verbose)
         else:
-            MCMC_posterior(_id[0], rht_cursor = rht_cursor)
+            all_pMB[i], all_psiMB[i] = MCMC_posterior_vectorized(_id[0], region = region, rht_cursor = rht_cursor, adaptivep0 = adaptivep0, data_provider = data_provider)[:2]
 
         
         #print("for id {}, num {}, I get pMB {} and psiMB {}".format(_id, i, all_pMB[i], all_psiMB[i]))
@@ -1455,11 +2775,372 @@ def sample_all_rht_points(all_ids, adaptivep0=True, rht_cursor=None, region="SC_
         #return all_psi0s, all_zero_thetas
     else:
         return all_pMB, all_psiMB
+
+def sample_all_rht_points_batched(all_ids, adaptivep0=True, rht_cursor=None, region="SC_241", gausssmooth_prior=False, deltafuncprior=False, baseprioramp=1E-8, batchsize=256, data_provider=None, planck_memmap_root=None, quarantine=None, precision="float64", 
+                                  summary=False, prior_store=None, fused=False, fastpath=False, fastpath_snr=10.0, fastpath_concentration=0.3, fastpath_ids=None, 
+                                  prefetch_threads=0, prefetch_mb=256):
+    """
+    Mean Bayesian pMB, psiMB for RHT prior + Planck likelihood, evaluated batchsize pixels at a time with BatchPosterior
+    precision   : "float64", or "float32" for single precision log-domain posteriors
+    summary     : if True, return a dictionary of all posterior_summary_batch outputs instead of (pMB, psiMB)
+    fused       : if True, estimate straight from the prior and Planck data with mean_bayesian_posterior_fused (float64)
+                  instead of building BatchPosterior grids. Not with summary.
+    prior_store : if not None, a pixel_data.PriorStore (or its directory) written by precompute_rht_priors. Priors are read
+                  from it rather than built from RHT data, and gausssmooth_prior, deltafuncprior, baseprioramp are ignored.
+    fastpath    : if True, pixels with pmeas/sigma_p > fastpath_snr and prior concentration < fastpath_concentration get
+                  asymptotic estimates instead of a posterior grid (see get_fastpath_block). Not with summary.
+    fastpath_ids : if a list, ids of the fast path pixels are appended to it
+    prefetch_threads, prefetch_mb : read blocks ahead while computing (see sample_pixel_blocks)
+    """
+    get_block_sampler(batchsize = batchsize, precision = precision, prior_store = prior_store, fused = fused, fastpath = fastpath, prefetch_threads = prefetch_threads,
+                      summary = summary)
+    if isinstance(prior_store, str):
+        prior_store = pixel_data.PriorStore(prior_store)
+
+    if data_provider is None:
+        if (rht_cursor is None) and (prior_store is None):
+            print("Loading default rht_cursor by region because it was not provided")
+            rht_cursor, tablename = get_rht_cursor(region = region)
+        data_provider = get_data_provider(rht_cursor = rht_cursor, region = region, planck_memmap_root = planck_memmap_root)
+
+    def estimate_block(batch_ids, block, found):
+        pMB = np.zeros(np.sum(found))
+        psiMB = np.zeros(np.sum(found))
+        # Pixels of found left for the posterior grids (or fused estimates)
+        full = np.ones(len(pMB), np.bool_)
+
+        if fastpath:
+            fast, fast_pMB, fast_psiMB = get_fastpath_block(block, found, snr_min = fastpath_snr, concentration_max = fastpath_concentration, gausssmooth_prior = gausssmooth_prior,
+                                                            deltafuncprior = deltafuncprior, baseprioramp = baseprioramp, wlen = data_provider.wlen)
+            pMB[fast[found]] = fast_pMB
+            psiMB[fast[found]] = fast_psiMB
+            if fastpath_ids is not None:
+                fastpath_ids.extend(int(_id) for _id in batch_ids[fast])
+            full = ~fast[found]
+            found = found & ~fast
+
+        if not np.any(found):
+            return {"pMB": pMB, "psiMB": psiMB}
+        if fused:
+            pMB[full], psiMB[full] = sample_rht_block_fused(block, found, adaptivep0 = adaptivep0, gausssmooth_prior = gausssmooth_prior, deltafuncprior = deltafuncprior,
+                                                            baseprioramp = baseprioramp, wlen = data_provider.wlen)
+            return {"pMB": pMB, "psiMB": psiMB}
+
+        if prior_store is None:
+            stored_prior = None
+            rht_data = block["rht_data"][found]
+        else:
+            stored_prior = block["normed_prior"][found]
+            rht_data = None
+        posterior_obj = BatchPosterior(batch_ids[found], block["T"][found], block["Q"][found], block["U"][found], block["QQ"][found], block["QU"][found], block["UU"][found],
+                                       rht_data = rht_data, zero_theta = block["zero_theta"][found], adaptivep0 = adaptivep0, useprior = "RHTPrior",
+                                       gausssmooth_prior = gausssmooth_prior, deltafuncprior = deltafuncprior, baseprioramp = baseprioramp, wlen = data_provider.wlen,
+                                       precision = precision, normed_prior_psi0 = stored_prior, **get_batch_posterior_planck_kwargs(block, found, adaptivep0 = adaptivep0))
+        if summary:
+            return posterior_summary_batch(posterior_obj)
+        pMB[full], psiMB[full] = mean_bayesian_posterior_batch(posterior_obj)
+        return {"pMB": pMB, "psiMB": psiMB}
+
+    results = sample_pixel_blocks(all_ids, data_provider, estimate_block, batchsize = batchsize, rht = (prior_store is None), prior_store = prior_store, quarantine = quarantine,
+                                  outputs = () if summary else ("pMB", "psiMB"), prefetch_threads = prefetch_threads, prefetch_mb = prefetch_mb)
+    if summary:
+        return results
+
+    return results["pMB"], results["psiMB"]
+
+def get_block_estimator_inputs(block, found, useprior = "RHTPrior", adaptivep0 = True, gausssmooth_prior = False, deltafuncprior = False, baseprioramp = 1E-8, wlen = 75, 
+                               npsisample = 165):
+    """
+    Per-pixel quantities the separable estimators need, for the found pixels of a get_pixel_data block:
+    pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax, cos2psi0, sin2psi0 and prior along psi0.
+    useprior : "RHTPrior" (from rht_data, or a stored normed_prior if the block has one) or None (flat prior on the PlanckPosterior psi0 grid)
+    """
+    pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax = get_block_planck_quantities(block, found, adaptivep0 = adaptivep0)
+    
+    if useprior is None:
+        psi0_all = np.linspace(0, np.pi, npsisample, endpoint=False)
+        cos2psi0, sin2psi0 = [np.tile(trig, (len(pmeas), 1)) for trig in get_psi0_trig_tables(psi0_all)]
+        prior = np.ones(cos2psi0.shape)
+    elif "normed_prior" in block:
+        sample_psi0, cos2psi0, sin2psi0, rollindx = get_rolled_psi0_grids(block["zero_theta"][found], reverse_RHT = True, wlen = wlen)
+        prior = block["normed_prior"][found]
+    else:
+        sample_psi0, prior, cos2psi0, sin2psi0 = get_rht_prior_profiles(block["rht_data"][found], block["zero_theta"][found], reverse_RHT = True, gausssmooth = gausssmooth_prior, 
+                                                                        deltafuncprior = deltafuncprior, baseprioramp = baseprioramp, wlen = wlen)
+    
+    return pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax, cos2psi0, sin2psi0, prior
+
+def sample_rht_block_fused(block, found, adaptivep0 = True, gausssmooth_prior = False, deltafuncprior = False, baseprioramp = 1E-8, wlen = 75, backend = None):
+    """
+    pMB, psiMB for the found pixels of a get_pixel_data block (with rht_data, or a stored normed_prior) from mean_bayesian_posterior_fused
+    """
+    pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax, cos2psi0, sin2psi0, prior = get_block_estimator_inputs(block, found, adaptivep0 = adaptivep0, 
+                                            gausssmooth_prior = gausssmooth_prior, deltafuncprior = deltafuncprior, baseprioramp = baseprioramp, wlen = wlen)
+    sample_p0 = get_p_grids(pgridmin, pgridmax)
+    
+    return mean_bayesian_posterior_fused(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, sample_p0, cos2psi0, sin2psi0, prior, backend = backend)
+
+def get_prior_concentration(prior, cos2psi0, sin2psi0):
+    """
+    Concentration of (N, npsi) priors along psi0: the length of their mean direction in 2 psi0, from 0 for a flat prior to 1
+    for a delta function. Priors with negative values (e.g. baseprioramp = "variable") get 1, so they never count as broad.
+    """
+    norm = np.sum(prior, axis = 1)
+    concentration = np.hypot(np.sum(prior*cos2psi0, axis = 1), np.sum(prior*sin2psi0, axis = 1))/norm
+    concentration[np.min(prior, axis = 1) < 0] = 1
     
-def sample_all_planck_points(all_ids, adaptivep0 = True, planck_tqu_cursor = None, planck_cov_cursor = None, region = "SC_241", verbose = False, tol=1E-5, sampletype = "mean_bayes", testproj=False):
+    return concentration
+
+@stage_timing.timed("estimator")
+def asymptotic_posterior_estimates(pmeas, psimeas, sigmameas):
+    """
+    High signal to noise limit of pMB, psiMB under a broad prior: the debiased p (debias.asymptotic_estimator) and the naive psi
+    """
+    return debias.asymptotic_estimator(pmeas, sigmameas), psimeas
+
+@stage_timing.timed("triage")
+def get_fastpath_block(block, found, snr_min = 10.0, concentration_max = 0.3, gausssmooth_prior = False, deltafuncprior = False, baseprioramp = 1E-8, wlen = 75):
+    """
+    Triage for the found pixels of a get_pixel_data block (with rht_data, or a stored normed_prior). A pixel takes the fast path
+    if pmeas/sigma_p > snr_min and its prior concentration (get_prior_concentration) < concentration_max, i.e. the likelihood
+    is narrow and the prior nearly flat across it. Its pMB, psiMB then come from asymptotic_posterior_estimates.
+    Returns a mask like found of the fast path pixels, and their pMB, psiMB.
+    """
+    pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax, cos2psi0, sin2psi0, prior = get_block_estimator_inputs(block, found, adaptivep0 = False, 
+                                            gausssmooth_prior = gausssmooth_prior, deltafuncprior = deltafuncprior, baseprioramp = baseprioramp, wlen = wlen)
+    if "snr" in block:
+        snr = block["snr"][found]
+        sigmameas = np.sqrt(block["sigpsq"][found])
+    else:
+        pmeas, sigmameas, snr = get_pixel_snr(*[block[name][found] for name in ["T", "Q", "U", "QQ", "QU", "UU"]])
+    
+    fast = (snr > snr_min) & (get_prior_concentration(prior, cos2psi0, sin2psi0) < concentration_max)
+    fastpath = np.zeros(len(found), np.bool_)
+    fastpath[found] = fast
+    pMB, psiMB = asymptotic_posterior_estimates(pmeas[fast], psimeas[fast], sigmameas[fast])
+    
+    return fastpath, pMB, psiMB
+
+def sample_all_points_analytic_p0(all_ids, useprior="RHTPrior", adaptivep0=True, rht_cursor=None, region="SC_241", gausssmooth_prior=False, deltafuncprior=False, baseprioramp=1E-8, 
+                                  batchsize=256, data_provider=None, planck_memmap_root=None, quarantine=None, prior_store=None, prefetch_threads=0, prefetch_mb=256):
+    """
+    Mean Bayesian pMB, psiMB with the integrals over p0 done in closed form (get_likelihood_p0_integrals) and only psi0 sampled:
+    about npsi likelihood evaluations per pixel instead of npsi x np, and no discretization error from the p0 grid.
+    Valid because the RHT prior (useprior = "RHTPrior") and the flat prior (useprior = None, PlanckPosterior) are constant in p0.
+    prior_store : if not None, precomputed RHT priors (see precompute_rht_priors)
+    prefetch_threads, prefetch_mb : read blocks ahead while computing (see sample_pixel_blocks)
+    """
+    if isinstance(prior_store, str):
+        prior_store = pixel_data.PriorStore(prior_store)
+    rht = (useprior == "RHTPrior") and (prior_store is None)
+
+    if data_provider is None:
+        if rht and (rht_cursor is None):
+            print("Loading default rht_cursor by region because it was not provided")
+            rht_cursor, tablename = get_rht_cursor(region = region)
+        data_provider = get_data_provider(rht_cursor = rht_cursor, region = region, planck_memmap_root = planck_memmap_root)
+
+    if useprior != "RHTPrior":
+        prior_store = None
+
+    def estimate_block(batch_ids, block, found):
+        pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax, cos2psi0, sin2psi0, prior = get_block_estimator_inputs(block, found, useprior = useprior,
+                                                adaptivep0 = adaptivep0, gausssmooth_prior = gausssmooth_prior, deltafuncprior = deltafuncprior, baseprioramp = baseprioramp, wlen = data_provider.wlen)
+        L_int, Lp_int = get_likelihood_p0_integrals(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, pgridmin, pgridmax, cos2psi0, sin2psi0)
+
+        # The psi0 marginal is the integral over p0 itself
+        pMB, psiMB = mean_bayesian_posterior_separable(L_int, Lp_int, L_int, prior, cos2psi0, sin2psi0)
+        return {"pMB": pMB, "psiMB": psiMB}
+
+    results = sample_pixel_blocks(all_ids, data_provider, estimate_block, batchsize = batchsize, rht = rht, prior_store = prior_store, quarantine = quarantine,
+                                  prefetch_threads = prefetch_threads, prefetch_mb = prefetch_mb)
+
+    return results["pMB"], results["psiMB"]
+
+def sweep_rht_prior_configs(all_ids, prior_configs, adaptivep0=True, region="SC_241", velrangestring="-10_10", batchsize=256, data_provider=None, 
+                            planck_memmap_root=None, quarantine=None, analytic_p0=False):
+    """
+    Mean Bayesian pMB, psiMB for K RHT prior configurations, computing each pixel's likelihood once.
+    The likelihood is reduced over p0 once (get_likelihood_p0_moments); each configuration then costs only its prior along psi0.
+    analytic_p0   : if True, the likelihood is integrated over p0 in closed form instead (get_likelihood_p0_integrals)
+    prior_configs : list of dictionaries, each with any of gausssmooth_prior, deltafuncprior, baseprioramp (defaults False, False, 1E-8)
+                    and velrangestring (default velrangestring). Each velocity range's RHT table is read once per batch.
+    quarantine    : if a list, ids missing from the Planck or zero-theta data are appended to it
+    Returns (K, len(all_ids)) pMB and psiMB. Pixels missing from a configuration's RHT table are NaN there.
+    """
+    prior_configs = [dict({"gausssmooth_prior": False, "deltafuncprior": False, "baseprioramp": 1E-8, "velrangestring": velrangestring}, **config) for config in prior_configs]
+
+    if data_provider is None:
+        data_provider = get_data_provider(region = region, planck_memmap_root = planck_memmap_root)
+
+    rht_cursors = {}
+    for config in prior_configs:
+        if config["velrangestring"] not in rht_cursors:
+            rht_cursors[config["velrangestring"]] = get_rht_cursor(region = region, velrangestring = config["velrangestring"])
+
+    def add_zero_theta(provider, batch_ids, block):
+        block["zero_theta"], found_zero = provider.get_zero_theta(batch_ids)
+        block["found"] &= found_zero
+
+    def estimate_block(batch_ids, block, found):
+        batch_ids = batch_ids[found]
+        zero_theta = block["zero_theta"][found]
+        pMB = np.zeros((len(prior_configs), len(batch_ids)))
+        psiMB = np.zeros((len(prior_configs), len(batch_ids)))
+        pMB[...] = np.nan
+        psiMB[...] = np.nan
+
+        # Likelihood, once for every configuration
+        pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax = get_block_planck_quantities(block, found, adaptivep0 = adaptivep0)
+        sample_psi0, cos2psi0, sin2psi0, rollindx = get_rolled_psi0_grids(zero_theta, reverse_RHT = True, wlen = data_provider.wlen)
+        if analytic_p0:
+            L_int, Lp_int = get_likelihood_p0_integrals(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, pgridmin, pgridmax, cos2psi0, sin2psi0)
+            L_sum = L_int
+        else:
+            sample_p0 = get_p_grids(pgridmin, pgridmax)
+            L_int, Lp_int, L_sum = get_likelihood_p0_moments(pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, sample_p0, cos2psi0, sin2psi0)
+
+        # RHT data, once per velocity range
+        rht_data = {}
+        for vel, (rht_cursor, tablename) in rht_cursors.items():
+            rht_data[vel] = pixel_data.fetch_rows(rht_cursor, tablename, batch_ids, data_provider.nthets)
+
+        for k, config in enumerate(prior_configs):
+            data, found_rht = rht_data[config["velrangestring"]]
+            if not np.any(found_rht):
+                continue
+            sample_psi0, prior, cos2psi0_k, sin2psi0_k = get_rht_prior_profiles(data.T[found_rht], zero_theta[found_rht], reverse_RHT = True, gausssmooth = config["gausssmooth_prior"],
+                                                                                deltafuncprior = config["deltafuncprior"], baseprioramp = config["baseprioramp"], wlen = data_provider.wlen)
+            pMB[k, found_rht], psiMB[k, found_rht] = mean_bayesian_posterior_separable(L_int[found_rht], Lp_int[found_rht], L_sum[found_rht], prior,
+                                                                                       cos2psi0[found_rht], sin2psi0[found_rht])
+        return {"pMB": pMB, "psiMB": psiMB}
+
+    results = sample_pixel_blocks(all_ids, data_provider, estimate_block, batchsize = batchsize, rht = False, extend_block = add_zero_theta, quarantine = quarantine,
+                                  shape = (len(prior_configs),), fill = np.nan)
+
+    return results["pMB"], results["psiMB"]
+
+def sample_all_points_adaptive_grid(all_ids, useprior="RHTPrior", adaptivep0=True, rht_cursor=None, region="SC_241", gausssmooth_prior=False, deltafuncprior=False, baseprioramp=1E-8, 
+                                    tol=1E-5, blocksize=256, data_provider=None, planck_memmap_root=None, quarantine=None, verbose=False, prior_store=None, 
+                                    prefetch_threads=0, prefetch_mb=256, maxlevel=10, unconverged_ids=None):
+    """
+    Mean Bayesian pMB, psiMB from coarse-to-fine posterior grids (adaptive_mean_bayesian_posterior), refined until
+    both estimates change by less than tol. Pixel data and priors are built blocksize pixels at a time.
+    Pixels that do not reach tol within maxlevel refinements keep their finest-grid estimates and are reported;
+    if unconverged_ids is a list, their ids are appended to it.
+    useprior    : "RHTPrior", or None for the Planck likelihood alone (flat prior on the PlanckPosterior psi0 grid)
+    prior_store : if not None, RHT priors are read from this pixel_data.PriorStore (or directory), see precompute_rht_priors
+    prefetch_threads, prefetch_mb : read blocks ahead while computing (see sample_pixel_blocks)
+    """
+    if isinstance(prior_store, str):
+        prior_store = pixel_data.PriorStore(prior_store)
+
+    if data_provider is None:
+        if (rht_cursor is None) and (useprior == "RHTPrior") and (prior_store is None):
+            print("Loading default rht_cursor by region because it was not provided")
+            rht_cursor, tablename = get_rht_cursor(region = region)
+        data_provider = get_data_provider(rht_cursor = rht_cursor, region = region, planck_memmap_root = planck_memmap_root)
+    
+    if useprior != "RHTPrior":
+        psi0_all = np.linspace(0, np.pi, 165, endpoint=False)
+        cos2psi0_all, sin2psi0_all = get_psi0_trig_tables(psi0_all)
+        prior_all = np.ones(len(psi0_all))
+    
+    if useprior != "RHTPrior":
+        prior_store = None
+
+    # Grid points evaluated, over all blocks
+    nevals = [0]
+
+    def estimate_block(block_ids, block, found):
+        pmeas, psimeas, invsig_QQ, invsig_QU, invsig_UU, sigpGsq, pgridmin, pgridmax = get_block_planck_quantities(block, found, adaptivep0 = adaptivep0)
+
+        if useprior == "RHTPrior" and (prior_store is not None):
+            sample_psi0, cos2psi0, sin2psi0, rollindx = get_rolled_psi0_grids(block["zero_theta"][found], reverse_RHT = True, wlen = data_provider.wlen)
+            prior = block["normed_prior"][found]
+        elif useprior == "RHTPrior":
+            sample_psi0, prior, cos2psi0, sin2psi0 = get_rht_prior_profiles(block["rht_data"][found], block["zero_theta"][found], reverse_RHT = True, gausssmooth = gausssmooth_prior,
+                                                                            deltafuncprior = deltafuncprior, baseprioramp = baseprioramp, wlen = data_provider.wlen)
+
+        block_ids = block_ids[found]
+        pMB = np.zeros(len(block_ids))
+        psiMB = np.zeros(len(block_ids))
+        for i in xrange(len(block_ids)):
+            if useprior == "RHTPrior":
+                cos2psi0_i, sin2psi0_i, prior_i = cos2psi0[i], sin2psi0[i], prior[i]
+            else:
+                cos2psi0_i, sin2psi0_i, prior_i = cos2psi0_all, sin2psi0_all, prior_all
+
+            pMB[i], psiMB[i], pixel_nevals, converged = adaptive_mean_bayesian_posterior(pmeas[i], psimeas[i], invsig_QQ[i], invsig_QU[i], invsig_UU[i],
+                                                            sigpGsq[i], pgridmin[i], pgridmax[i], cos2psi0_i, sin2psi0_i, prior_i, tol = tol, maxlevel = maxlevel)
+            nevals[0] += pixel_nevals
+            if not converged:
+                print("Index {} not converged to tol {} after {} levels".format(block_ids[i], tol, maxlevel))
+                if unconverged_ids is not None:
+                    unconverged_ids.append(int(block_ids[i]))
+
+        return {"pMB": pMB, "psiMB": psiMB}
+
+    results = sample_pixel_blocks(all_ids, data_provider, estimate_block, batchsize = blocksize, rht = (useprior == "RHTPrior") and (prior_store is None),
+                                  prior_store = prior_store, quarantine = quarantine, prefetch_threads = prefetch_threads, prefetch_mb = prefetch_mb)
+
+    if verbose is True:
+        print("{} grid points per pixel on average".format(nevals[0]/max(len(all_ids), 1)))
+
+    return results["pMB"], results["psiMB"]
+
+def compare_precision(all_ids, adaptivep0=True, rht_cursor=None, region="SC_241", gausssmooth_prior=False, deltafuncprior=False, baseprioramp=1E-8, batchsize=256, data_provider=None):
+    """
+    Sample all_ids with float64 and with float32 log-domain BatchPosteriors, and report the maximum pMB and psiMB deviations.
+    Pixels whose float64 posterior underflows (NaN estimates) are counted and left out of the comparison.
+    """
+    if data_provider is None:
+        if rht_cursor is None:
+            rht_cursor, tablename = get_rht_cursor(region = region)
+        data_provider = get_data_provider(rht_cursor = rht_cursor, region = region)
+    
+    results = {}
+    for precision in ["float64", "float32"]:
+        time0 = time.time()
+        results[precision] = sample_all_rht_points_batched(all_ids, adaptivep0=adaptivep0, region=region, gausssmooth_prior=gausssmooth_prior, deltafuncprior=deltafuncprior, 
+                                                           baseprioramp=baseprioramp, batchsize=batchsize, data_provider=data_provider, precision=precision)
+        print("\n{} took {} sec".format(precision, time.time() - time0))
+    
+    pMB64, psiMB64 = results["float64"]
+    pMB32, psiMB32 = results["float32"]
+    ok = np.isfinite(pMB64) & np.isfinite(psiMB64)
+    
+    max_dpMB = np.max(np.abs(pMB32[ok] - pMB64[ok]))
+    max_dpsiMB = np.max(np.abs(angle_residual(psiMB32[ok], psiMB64[ok], degrees = False)))
+    
+    print("{} of {} pixels have no finite float64 estimate".format(np.sum(~ok), len(all_ids)))
+    print("max |pMB float32 - pMB float64| = {}".format(max_dpMB))
+    print("max |psiMB float32 - psiMB float64| = {} rad".format(max_dpsiMB))
+    
+    return max_dpMB, max_dpsiMB
+
+def sample_all_planck_points(all_ids, adaptivep0 = True, planck_tqu_cursor = None, planck_cov_cursor = None, region = "SC_241", verbose = False, tol=1E-5, sampletype = "mean_bayes", testproj=False, planck_memmap_root=None, data_provider=None, adaptivegrid=False, analytic_p0=False, 
+                             prefetch_threads=0, prefetch_mb=256):
     """
     Sample the Planck likelihood rather than a posterior constructed from a likelihood and prior
+    planck_tqu_cursor, planck_cov_cursor : if given (and no data_provider), Planck data are read from their databases
+    planck_memmap_root : if not None, read Planck data from memory-mapped arrays instead of the cursors
+    adaptivegrid : if True, mean bayes estimates come from coarse-to-fine grids refined until they change by less than tol
+    analytic_p0 : if True, mean bayes estimates integrate over p0 in closed form (see sample_all_points_analytic_p0)
+    prefetch_threads, prefetch_mb : with analytic_p0 or adaptivegrid, read blocks ahead while computing (see sample_pixel_blocks)
+    analytic_p0 and adaptivegrid are mean bayes only, and not with testproj; other combinations raise ValueError (see get_block_sampler).
     """
+    per_pixel_options = [name for name, value in [("sampletype", sampletype != "mean_bayes"), ("testproj", testproj)] if value]
+    block_sampler = get_block_sampler(useprior = None, per_pixel_options = per_pixel_options, adaptivegrid = adaptivegrid, analytic_p0 = analytic_p0,
+                                      prefetch_threads = prefetch_threads)
+
+    if block_sampler == "analytic_p0":
+        return sample_all_points_analytic_p0(all_ids, useprior=None, adaptivep0=adaptivep0, region=region, data_provider=data_provider, planck_memmap_root=planck_memmap_root,
+                                             prefetch_threads=prefetch_threads, prefetch_mb=prefetch_mb)
+    elif block_sampler == "adaptivegrid":
+        return sample_all_points_adaptive_grid(all_ids, useprior=None, adaptivep0=adaptivep0, region=region, tol=tol, data_provider=data_provider, planck_memmap_root=planck_memmap_root, verbose=verbose, 
+                                               prefetch_threads=prefetch_threads, prefetch_mb=prefetch_mb)
+    
     if testproj:
         all_naive_p = np.zeros(len(all_ids))
         all_naive_psi = np.zeros(len(all_ids))
@@ -1467,24 +3148,26 @@ def sample_all_planck_points(all_ids, adaptivep0 = True, planck_tqu_cursor = Non
         all_pMB = np.zeros(len(all_ids))
         all_psiMB = np.zeros(len(all_ids))
 
-    if planck_tqu_cursor is None:
-        print("Loading default planck_tqu_cursor because it was not provided")
-        planck_tqu_db = sqlite3.connect("planck_TQU_gal_2048_db.sqlite")
-        planck_tqu_cursor = planck_tqu_db.cursor()
-    
-    if planck_cov_cursor is None:
-        print("Loading default planck_cov_cursor because it was not provided")
-        planck_cov_db = sqlite3.connect("planck_cov_gal_2048_db.sqlite")
-        planck_cov_cursor = planck_cov_db.cursor()
+    if (data_provider is None) and (planck_memmap_root is None) and ((planck_tqu_cursor is not None) or (planck_cov_cursor is not None)):
+        # Read from the databases of the given cursors, on the provider's own connections
+        db_fns = {}
+        if planck_tqu_cursor is not None:
+            db_fns["planck_tqu_fn"] = pixel_data.get_db_fn(planck_tqu_cursor)
+        if planck_cov_cursor is not None:
+            db_fns["planck_cov_fn"] = pixel_data.get_db_fn(planck_cov_cursor)
+        data_provider = pixel_data.PixelDataProvider(**db_fns)
+    elif data_provider is None:
+        data_provider = get_data_provider(region = region, planck_memmap_root = planck_memmap_root)
 
     # Get p0 and psi0 sampling grids
     p0_all = np.linspace(0, 1, 165)
     psi0_all = np.linspace(0, np.pi, 165, endpoint=False) # don't count both 0 and pi
+    psi0_trig = get_psi0_trig_tables(psi0_all) # shared by all pixels
 
     update_progress(0.0)
     for i, _id in enumerate(all_ids):
         #if _id[0] in [3400757, 793551, 2447655]:
-        posterior_obj = PlanckPosterior(_id[0], planck_tqu_cursor, planck_cov_cursor, p0_all, psi0_all, adaptivep0 = adaptivep0)
+        posterior_obj = PlanckPosterior(_id[0], planck_tqu_cursor, planck_cov_cursor, p0_all, psi0_all, adaptivep0 = adaptivep0, psi0_trig = psi0_trig, data_provider = data_provider)
         #print("for id {}, p0 grid is {}".format(_id, posterior_obj.sample_p0))
         #print("for id {}, pmeas is {}, psimeas is {}, psi naive is {}".format(_id, posterior_obj.pmeas, posterior_obj.psimeas, posterior_obj.naive_psi))
         #print("for id {}, likelihood[0, 1] = {}".format(_id, posterior_obj.posterior[0, 1]))
@@ -1511,30 +3194,652 @@ def sample_all_planck_points(all_ids, adaptivep0 = True, planck_tqu_cursor = Non
     else:
         return all_pMB, all_psiMB
     
-def sample_all_rht_points_ThetaRHTPrior(all_ids, adaptivep0 = True, region = "SC_241", useprior = "ThetaRHT", local = False, tol=1E-5, smoothprior=False, sig=30, fixwidth=False):
+def sample_all_rht_points_ThetaRHTPrior(all_ids, adaptivep0 = True, region = "SC_241", useprior = "ThetaRHT", local = False, tol=1E-5, smoothprior=False, sig=30, fixwidth=False, data_provider=None, quarantine=None, 
+                                         batchsize=None, QU_QUsq_RHT_cursor=None, precision="float64"):
+    """
+    Sample pMB, psiMB for theta_RHT prior + Planck likelihood posteriors of all_ids
+    batchsize : if not None, build priors and posteriors batchsize pixels at a time (sample_all_rht_points_ThetaRHTPrior_batched)
+    precision : "float64" or "float32" (batched, with batchsize or 256)
+    """
+    block_sampler = get_block_sampler(useprior = "ThetaRHT", batchsize = batchsize, precision = precision)
+
+    # Get cursor containint Q, U, QRHT, URHT
+    if QU_QUsq_RHT_cursor is None:
+        QU_QUsq_RHT_cursor = get_rht_QU_cursors(local = local, smoothprior=smoothprior, sig=sig)
+    if data_provider is None:
+        data_provider = get_data_provider(region = region)
+
+    if block_sampler == "ThetaRHT_batched":
+        return sample_all_rht_points_ThetaRHTPrior_batched(all_ids, QU_QUsq_RHT_cursor, adaptivep0 = adaptivep0, smoothprior = smoothprior, fixwidth = fixwidth,
+                                                           batchsize = (batchsize or 256), data_provider = data_provider, quarantine = quarantine, precision = precision)
     
     all_pMB = np.zeros(len(all_ids))
     all_psiMB = np.zeros(len(all_ids))
     
-    # Get cursor containint Q, U, QRHT, URHT
-    QU_QUsq_RHT_cursor = get_rht_QU_cursors(local = local, smoothprior=smoothprior, sig=sig)
-    
     update_progress(0.0)
     for i, _id in enumerate(all_ids):
-        posterior_obj = Posterior(_id[0], adaptivep0 = adaptivep0, region = region, useprior = useprior, QU_QUsq_RHT_cursor = QU_QUsq_RHT_cursor, smoothprior=smoothprior, fixwidth=fixwidth)
-        all_pMB[i], all_psiMB[i] = mean_bayesian_posterior(posterior_obj, center = "naive", verbose = False, tol=tol)
+        posterior_obj = Posterior(_id[0], adaptivep0 = adaptivep0, region = region, useprior = useprior, QU_QUsq_RHT_cursor = QU_QUsq_RHT_cursor, smoothprior=smoothprior, fixwidth=fixwidth, data_provider=data_provider)
+        if posterior_obj.quarantined:
+            if quarantine is not None:
+                quarantine.append(_id[0])
+        else:
+            all_pMB[i], all_psiMB[i] = mean_bayesian_posterior(posterior_obj, center = "naive", verbose = False, tol=tol)
         update_progress((i+1.0)/len(all_ids), message='Sampling: ', final_message='Finished Sampling: ')
         
     return all_pMB, all_psiMB
+
+def sample_all_rht_points_ThetaRHTPrior_batched(all_ids, QU_QUsq_RHT_cursor, adaptivep0 = True, smoothprior = False, fixwidth = False, batchsize = 256, data_provider = None, quarantine = None, 
+                                                 precision = "float64"):
+    """
+    Mean Bayesian pMB, psiMB for theta_RHT prior + Planck likelihood, batchsize pixels at a time: priors from get_thetarht_priors,
+    posteriors from BatchPosterior
+    precision : "float32" for log-domain posteriors, which stay finite where a concentrated prior and a narrow likelihood underflow
+    """
+    if data_provider is None:
+        data_provider = get_data_provider()
+
+    def add_thetarht_priors(provider, batch_ids, block):
+        block["normed_prior"], found_prior = get_thetarht_priors(batch_ids, QU_QUsq_RHT_cursor, smoothprior = smoothprior, fixwidth = fixwidth)
+        block["found"] &= found_prior
+
+    def estimate_block(batch_ids, block, found):
+        posterior_obj = BatchPosterior(batch_ids[found], block["T"][found], block["Q"][found], block["U"][found], block["QQ"][found], block["QU"][found], block["UU"][found],
+                                       adaptivep0 = adaptivep0, useprior = "ThetaRHT", normed_prior_psi0 = block["normed_prior"][found], precision = precision,
+                                       **get_batch_posterior_planck_kwargs(block, found, adaptivep0 = adaptivep0))
+        pMB, psiMB = mean_bayesian_posterior_batch(posterior_obj)
+        return {"pMB": pMB, "psiMB": psiMB}
+
+    results = sample_pixel_blocks(all_ids, data_provider, estimate_block, batchsize = batchsize, rht = False, extend_block = add_thetarht_priors, quarantine = quarantine)
+
+    return results["pMB"], results["psiMB"]
+
+def get_id_chunks(all_ids, chunksize = 4096, aligned = False):
+    """
+    Split all_ids into chunks of pixels that are contiguous in NEST order.
+    Returns the order that sorts all_ids by healpix id, and (start, stop) slices into the sorted ids.
+    Chunks depend only on all_ids and chunksize (never on the number of processes), so results are reproducible.
+    aligned : if True, a chunk holds the ids in one block of chunksize healpix ids (id // chunksize), so adding or
+              removing pixels only changes the chunks they fall in
+    """
+    order = np.argsort(np.array([_id[0] for _id in all_ids], np.int64), kind = "mergesort")
+    if aligned:
+        blocks = np.array([_id[0] for _id in all_ids], np.int64)[order]//chunksize
+        edges = list(np.flatnonzero(np.diff(blocks)) + 1)
+        chunks = [(int(start), int(stop)) for start, stop in zip([0] + edges, edges + [len(all_ids)]) if stop > start]
+    else:
+        chunks = [(start, min(start + chunksize, len(all_ids))) for start in xrange(0, len(all_ids), chunksize)]
+    
+    return order, chunks
+
+# Per-process state for sample_all_points_parallel, filled in by init_parallel_worker
+parallel_state = {}
+
+def init_parallel_worker(sampler, sampler_kwargs, region, velrangestring, planck_memmap_root, sorted_ids, shared_pMB, shared_psiMB, checkpoint_dir = None, cache_dir = None):
+    """
+    Open this process's own database connections and attach the shared output arrays
+    """
+    global show_progress
+    show_progress = False
+    
+    parallel_state.clear()
+    parallel_state["sampler"] = sampler
+    parallel_state["sampler_kwargs"] = sampler_kwargs
+    parallel_state["region"] = region
+    parallel_state["sorted_ids"] = sorted_ids
+    parallel_state["pMB"] = np.frombuffer(shared_pMB, np.float_)
+    parallel_state["psiMB"] = np.frombuffer(shared_psiMB, np.float_)
+    parallel_state["checkpoint_dir"] = checkpoint_dir
+    parallel_state["cache_dir"] = cache_dir
+    parallel_state["cache_settings"] = get_cache_settings_repr(sampler, sampler_kwargs, region, velrangestring)
+    
+    rht_cursor = None
+    if sampler == "RHTPrior":
+        rht_cursor, tablename = get_rht_cursor(region = region, velrangestring = velrangestring)
+    parallel_state["rht_cursor"] = rht_cursor
+    parallel_state["data_provider"] = get_data_provider(rht_cursor = rht_cursor, region = region, planck_memmap_root = planck_memmap_root)
+    
+    QU_QUsq_RHT_cursor = None
+    if sampler == "ThetaRHT":
+        QU_QUsq_RHT_cursor = sampler_kwargs.get("QU_QUsq_RHT_cursor")
+        if QU_QUsq_RHT_cursor is None:
+            QU_QUsq_RHT_cursor = get_rht_QU_cursors(local = sampler_kwargs.get("local", False), smoothprior = sampler_kwargs.get("smoothprior", False), sig = sampler_kwargs.get("sig", 30))
+    parallel_state["QU_QUsq_RHT_cursor"] = QU_QUsq_RHT_cursor
+
+# Sampler options that change only how fast results are computed, not the results
+performance_kwargs = ["prefetch_threads", "prefetch_mb"]
+
+def get_cache_settings_repr(sampler, sampler_kwargs, region, velrangestring):
+    """
+    Stable string of the run settings. Objects passed in sampler_kwargs (prior stores, cursors) are represented by
+    their directory or type only; the data they serve are hashed per chunk. Settings that cannot change the results
+    (prefetching) are left out.
+    """
+    settings = []
+    for name, value in sorted(sampler_kwargs.items()):
+        if name in performance_kwargs:
+            continue
+        if isinstance(value, pixel_data.PriorStore):
+            value = value.prior_store_dir
+        elif not isinstance(value, (type(None), bool, int, long, float, str, unicode, tuple, list)):
+            value = type(value).__name__
+        settings.append((name, value))
+    
+    return repr((sampler, settings, region, velrangestring))
+
+def get_chunk_cache_key(chunk_ids):
+    """
+    sha1 of everything a chunk's estimates depend on: the sampler settings, the ids, and the Planck, zero-theta
+    and RHT inputs of its pixels as read by this worker.
+    """
+    sampler = parallel_state["sampler"]
+    key = hashlib.sha1(parallel_state["cache_settings"].encode("utf-8"))
+    key.update(np.ascontiguousarray(chunk_ids, np.int64).tobytes())
+    
+    block = parallel_state["data_provider"].get_pixel_data(chunk_ids, rht = (sampler == "RHTPrior"))
+    if sampler == "ThetaRHT":
+        block["QU_QUsq_RHT"], block["found_QU_QUsq_RHT"] = pixel_data.fetch_rows(parallel_state["QU_QUsq_RHT_cursor"], 
+                                                        get_thetarht_tablename(parallel_state["sampler_kwargs"].get("smoothprior", False)), chunk_ids, 4)
+    for name in sorted(block.keys()):
+        key.update(name.encode("utf-8"))
+        key.update(np.ascontiguousarray(block[name], np.float_).tobytes())
+    
+    return key.hexdigest()
+
+def chunk_cache_fn(cache_dir, key):
+    return os.path.join(cache_dir, key + ".npz")
+
+def sample_parallel_chunk(chunk):
+    """
+    Sample one chunk of NEST-sorted pixels and write pMB, psiMB into the shared output arrays.
+    With a cache_dir, a chunk whose inputs hash to a stored result is loaded instead of sampled.
+    Returns the chunk, the ids of its quarantined and fast path pixels, whether it came from the cache, and the stage timings of the chunk.
+    """
+    timing_before = stage_timing.get_stats()
+    start, stop = chunk
+    chunk_ids = [(int(_id),) for _id in parallel_state["sorted_ids"][start:stop]]
+    sampler = parallel_state["sampler"]
+    cache_dir = parallel_state["cache_dir"]
+    quarantine = []
+    fastpath_ids = []
+    cached = False
+    
+    if cache_dir is not None:
+        cache_fn = chunk_cache_fn(cache_dir, get_chunk_cache_key(parallel_state["sorted_ids"][start:stop]))
+        if os.path.isfile(cache_fn):
+            result = np.load(cache_fn)
+            cached = np.array_equal(result["ids"], parallel_state["sorted_ids"][start:stop])
+    
+    if cached:
+        chunk_pMB, chunk_psiMB = result["pMB"], result["psiMB"]
+        quarantine = [int(_id) for _id in result["quarantine"]]
+        if "fastpath" in result.files:
+            fastpath_ids = [int(_id) for _id in result["fastpath"]]
+    elif sampler == "RHTPrior":
+        chunk_pMB, chunk_psiMB = sample_all_rht_points(chunk_ids, rht_cursor = parallel_state["rht_cursor"], region = parallel_state["region"], data_provider = parallel_state["data_provider"], quarantine = quarantine, 
+                                                       fastpath_ids = fastpath_ids, **parallel_state["sampler_kwargs"])
+    elif sampler == "ThetaRHT":
+        sampler_kwargs = dict(parallel_state["sampler_kwargs"], QU_QUsq_RHT_cursor = parallel_state["QU_QUsq_RHT_cursor"])
+        chunk_pMB, chunk_psiMB = sample_all_rht_points_ThetaRHTPrior(chunk_ids, region = parallel_state["region"], data_provider = parallel_state["data_provider"], quarantine = quarantine, **sampler_kwargs)
+    elif sampler == "Planck":
+        chunk_pMB, chunk_psiMB = sample_all_planck_points(chunk_ids, region = parallel_state["region"], data_provider = parallel_state["data_provider"], **parallel_state["sampler_kwargs"])
+    
+    parallel_state["pMB"][start:stop] = chunk_pMB
+    parallel_state["psiMB"][start:stop] = chunk_psiMB
+    
+    if (cache_dir is not None) and (not cached):
+        save_chunk_results(cache_fn, parallel_state["sorted_ids"][start:stop], chunk_pMB, chunk_psiMB, quarantine, fastpath_ids)
+    if parallel_state["checkpoint_dir"] is not None:
+        save_checkpoint(parallel_state["checkpoint_dir"], chunk, parallel_state["sorted_ids"][start:stop], chunk_pMB, chunk_psiMB, quarantine, fastpath_ids, 
+                        settings = parallel_state["cache_settings"])
+    
+    return chunk, quarantine, fastpath_ids, cached, stage_timing.stats_since(timing_before)
+
+def write_parallel_chunk(output_writer, chunk, sorted_ids, shared_pMB, shared_psiMB):
+    """
+    Hand one finished chunk of the shared output arrays to a SparseMapWriter
+    """
+    start, stop = chunk
+    output_writer.write(sorted_ids[start:stop], pMB = np.frombuffer(shared_pMB, np.float_)[start:stop], psiMB = np.frombuffer(shared_psiMB, np.float_)[start:stop])
+
+def checkpoint_fn(checkpoint_dir, chunk):
+    return os.path.join(checkpoint_dir, "chunk_{:010d}_{:010d}.npz".format(chunk[0], chunk[1]))
+
+def save_checkpoint(checkpoint_dir, chunk, ids, pMB, psiMB, quarantine, fastpath_ids = (), settings = None):
+    """
+    Save one finished chunk (ids, estimator outputs, quarantined ids, fast path ids, and the hash of the settings
+    string of get_cache_settings_repr it was sampled with)
+    """
+    save_chunk_results(checkpoint_fn(checkpoint_dir, chunk), ids, pMB, psiMB, quarantine, fastpath_ids, settings = settings)
+
+def get_settings_sha1(settings):
+    return hashlib.sha1(settings.encode("utf-8")).hexdigest()
+
+def save_chunk_results(fn, ids, pMB, psiMB, quarantine, fastpath_ids = (), settings = None):
+    """
+    Written to a temporary file and renamed, so a crash mid-write never leaves a truncated file behind.
+    """
+    results = {"ids": ids, "pMB": pMB, "psiMB": psiMB, "quarantine": np.array(quarantine, np.int64), "fastpath": np.array(fastpath_ids, np.int64)}
+    if settings is not None:
+        results["settings_sha1"] = np.array(get_settings_sha1(settings))
+    
+    tmp_fn = fn + ".{}.{}.tmp".format(socket.gethostname(), os.getpid())
+    with open(tmp_fn, "wb") as f:
+        np.savez(f, **results)
+    os.rename(tmp_fn, fn)
+
+def load_checkpoints(checkpoint_dir, chunks, sorted_ids, pMB, psiMB, quarantine, fastpath_ids = None, settings = None):
+    """
+    Fill pMB, psiMB (NEST-sorted order) and the quarantine (and fastpath_ids) list from every checkpointed chunk.
+    settings : if not None, the get_cache_settings_repr string of this run. A checkpoint saved with other settings
+               (or without any) raises ValueError rather than being mixed in.
+    Returns the chunks that still need to be sampled.
+    """
+    todo = []
+    for chunk in chunks:
+        start, stop = chunk
+        fn = checkpoint_fn(checkpoint_dir, chunk)
+        if not os.path.isfile(fn):
+            todo.append(chunk)
+            continue
+            
+        checkpoint = np.load(fn)
+        if not np.array_equal(checkpoint["ids"], sorted_ids[start:stop]):
+            raise ValueError("Checkpoint {} does not match the pixels being sampled".format(fn))
+        if (settings is not None) and (("settings_sha1" not in checkpoint.files) or (str(checkpoint["settings_sha1"]) != get_settings_sha1(settings))):
+            raise ValueError("Checkpoint {} was sampled with different settings; rerun without resume to start over".format(fn))
+        pMB[start:stop] = checkpoint["pMB"]
+        psiMB[start:stop] = checkpoint["psiMB"]
+        quarantine.extend(int(_id) for _id in checkpoint["quarantine"])
+        if (fastpath_ids is not None) and ("fastpath" in checkpoint.files):
+            fastpath_ids.extend(int(_id) for _id in checkpoint["fastpath"])
+    
+    return todo
+
+def check_checkpoint_config(checkpoint_dir, run_config, resume = False):
+    """
+    Record the run configuration in checkpoint_dir. On resume, refuse to mix in checkpoints from a different configuration.
+    Without resume, the checkpoints of any earlier run are removed first, so a later resume can only find this run's chunks.
+    """
+    config_fn = os.path.join(checkpoint_dir, "run_config.p")
+    if resume and os.path.isfile(config_fn):
+        old_config = pickle.load(open(config_fn, "rb"))
+        if old_config != run_config:
+            raise ValueError("Checkpoints in {} were written with a different configuration: {}".format(checkpoint_dir, old_config))
+    elif not resume:
+        old_fns = [fn for fn in os.listdir(checkpoint_dir) if fn.startswith("chunk_") and fn.endswith(".npz")]
+        if len(old_fns) > 0:
+            print("Removing {} checkpoints of an earlier run from {}".format(len(old_fns), checkpoint_dir))
+        for fn in old_fns:
+            os.remove(os.path.join(checkpoint_dir, fn))
+    
+    pickle.dump(run_config, open(config_fn, "wb"))
+
+def sample_all_points_parallel(all_ids, sampler = "RHTPrior", nprocesses = None, chunksize = 4096, region = "SC_241", velrangestring = "-10_10", planck_memmap_root = None, sampler_kwargs = None, 
+                               checkpoint_dir = None, resume = False, quarantine = None, cache_dir = None, output_writer = None, fastpath_ids = None):
+    """
+    Sample pMB, psiMB for all_ids on nprocesses worker processes.
+    sampler         : "RHTPrior" (sample_all_rht_points), "ThetaRHT" (sample_all_rht_points_ThetaRHTPrior) or "Planck" (sample_all_planck_points)
+    nprocesses      : number of worker processes. None uses every core; 1 runs in this process.
+    chunksize       : number of NEST-contiguous pixels handed to a worker at a time
+    sampler_kwargs  : dictionary of further keyword arguments for the sampler
+    checkpoint_dir  : if not None, every finished chunk is saved here as it completes
+    resume          : skip chunks already saved in checkpoint_dir
+    quarantine      : if a list, ids of pixels whose prior could not be constructed are appended to it.
+                      With checkpoint_dir, they are also written to checkpoint_dir/quarantine.txt
+    cache_dir       : if not None, results are cached per chunk under a hash of the chunk's settings and input data, and
+                      chunks whose inputs are unchanged since an earlier run are loaded rather than resampled. Chunks are
+                      aligned to blocks of chunksize healpix ids so a changed mask only resamples the blocks it touches.
+                      The hash does not cover the estimator code itself: empty the cache after changing it.
+    output_writer   : if not None, a SparseMapWriter that every chunk's ids, pMB and psiMB are written to as it finishes
+    fastpath_ids    : if a list, ids of pixels given asymptotic estimates by the RHTPrior fastpath option are appended to it
+    Workers write straight into shared-memory arrays. Output is identical for any nprocesses.
+    Returns all_pMB, all_psiMB in the order of all_ids.
+    """
+    if sampler not in ["RHTPrior", "ThetaRHT", "Planck"]:
+        raise ValueError("sampler must be 'RHTPrior', 'ThetaRHT' or 'Planck'")
+    if sampler_kwargs is None:
+        sampler_kwargs = {}
+    if nprocesses is None:
+        nprocesses = multiprocessing.cpu_count()
+    if quarantine is None:
+        quarantine = []
+    if fastpath_ids is None:
+        fastpath_ids = []
+    
+    order, chunks = get_id_chunks(all_ids, chunksize = chunksize, aligned = cache_dir is not None)
+    sorted_ids = np.array([_id[0] for _id in all_ids], np.int64)[order]
+    
+    shared_pMB = multiprocessing.RawArray(ctypes.c_double, len(all_ids))
+    shared_psiMB = multiprocessing.RawArray(ctypes.c_double, len(all_ids))
+    
+    if checkpoint_dir is not None:
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        run_config = {"settings": get_cache_settings_repr(sampler, sampler_kwargs, region, velrangestring), "chunksize": chunksize, "nids": len(all_ids)}
+        if cache_dir is not None:
+            run_config["aligned_chunks"] = True
+        check_checkpoint_config(checkpoint_dir, run_config, resume = resume)
+        if resume:
+            chunks_done = len(chunks)
+            todo = load_checkpoints(checkpoint_dir, chunks, sorted_ids, np.frombuffer(shared_pMB, np.float_), np.frombuffer(shared_psiMB, np.float_), quarantine, fastpath_ids, 
+                                    settings = run_config["settings"])
+            if output_writer is not None:
+                for chunk in set(chunks) - set(todo):
+                    write_parallel_chunk(output_writer, chunk, sorted_ids, shared_pMB, shared_psiMB)
+            chunks = todo
+            print("Resuming: {} of {} chunks already finished".format(chunks_done - len(chunks), chunks_done))
+    if (cache_dir is not None) and (not os.path.isdir(cache_dir)):
+        os.makedirs(cache_dir)
+    
+    initargs = (sampler, sampler_kwargs, region, velrangestring, planck_memmap_root, sorted_ids, shared_pMB, shared_psiMB, checkpoint_dir, cache_dir)
+    ncached = 0
+    
+    print("Sampling {} pixels in {} chunks on {} processes".format(len(all_ids), len(chunks), nprocesses))
+    update_progress(0.0)
+    if len(chunks) == 0:
+        pass
+    elif nprocesses == 1:
+        # The per-chunk samplers run silenced; only whole chunks are reported here
+        with silence_progress():
+            init_parallel_worker(*initargs)
+        for i, chunk in enumerate(chunks):
+            with silence_progress():
+                chunk, chunk_quarantine, chunk_fastpath_ids, cached, chunk_timing = sample_parallel_chunk(chunk)
+            quarantine.extend(chunk_quarantine)
+            fastpath_ids.extend(chunk_fastpath_ids)
+            ncached += cached
+            if output_writer is not None:
+                write_parallel_chunk(output_writer, chunk, sorted_ids, shared_pMB, shared_psiMB)
+            update_progress((i+1.0)/len(chunks), message='Sampling: ', final_message='Finished Sampling: ')
+    else:
+        pool = multiprocessing.Pool(processes = nprocesses, initializer = init_parallel_worker, initargs = initargs)
+        try:
+            for i, (chunk, chunk_quarantine, chunk_fastpath_ids, cached, chunk_timing) in enumerate(pool.imap_unordered(sample_parallel_chunk, chunks)):
+                stage_timing.merge_stats(chunk_timing)
+                quarantine.extend(chunk_quarantine)
+                fastpath_ids.extend(chunk_fastpath_ids)
+                ncached += cached
+                if output_writer is not None:
+                    write_parallel_chunk(output_writer, chunk, sorted_ids, shared_pMB, shared_psiMB)
+                update_progress((i+1.0)/len(chunks), message='Sampling: ', final_message='Finished Sampling: ')
+        finally:
+            pool.terminate()
+            pool.join()
+    
+    if cache_dir is not None:
+        print("{} of {} chunks reused from {}".format(ncached, len(chunks), cache_dir))
+    quarantine.sort()
+    if len(quarantine) > 0:
+        print("{} pixels quarantined because their prior could not be constructed".format(len(quarantine)))
+    if checkpoint_dir is not None:
+        np.savetxt(os.path.join(checkpoint_dir, "quarantine.txt"), np.array(quarantine, np.int64), fmt = "%d")
+    
+    # Back from NEST-sorted order to the order of all_ids
+    all_pMB = np.zeros(len(all_ids))
+    all_psiMB = np.zeros(len(all_ids))
+    all_pMB[order] = np.frombuffer(shared_pMB, np.float_)
+    all_psiMB[order] = np.frombuffer(shared_psiMB, np.float_)
+    
+    return all_pMB, all_psiMB
+
+def claim_lease(lease_fn, lease_timeout = 3600):
+    """
+    Try to take the lease file lease_fn, by creating it exclusively (atomic on local and NFS disks).
+    A lease not renewed for lease_timeout seconds (see hold_lease) is taken over.
+    Returns the token written into the lease (host, process and a random number) if this process now holds it, else None.
+    """
+    try:
+        expired = time.time() - os.path.getmtime(lease_fn) > lease_timeout
+    except OSError:
+        expired = False
+    
+    if expired:
+        # Only one process can move the expired lease aside. If it was renewed or retaken meanwhile, put it back.
+        stale_fn = lease_fn + ".{}.{}.stale".format(socket.gethostname(), os.getpid())
+        try:
+            os.rename(lease_fn, stale_fn)
+            if time.time() - os.path.getmtime(stale_fn) <= lease_timeout:
+                try:
+                    os.link(stale_fn, lease_fn)
+                except OSError:
+                    pass
+            os.remove(stale_fn)
+        except OSError:
+            pass
+    
+    try:
+        fd = os.open(lease_fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return None
+        raise
+    token = "{} {} {:016x}\n".format(socket.gethostname(), os.getpid(), random.SystemRandom().getrandbits(64))
+    os.write(fd, token.encode("utf-8"))
+    os.close(fd)
+    
+    return token
+
+def read_lease(lease_fn):
+    """
+    Token in the lease file lease_fn, or None if there is none
+    """
+    try:
+        with open(lease_fn, "rb") as f:
+            return f.read().decode("utf-8")
+    except (IOError, OSError):
+        return None
+
+@contextlib.contextmanager
+def hold_lease(lease_fn, token, lease_timeout = 3600):
+    """
+    Renew a lease claimed with token (see claim_lease) from a background thread every lease_timeout/4 seconds while the
+    enclosed block runs, then release it. A lease taken over by another worker meanwhile is neither renewed nor released.
+    """
+    stop = threading.Event()
+    def renew():
+        while not stop.wait(lease_timeout/4):
+            if read_lease(lease_fn) != token:
+                print("Lease {} was taken over by another worker".format(lease_fn))
+                return
+            try:
+                os.utime(lease_fn, None)
+            except OSError:
+                pass
+    
+    thread = threading.Thread(target = renew)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        if read_lease(lease_fn) == token:
+            try:
+                os.remove(lease_fn)
+            except OSError:
+                pass
+
+def open_work_queue(queue_dir, all_ids, settings, chunksize = 4096, aligned = False):
+    """
+    Create the work queue in queue_dir, or join the one already there, which must hold the same pixels and settings.
+    Returns the order that sorts all_ids, the sorted ids and the chunks (see get_id_chunks).
+    """
+    if not os.path.isdir(queue_dir):
+        try:
+            os.makedirs(queue_dir)
+        except OSError:
+            if not os.path.isdir(queue_dir):
+                raise
+    
+    order, chunks = get_id_chunks(all_ids, chunksize = chunksize, aligned = aligned)
+    sorted_ids = np.array([_id[0] for _id in all_ids], np.int64)[order]
+    queue_config = {"settings": settings, "chunksize": chunksize, "aligned": aligned, "nids": len(all_ids), 
+                    "ids_sha1": hashlib.sha1(sorted_ids.tobytes()).hexdigest()}
+    
+    config_fn = os.path.join(queue_dir, "queue_config.p")
+    if not os.path.isfile(config_fn):
+        tmp_fn = config_fn + ".{}.{}.tmp".format(socket.gethostname(), os.getpid())
+        pickle.dump(queue_config, open(tmp_fn, "wb"))
+        os.rename(tmp_fn, config_fn)
+    old_config = pickle.load(open(config_fn, "rb"))
+    if old_config != queue_config:
+        raise ValueError("Work queue {} was created for different pixels or settings: {}".format(queue_dir, old_config))
+    
+    return order, sorted_ids, chunks
+
+def sample_all_points_work_queue(all_ids, queue_dir, sampler = "RHTPrior", chunksize = 4096, region = "SC_241", velrangestring = "-10_10", planck_memmap_root = None, 
+                                 sampler_kwargs = None, lease_timeout = 3600, cache_dir = None, quarantine = None, fastpath_ids = None, poll_interval = 60):
+    """
+    Work on a queue of chunksize-pixel NEST chunks shared by any number of processes, on one or many hosts, through queue_dir
+    (a directory every worker can see, e.g. on NFS). Each worker claims chunks with lease files, samples them, writes their
+    results to queue_dir (as checkpoints, see save_checkpoint) and releases the lease. Once no chunk is left to claim, it checks
+    again every poll_interval seconds until every chunk has its results.
+    A lease is renewed while its chunk is sampled; one not renewed for lease_timeout seconds (a crashed worker) is taken over by
+    the next worker to reach it. At worst a chunk is sampled twice, with identical results.
+    The first worker to find every chunk finished merges them under queue_dir/merge.lease, marks the queue merged (merge.done)
+    and returns all_pMB, all_psiMB in the order of all_ids (quarantine and fastpath_ids, if lists, collect those ids).
+    Every other worker returns None, None. Remove merge.done to merge again.
+    Every worker must be given the same all_ids and settings.
+    """
+    if sampler not in ["RHTPrior", "ThetaRHT", "Planck"]:
+        raise ValueError("sampler must be 'RHTPrior', 'ThetaRHT' or 'Planck'")
+    if sampler_kwargs is None:
+        sampler_kwargs = {}
+    if quarantine is None:
+        quarantine = []
+    if fastpath_ids is None:
+        fastpath_ids = []
+    
+    settings = get_cache_settings_repr(sampler, sampler_kwargs, region, velrangestring)
+    order, sorted_ids, chunks = open_work_queue(queue_dir, all_ids, settings, chunksize = chunksize, aligned = cache_dir is not None)
+    if (cache_dir is not None) and (not os.path.isdir(cache_dir)):
+        os.makedirs(cache_dir)
+    
+    shared_pMB = multiprocessing.RawArray(ctypes.c_double, len(all_ids))
+    shared_psiMB = multiprocessing.RawArray(ctypes.c_double, len(all_ids))
+    with silence_progress():
+        init_parallel_worker(sampler, sampler_kwargs, region, velrangestring, planck_memmap_root, sorted_ids, shared_pMB, shared_psiMB, checkpoint_dir = queue_dir, cache_dir = cache_dir)
+    
+    # Workers take chunks in different orders so they rarely contend for the same lease
+    shuffle = random.Random("{} {} {}".format(socket.gethostname(), os.getpid(), time.time())).shuffle
+    todo = [chunk for chunk in chunks if not os.path.isfile(checkpoint_fn(queue_dir, chunk))]
+    print("Worker {} on {}: {} of {} chunks left in {}".format(os.getpid(), socket.gethostname(), len(todo), len(chunks), queue_dir))
+    
+    # Passes over the unfinished chunks, until none is left. Later passes retake the leases of crashed workers once they expire.
+    nsampled = 0
+    update_progress(0.0)
+    while len(todo) > 0:
+        shuffle(todo)
+        nfinished = len(chunks) - len(todo)
+        for chunk in todo:
+            result_fn = checkpoint_fn(queue_dir, chunk)
+            token = None if os.path.isfile(result_fn) else claim_lease(result_fn + ".lease", lease_timeout)
+            if token is not None:
+                with hold_lease(result_fn + ".lease", token, lease_timeout):
+                    # Another worker may have finished it between the check and the claim
+                    if not os.path.isfile(result_fn):
+                        with silence_progress():
+                            sample_parallel_chunk(chunk)
+                        nsampled += 1
+            if os.path.isfile(result_fn):
+                nfinished += 1
+                update_progress(nfinished/len(chunks), message='Sampling: ', final_message='Finished Sampling: ')
+        
+        todo = [chunk for chunk in todo if not os.path.isfile(checkpoint_fn(queue_dir, chunk))]
+        if len(todo) > 0:
+            time.sleep(poll_interval)
+    print("Worker {} on {} sampled {} chunks".format(os.getpid(), socket.gethostname(), nsampled))
+    
+    # Merge, by one worker only
+    merge_fn = os.path.join(queue_dir, "merge.lease")
+    done_fn = os.path.join(queue_dir, "merge.done")
+    token = claim_lease(merge_fn, lease_timeout)
+    if token is None:
+        print("Another worker is merging {}".format(queue_dir))
+        return None, None
+    try:
+        if os.path.isfile(done_fn):
+            print("{} was already merged by another worker".format(queue_dir))
+            return None, None
+        
+        merged_pMB = np.zeros(len(all_ids))
+        merged_psiMB = np.zeros(len(all_ids))
+        load_checkpoints(queue_dir, chunks, sorted_ids, merged_pMB, merged_psiMB, quarantine, fastpath_ids, settings = settings)
+        quarantine.sort()
+        np.savetxt(os.path.join(queue_dir, "quarantine.txt"), np.array(quarantine, np.int64), fmt = "%d")
+        open(done_fn, "w").close()
+    finally:
+        if read_lease(merge_fn) == token:
+            os.remove(merge_fn)
+    
+    # Back from NEST-sorted order to the order of all_ids
+    all_pMB = np.zeros(len(all_ids))
+    all_psiMB = np.zeros(len(all_ids))
+    all_pMB[order] = merged_pMB
+    all_psiMB[order] = merged_psiMB
+    
+    return all_pMB, all_psiMB
     
 def fully_sample_sky(region = "allsky", limitregion = False, adaptivep0 = True, useprior = "RHTPrior", velrangestring = "-10_10", 
                      gausssmooth_prior = False, tol=1E-5, sampletype = "mean_bayes", mcmc=False, deltafuncprior=False, testpsiproj=False, 
-                     testthetas=False, save=True, baseprioramp = 1E-8, smoothprior=False, sig=30, fixwidth=False):
+                     testthetas=False, save=True, baseprioramp = 1E-8, smoothprior=False, sig=30, fixwidth=False, batchsize=None, planck_memmap_root=None,
+                     nprocesses=None, chunksize=4096, checkpoint_dir=None, resume=False, adaptivegrid=False, uncertainties=False, 
+                     prior_store_root=None, cache_dir=None, output_format="healpix", timing_fn=None, fused=False, analytic_p0=False, 
+                     fastpath=False, fastpath_snr=10.0, fastpath_concentration=0.3, prefetch_threads=0, prefetch_mb=256, queue_dir=None, lease_timeout=3600):
     """
     Sample psi_MB and p_MB from whole GALFA-HI sky
+    prior_store_root : if not None, RHT priors are precomputed once per prior configuration under this root (or reused if already there)
+                       and read by the batched and adaptive grid samplers
+    uncertainties : if True, also save MAP, sigma and credible interval maps (see posterior_summary_batch) from the same pass.
+                    Serial RHT prior mean bayes runs only; uses batchsize, or 256 if not given.
+    adaptivegrid : if True, RHT prior mean bayes estimates come from coarse-to-fine grids refined until they change by less than tol
+    batchsize : if not None, evaluate RHT and theta_RHT prior posteriors batchsize pixels at a time
+    fused : if True, RHT prior mean bayes estimates come from a single fused loop per pixel (Numba if installed, NumPy otherwise)
+            rather than from posterior grids, batchsize pixels at a time (256 if not given)
+    analytic_p0 : if True, RHT prior mean bayes estimates integrate over p0 in closed form and sample only psi0
+                  (see sample_all_points_analytic_p0)
+    fastpath : if True, RHT prior mean bayes pixels with Planck pmeas/sigma_p > fastpath_snr and prior concentration < fastpath_concentration
+               get asymptotic estimates (debiased p, naive psi) instead of a posterior grid (see get_fastpath_block). Those pixels are
+               flagged in a "fastpath" map or column (with sparse output from nprocesses, a "fastpath_ids" array).
+    prefetch_threads, prefetch_mb : RHT prior mean bayes runs read blocks ahead while computing, which hides read latency
+                                    on network disks (see sample_pixel_blocks). Uses batchsize, or 256 if not given.
+    Combinations of the sampler options above that no sampler supports raise ValueError (see get_block_sampler).
+    queue_dir : if not None, work as one of any number of independent workers (on one or many hosts) sharing this directory:
+                chunksize-pixel chunks are claimed with lease files, sampled and saved there (see sample_all_points_work_queue).
+                Start the same call on every worker; each works until all chunks are finished, then one of them writes
+                the maps and the others return without output. Not with nprocesses, checkpoint_dir or resume. A chunk whose worker has not renewed
+                its lease for lease_timeout seconds is taken over by a later worker.
+    planck_memmap_root : if not None, read Planck data from memory-mapped arrays instead of SQLite
+    nprocesses : if not None, sample chunksize-pixel NEST chunks on nprocesses worker processes
+    checkpoint_dir : if not None, save every finished chunk here (implies nprocesses = 1 if not given), 
+                     along with the ids of quarantined pixels. resume = True skips chunks already saved.
+    cache_dir : if not None, reuse per-chunk results whose input data and settings are unchanged since an earlier run
+                (implies nprocesses = 1 if not given; see sample_all_points_parallel)
+    output_format : "healpix" writes full-sky maps. "npy" writes only the sampled pixels (see SparseMapWriter), streamed chunk
+                    by chunk when sampling with nprocesses; "partialfits" also converts them to a partial-sky HEALPix FITS table.
+                    Use sparse_to_hp_map for a full-sky map from the sparse output.
+    timing_fn : JSON file for the summary of wall time per stage, throughput and peak memory (see stage_timing).
+                If None, it is written next to the output maps when save is True.
     """
+    if output_format not in ["healpix", "npy", "partialfits"]:
+        raise ValueError("output_format must be 'healpix', 'npy' or 'partialfits'")
+    if uncertainties and ((nprocesses is not None) or (checkpoint_dir is not None) or (cache_dir is not None) or (queue_dir is not None) or (useprior != "RHTPrior") or (sampletype != "mean_bayes") or mcmc or testpsiproj):
+        raise ValueError("uncertainties are only computed by the serial RHT prior mean bayes sampler")
+    if (queue_dir is not None) and ((nprocesses is not None) or (checkpoint_dir is not None) or resume):
+        raise ValueError("Work queue workers save their own chunks; queue_dir is not used with nprocesses, checkpoint_dir or resume")
+    if useprior == "ThetaRHT":
+        per_pixel_options = [name for name, value in [("sampletype", sampletype != "mean_bayes"), ("mcmc", mcmc), ("testpsiproj", testpsiproj)] if value]
+        if len(per_pixel_options) > 0:
+            raise ValueError("theta_RHT prior runs are mean bayes only, not with {}".format(", ".join(per_pixel_options)))
+        per_pixel_options = []
+    else:
+        per_pixel_options = [name for name, value in [("sampletype", sampletype != "mean_bayes"), ("mcmc", mcmc), ("testpsiproj", testpsiproj), ("testthetas", testthetas)] if value]
+    get_block_sampler(useprior = useprior, per_pixel_options = per_pixel_options, batchsize = batchsize, adaptivegrid = adaptivegrid, prior_store = prior_store_root,
+                      fused = fused, analytic_p0 = analytic_p0, fastpath = fastpath, prefetch_threads = prefetch_threads, summary = uncertainties)
     
     print("Fully sampling sky with options: region = {}, limitregion = {}, useprior = {}, velrangestring = {}, gausssmooth_prior = {}, deltafuncprior = {}, testpsiproj = {}, testthetas = {}".format(region, limitregion, useprior, velrangestring, gausssmooth_prior, deltafuncprior, testpsiproj, testthetas))
+    stage_timing.reset()
 
     out_root = "/disks/jansky/a/users/goldston/susan/Wide_maps/"
 
@@ -1551,17 +3856,16 @@ def fully_sample_sky(region = "allsky", limitregion = False, adaptivep0 = True,
     
     print("beginning creation of all posteriors")
     
-    if testthetas is False:
-        # Create and sample posteriors for all pixels
-        if useprior is "RHTPrior":
-            all_pMB, all_psiMB = sample_all_rht_points(all_ids, adaptivep0 = adaptivep0, rht_cursor = rht_cursor, region = region, useprior = useprior, gausssmooth_prior = gausssmooth_prior, tol=tol, sampletype = sampletype, mcmc = mcmc, deltafuncprior=deltafuncprior, testpsiproj=testpsiproj, baseprioramp=baseprioramp)
-        elif useprior is "ThetaRHT":
-            all_pMB, all_psiMB = sample_all_rht_points_ThetaRHTPrior(all_ids, adaptivep0 = adaptivep0, region = region, useprior = useprior, local = False, tol=tol, smoothprior=smoothprior, sig=sig, fixwidth=fixwidth)
+    prior_store = None
+    if (prior_store_root is not None) and (useprior == "RHTPrior"):
+        prior_store = precompute_rht_priors(all_ids, prior_store_root, rht_cursor = rht_cursor, region = region, gausssmooth_prior = gausssmooth_prior, 
+                                            deltafuncprior = deltafuncprior, baseprioramp = baseprioramp)
     
-        # Place into healpix map
-        hp_psiMB = make_hp_map(all_psiMB, all_ids, Nside = 2048, nest = True)
-        hp_pMB = make_hp_map(all_pMB, all_ids, Nside = 2048, nest = True)
+    all_summary = {}
+    fastpath_ids = []
     
+    if testthetas is False:
+        # Output filenames
         if limitregion is False:
             psiMB_out_fn = "psiMB_allsky_"+velrangestring+"_smoothprior_"+str(gausssmooth_prior)+"_adaptivep0_"+str(adaptivep0)+".fits"
             pMB_out_fn = "pMB_allsky_"+velrangestring+"_smoothprior_"+str(gausssmooth_prior)+"_adaptivep0_"+str(adaptivep0)+".fits"
@@ -1576,10 +3880,10 @@ def fully_sample_sky(region = "allsky", limitregion = False, adaptivep0 = True,
                     #pMB_out_fn = "pMB_DR2_SC_241_"+velrangestring+"_smoothprior_"+str(gausssmooth_prior)+"_adaptivep0_"+str(adaptivep0)+"_tol_{}.fits".format(tol)
                     #psiMB_out_fn = "psiMB_DR2_SC_241_"+velrangestring+"_smoothprior_"+str(gausssmooth_prior)+"_adaptivep0_"+str(adaptivep0)+"_deltafuncprior_"+str(deltafuncprior)+"_fixedpsi0_reverseRHT.fits"
                     #pMB_out_fn = "pMB_DR2_SC_241_"+velrangestring+"_smoothprior_"+str(gausssmooth_prior)+"_adaptivep0_"+str(adaptivep0)+"_deltafuncprior_"+str(deltafuncprior)+"_fixedpsi0_reverseRHT.fits"
-                    if useprior is "RHTPrior":
+                    if useprior == "RHTPrior":
                         psiMB_out_fn = "psiMB_DR2_SC_241_prior_"+useprior+"_"+velrangestring+"_smoothprior_"+str(gausssmooth_prior)+"_adaptivep0_"+str(adaptivep0)+"_deltafuncprior_"+str(deltafuncprior)+"_baseprioramp_"+str(baseprioramp)+".fits"
                         pMB_out_fn = "pMB_DR2_SC_241_prior_"+useprior+"_"+velrangestring+"_smoothprior_"+str(gausssmooth_prior)+"_adaptivep0_"+str(adaptivep0)+"_deltafuncprior_"+str(deltafuncprior)+"_baseprioramp_"+str(baseprioramp)+".fits"
-                    elif useprior is "ThetaRHT":
+                    elif useprior == "ThetaRHT":
                         psiMB_out_fn = "psiMB_DR2_SC_241_prior_"+useprior+"_"+velrangestring+"_smoothprior_"+str(smoothprior)+"_sig_"+str(sig)+"_adaptivep0_"+str(adaptivep0)+"_fixwidth_"+str(fixwidth)+".fits"
                         pMB_out_fn = "pMB_DR2_SC_241_prior_"+useprior+"_"+velrangestring+"_smoothprior_"+str(smoothprior)+"_sig_"+str(sig)+"_adaptivep0_"+str(adaptivep0)+"_fixwidth_"+str(fixwidth)+".fits"
             
@@ -1592,19 +3896,144 @@ def fully_sample_sky(region = "allsky", limitregion = False, adaptivep0 = True,
                 psiMB_out_fn = "psiMB_DR2_SC_241_"+velrangestring+"_smoothprior_"+str(gausssmooth_prior)+"_adaptivep0_"+str(adaptivep0)+"_deltafuncprior_"+str(deltafuncprior)+"_testpsiproj_"+str(testpsiproj)+"_smalloffset.fits"
                 pMB_out_fn = "pMB_DR2_SC_241_"+velrangestring+"_smoothprior_"+str(gausssmooth_prior)+"_adaptivep0_"+str(adaptivep0)+"_deltafuncprior_"+str(deltafuncprior)+"_testpsiproj_"+str(testpsiproj)+"_smalloffset.fits"
         
-        if save:
-            hp.fitsfunc.write_map(out_root + psiMB_out_fn, hp_psiMB, coord = "G", nest = True) 
-            hp.fitsfunc.write_map(out_root + pMB_out_fn, hp_pMB, coord = "G", nest = True) 
+        output_writer = None
+        if save and (output_format != "healpix"):
+            sparse_out_root = out_root + pMB_out_fn.replace("pMB", "sky", 1)[:-len(".fits")]
+            output_writer = SparseMapWriter(sparse_out_root)
+
+        # Create and sample posteriors for all pixels
+        if queue_dir is not None:
+            nprocesses = None
+        elif ((checkpoint_dir is not None) or (cache_dir is not None)) and (nprocesses is None):
+            nprocesses = 1
+        if (nprocesses is not None) or (queue_dir is not None):
+            if useprior == "RHTPrior":
+                sampler_kwargs = {"adaptivep0": adaptivep0, "useprior": useprior, "gausssmooth_prior": gausssmooth_prior, "tol": tol, "sampletype": sampletype, 
+                                  "mcmc": mcmc, "deltafuncprior": deltafuncprior, "testpsiproj": testpsiproj, "baseprioramp": baseprioramp, "batchsize": batchsize, 
+                                  "adaptivegrid": adaptivegrid, "prior_store": prior_store, "fused": fused, 
+                                  "analytic_p0": analytic_p0, "fastpath": fastpath, "fastpath_snr": fastpath_snr, "fastpath_concentration": fastpath_concentration, 
+                                  "prefetch_threads": prefetch_threads, "prefetch_mb": prefetch_mb}
+            elif useprior == "ThetaRHT":
+                sampler_kwargs = {"adaptivep0": adaptivep0, "useprior": useprior, "local": False, "tol": tol, "smoothprior": smoothprior, "sig": sig, "fixwidth": fixwidth, 
+                                  "batchsize": batchsize}
+            if queue_dir is not None:
+                all_pMB, all_psiMB = sample_all_points_work_queue(all_ids, queue_dir, sampler = useprior, chunksize = chunksize, region = region, velrangestring = velrangestring, 
+                                                                  planck_memmap_root = planck_memmap_root, sampler_kwargs = sampler_kwargs, lease_timeout = lease_timeout, 
+                                                                  cache_dir = cache_dir, fastpath_ids = fastpath_ids)
+                if all_pMB is None:
+                    return
+            else:
+                all_pMB, all_psiMB = sample_all_points_parallel(all_ids, sampler = useprior, nprocesses = nprocesses, chunksize = chunksize, region = region, velrangestring = velrangestring, 
+                                                                planck_memmap_root = planck_memmap_root, sampler_kwargs = sampler_kwargs, checkpoint_dir = checkpoint_dir, resume = resume, 
+                                                                cache_dir = cache_dir, output_writer = output_writer, fastpath_ids = fastpath_ids)
+        elif uncertainties:
+            all_summary = sample_all_rht_points_batched(all_ids, adaptivep0 = adaptivep0, rht_cursor = rht_cursor, region = region, gausssmooth_prior = gausssmooth_prior, deltafuncprior = deltafuncprior, 
+                                                        baseprioramp = baseprioramp, batchsize = (batchsize or 256), planck_memmap_root = planck_memmap_root, summary = True, 
+                                                        prior_store = prior_store)
+            all_pMB = all_summary.pop("pMB")
+            all_psiMB = all_summary.pop("psiMB")
+        elif useprior == "RHTPrior":
+            all_pMB, all_psiMB = sample_all_rht_points(all_ids, adaptivep0 = adaptivep0, rht_cursor = rht_cursor, region = region, useprior = useprior, gausssmooth_prior = gausssmooth_prior, tol=tol, sampletype = sampletype, mcmc = mcmc, deltafuncprior=deltafuncprior, testpsiproj=testpsiproj, baseprioramp=baseprioramp, batchsize=batchsize, planck_memmap_root=planck_memmap_root, adaptivegrid=adaptivegrid, prior_store=prior_store, fused=fused, analytic_p0=analytic_p0, 
+                                                   fastpath=fastpath, fastpath_snr=fastpath_snr, fastpath_concentration=fastpath_concentration, fastpath_ids=fastpath_ids, 
+                                                   prefetch_threads=prefetch_threads, prefetch_mb=prefetch_mb)
+        elif useprior == "ThetaRHT":
+            all_pMB, all_psiMB = sample_all_rht_points_ThetaRHTPrior(all_ids, adaptivep0 = adaptivep0, region = region, useprior = useprior, local = False, tol=tol, smoothprior=smoothprior, sig=sig, fixwidth=fixwidth, 
+                                                                     batchsize=batchsize)
+        
+        if fastpath:
+            print("{} of {} pixels took the fast path".format(len(fastpath_ids), len(all_ids)))
+            all_summary["fastpath"] = np.in1d([_id[0] for _id in all_ids], fastpath_ids).astype(np.float_)
+    
+        with stage_timing.stage("output"):
+            if output_writer is not None:
+                # The parallel sampler streams its chunks as they finish
+                if nprocesses is None:
+                    output_writer.write([_id[0] for _id in all_ids], pMB = all_pMB, psiMB = all_psiMB, **all_summary)
+                elif fastpath:
+                    np.save(sparse_map_fn(sparse_out_root, "fastpath_ids"), np.sort(np.array(fastpath_ids, np.int64)))
+                output_writer.close()
+                if output_format == "partialfits":
+                    write_partial_fits(sparse_out_root, sparse_out_root + ".fits", coord = "G")
+                print("Saved {} sampled pixels to {}".format(output_writer.nwritten, sparse_out_root))
+            elif output_format == "healpix":
+                # Place into healpix map
+                hp_psiMB = make_hp_map(all_psiMB, all_ids, Nside = 2048, nest = True)
+                hp_pMB = make_hp_map(all_pMB, all_ids, Nside = 2048, nest = True)
+                if save:
+                    hp.fitsfunc.write_map(out_root + psiMB_out_fn, hp_psiMB, coord = "G", nest = True) 
+                    hp.fitsfunc.write_map(out_root + pMB_out_fn, hp_pMB, coord = "G", nest = True) 
+                    for name, values in all_summary.items():
+                        hp.fitsfunc.write_map(out_root + pMB_out_fn.replace("pMB", name, 1), make_hp_map(values, all_ids, Nside = 2048, nest = True), coord = "G", nest = True) 
+        
+        if (timing_fn is None) and save:
+            timing_fn = out_root + pMB_out_fn.replace("pMB", "timing", 1).replace(".fits", ".json")
+        run_info = {"region": region, "limitregion": limitregion, "useprior": useprior, "velrangestring": velrangestring, "sampletype": sampletype, "mcmc": mcmc, 
+                    "batchsize": batchsize, "nprocesses": nprocesses, "chunksize": chunksize, "adaptivegrid": adaptivegrid, "planck_memmap_root": planck_memmap_root, 
+                    "prior_store_root": prior_store_root, "cache_dir": cache_dir, "output_format": output_format, 
+                    "fastpath": fastpath, "fastpath_snr": fastpath_snr, "fastpath_concentration": fastpath_concentration, "prefetch_threads": prefetch_threads, "queue_dir": queue_dir}
+        if timing_fn is not None:
+            stage_timing.write_summary(timing_fn, npix = len(all_ids), **run_info)
+        else:
+            stage_timing.print_summary(stage_timing.summary(npix = len(all_ids), **run_info))
     else:
         all_maxrhts, zzz = sample_all_rht_points(all_ids, adaptivep0 = adaptivep0, rht_cursor = rht_cursor, region = region, useprior = useprior, gausssmooth_prior = gausssmooth_prior, tol=tol, sampletype = sampletype, mcmc = mcmc, deltafuncprior=deltafuncprior, testpsiproj=testpsiproj, testthetas=testthetas)
         maxrhts = make_hp_map(all_maxrhts, all_ids, Nside = 2048, nest = True)
         hp.fitsfunc.write_map(out_root + "vel_" + velrangestring +"_maxrht.fits", maxrhts, coord = "G", nest = True)
          
     
-def fully_sample_planck_sky(region = "allsky", adaptivep0 = True, limitregion = False, local = False, verbose = False, tol=1E-5, sampletype = "mean_bayes", testproj=False):
+def fully_sample_sky_prior_sweep(prior_configs, region = "allsky", limitregion = False, adaptivep0 = True, velrangestring = "-10_10", save = True, batchsize = 256, 
+                                 planck_memmap_root = None):
+    """
+    fully_sample_sky for several RHT prior configurations at once (see sweep_rht_prior_configs): Planck data are read and
+    likelihoods computed once. Pixels are those of the velrangestring RHT table. Saves one pMB and one psiMB map per configuration.
+    """
+    print("Sweeping {} prior configurations over sky with region = {}, limitregion = {}, velrangestring = {}".format(len(prior_configs), region, limitregion, velrangestring))
+    
+    out_root = "/disks/jansky/a/users/goldston/susan/Wide_maps/"
+    
+    # Get ids of all pixels that contain RHT data
+    rht_cursor, tablename = get_rht_cursor(region = region, velrangestring = velrangestring)
+    all_ids = get_all_rht_ids(rht_cursor, tablename)
+    
+    if limitregion is True:
+        print("Loading all allsky data points that are in the SC_241 region")
+        all_ids_SC = pickle.load(open("SC_241_healpix_ids.p", "rb"))
+        all_ids = list(set(all_ids).intersection(all_ids_SC))
+    
+    all_pMB, all_psiMB = sweep_rht_prior_configs(all_ids, prior_configs, adaptivep0 = adaptivep0, region = region, velrangestring = velrangestring, batchsize = batchsize, 
+                                                 planck_memmap_root = planck_memmap_root)
+    
+    if save:
+        for k, config in enumerate(prior_configs):
+            config_string = "_".join("{}_{}".format(name, config[name]) for name in sorted(config.keys()))
+            hp.fitsfunc.write_map(out_root + "psiMB_sweep_" + region + "_" + velrangestring + "_" + config_string + "_adaptivep0_" + str(adaptivep0) + ".fits", 
+                                  make_hp_map(np.nan_to_num(all_psiMB[k]), all_ids, Nside = 2048, nest = True), coord = "G", nest = True)
+            hp.fitsfunc.write_map(out_root + "pMB_sweep_" + region + "_" + velrangestring + "_" + config_string + "_adaptivep0_" + str(adaptivep0) + ".fits", 
+                                  make_hp_map(np.nan_to_num(all_pMB[k]), all_ids, Nside = 2048, nest = True), coord = "G", nest = True)
+    
+    return all_pMB, all_psiMB
+
+def fully_sample_planck_sky(region = "allsky", adaptivep0 = True, limitregion = False, local = False, verbose = False, tol=1E-5, sampletype = "mean_bayes", testproj=False, planck_memmap_root=None, 
+                            nprocesses=None, chunksize=4096, checkpoint_dir=None, resume=False, adaptivegrid=False, cache_dir=None, timing_fn=None, analytic_p0=False, 
+                            prefetch_threads=0, prefetch_mb=256):
     """
     Sample Planck 353 GHz psi_MB and p_MB from whole GALFA-HI sky
+    adaptivegrid : if True, mean bayes estimates come from coarse-to-fine grids refined until they change by less than tol
+    analytic_p0 : if True, mean bayes estimates integrate over p0 in closed form and sample only psi0
+    prefetch_threads, prefetch_mb : with analytic_p0 or adaptivegrid, read blocks ahead while computing (see sample_pixel_blocks).
+                                    Other combinations of these options raise ValueError (see get_block_sampler).
+    planck_memmap_root : if not None, read Planck data from memory-mapped arrays instead of SQLite
+    nprocesses : if not None, sample chunksize-pixel NEST chunks on nprocesses worker processes
+    checkpoint_dir : if not None, save every finished chunk here (implies nprocesses = 1 if not given).
+                     resume = True skips chunks already saved.
+    cache_dir : if not None, reuse per-chunk results whose input data and settings are unchanged since an earlier run
+                (implies nprocesses = 1 if not given)
+    timing_fn : JSON file for the stage timing summary (see stage_timing). If None, it is written next to the output maps.
     """
+    per_pixel_options = [name for name, value in [("sampletype", sampletype != "mean_bayes"), ("testproj", testproj)] if value]
+    get_block_sampler(useprior = None, per_pixel_options = per_pixel_options, adaptivegrid = adaptivegrid, analytic_p0 = analytic_p0, prefetch_threads = prefetch_threads)
+    
+    stage_timing.reset()
     if region == "trueallsky":
         Npix = hp.pixelfunc.nside2npix(2048)
         all_ids = [(i_,) for i_ in xrange(Npix)]
@@ -1626,7 +4055,16 @@ def fully_sample_planck_sky(region = "allsky", adaptivep0 = True, limitregion =
         all_ids = list(set(all_ids).intersection(all_ids_SC))
     
     print("beginning creation of all likelihoods")
-    all_pMB, all_psiMB = sample_all_planck_points(all_ids, adaptivep0 = adaptivep0, planck_tqu_cursor = planck_tqu_cursor, planck_cov_cursor = planck_cov_cursor, region = "SC_241", verbose = verbose, tol=tol, sampletype = sampletype, testproj=testproj)
+    if ((checkpoint_dir is not None) or (cache_dir is not None)) and (nprocesses is None):
+        nprocesses = 1
+    if nprocesses is not None:
+        sampler_kwargs = {"adaptivep0": adaptivep0, "verbose": verbose, "tol": tol, "sampletype": sampletype, "testproj": testproj, "adaptivegrid": adaptivegrid, "analytic_p0": analytic_p0, 
+                          "prefetch_threads": prefetch_threads, "prefetch_mb": prefetch_mb}
+        all_pMB, all_psiMB = sample_all_points_parallel(all_ids, sampler = "Planck", nprocesses = nprocesses, chunksize = chunksize, region = "SC_241", 
+                                                        planck_memmap_root = planck_memmap_root, sampler_kwargs = sampler_kwargs, checkpoint_dir = checkpoint_dir, resume = resume, 
+                                                        cache_dir = cache_dir)
+    else:
+        all_pMB, all_psiMB = sample_all_planck_points(all_ids, adaptivep0 = adaptivep0, planck_tqu_cursor = planck_tqu_cursor, planck_cov_cursor = planck_cov_cursor, region = "SC_241", verbose = verbose, tol=tol, sampletype = sampletype, testproj=testproj, planck_memmap_root=planck_memmap_root, adaptivegrid=adaptivegrid, analytic_p0=analytic_p0, prefetch_threads=prefetch_threads, prefetch_mb=prefetch_mb)
     
     # Place into healpix map
     hp_psiMB = make_hp_map(all_psiMB, all_ids, Nside = 2048, nest = True)
@@ -1660,8 +4098,13 @@ def fully_sample_planck_sky(region = "allsky", adaptivep0 = True, limitregion =
    
     test = False
     if test is False:
-        hp.fitsfunc.write_map(out_root + psiMB_out_fn, hp_psiMB, coord = "G", nest = True) 
-        hp.fitsfunc.write_map(out_root + pMB_out_fn, hp_pMB, coord = "G", nest = True) 
+        with stage_timing.stage("output"):
+            hp.fitsfunc.write_map(out_root + psiMB_out_fn, hp_psiMB, coord = "G", nest = True) 
+            hp.fitsfunc.write_map(out_root + pMB_out_fn, hp_pMB, coord = "G", nest = True) 
+        if timing_fn is None:
+            timing_fn = out_root + pMB_out_fn.replace("pMB", "timing", 1).replace(".fits", ".json")
+        stage_timing.write_summary(timing_fn, npix = len(all_ids), region = region, limitregion = limitregion, sampletype = sampletype, nprocesses = nprocesses, 
+                                   chunksize = chunksize, adaptivegrid = adaptivegrid, planck_memmap_root = planck_memmap_root, cache_dir = cache_dir)
 
     
 def gauss_sample_sky(region = "allsky", useprior = "ThetaRHT"):
@@ -1717,19 +4160,17 @@ def gauss_sample_region(region = "SC_241", useprior = "ThetaRHT", local = True):
     hp.fitsfunc.write_map(out_root + "psiMB_SC_241_thetaRHT_test0.fits", hp_psiMB, coord = "C", nest = True) 
     hp.fitsfunc.write_map(out_root + "pMB_SC_241_thetaRHT_test0.fits", hp_pMB, coord = "C", nest = True) 
 
-def map_all_sig_p(limitregion=False, region="allsky"):
+def map_all_sig_p(limitregion=False, region="allsky", planck_memmap_root=None, batchsize=100000):
     """
     Get all sigpGsq values in map
+    planck_memmap_root : if not None, read Planck data from memory-mapped arrays instead of SQLite
     """
     
     # Get ids of all pixels that contain RHT data
     rht_cursor, tablename = get_rht_cursor(region = region)
     all_ids = get_all_rht_ids(rht_cursor, tablename)
     
-    planck_tqu_db = sqlite3.connect("planck_TQU_gal_2048_db.sqlite")
-    planck_tqu_cursor = planck_tqu_db.cursor()
-    planck_cov_db = sqlite3.connect("planck_cov_gal_2048_db.sqlite")
-    planck_cov_cursor = planck_cov_db.cursor()
+    data_provider = get_data_provider(region = region, planck_memmap_root = planck_memmap_root)
     
     if limitregion is True:
         print("Loading all allsky data points that are in the SC_241 region")
@@ -1739,26 +4180,12 @@ def map_all_sig_p(limitregion=False, region="allsky"):
         
     all_sigpGsq = np.zeros(len(all_ids))
 
+    # sigpGsq = sqrt(det(sigma_p)) = sigma_p,G^2, a block of pixels at a time (read from the derived map products if there are any)
     update_progress(0.0)
-    for i, hp_index in enumerate(all_ids):
-        #likelihood = Likelihood(_id[0], planck_tqu_cursor, planck_cov_cursor, p0_all, psi0_all, adaptivep0 = adaptivep0)
-        (hp_index, T, Q, U) = planck_tqu_cursor.execute("SELECT * FROM Planck_Nside_2048_TQU_Galactic WHERE id = ?", hp_index).fetchone()
-        (hp_index, TT, TQ, TU, TQa, QQ, QU, TUa, QUa, UU) = planck_cov_cursor.execute("SELECT * FROM Planck_Nside_2048_cov_Galactic WHERE id = ?", (hp_index,)).fetchone()
+    for start, batch_ids, block in iter_pixel_blocks(all_ids, data_provider, batchsize = batchsize, rht = False):
+        all_sigpGsq[start:start+batchsize] = get_block_planck_quantities(block, adaptivep0 = False)[5]
         
-        # sigma_p as defined in arxiv:1407.0178v1 Eqn 3.
-        sigma_p = np.zeros((2, 2), np.float_) # [sig_Q^2, sig_QU // sig_QU, UU]
-        sigma_p[0, 0] = (1.0/T**2)*QQ #QQ
-        sigma_p[0, 1] = (1.0/T**2)*QU #QU
-        sigma_p[1, 0] = (1.0/T**2)*QU #QU
-        sigma_p[1, 1] = (1.0/T**2)*UU #UU
-          
-        # det(sigma_p) = sigma_p,G^4
-        det_sigma_p = np.linalg.det(sigma_p)
-        sigpGsq = np.sqrt(det_sigma_p)
-        
-        all_sigpGsq[i] = sigpGsq
-        
-        update_progress((i+1.0)/len(all_ids), message='Calculating: ', final_message='Finished Calculating: ')
+        update_progress(min(start+batchsize, len(all_ids))/len(all_ids), message='Calculating: ', final_message='Finished Calculating: ')
     
     # Place into healpix map
     hp_sigpGsq = make_hp_map(all_sigpGsq, all_ids, Nside = 2048, nest = True)
@@ -1769,6 +4196,7 @@ def map_all_sig_p(limitregion=False, region="allsky"):
     else:
         hp.fitsfunc.write_map(out_root + "planck_sigpGsq_DR2sky.fits", hp_sigpGsq, coord = "G", nest = True) 
     
+@stage_timing.timed("output")
 def make_hp_map(data, hp_indices, Nside = 2048, nest = True):
     """
     Places data into array of healpix pixels by healpix index.
@@ -1785,6 +4213,105 @@ def make_hp_map(data, hp_indices, Nside = 2048, nest = True):
     
     return map_data
 
+class SparseMapWriter():
+    """
+    Streams per-pixel results for part of the sky to disk as they are computed, instead of holding full-sky maps.
+    Records are appended to out_fn_root + "_<column>.partial" files; close() sorts them by healpix id and writes
+    out_fn_root + "_ids.npy" plus one out_fn_root + "_<column>.npy" per column.
+    """
+    
+    def __init__(self, out_fn_root, columns = None):
+        
+        self.out_fn_root = out_fn_root
+        self.columns = columns
+        self.streams = {}
+        self.nwritten = 0
+        
+    def stream_fn(self, name):
+        return self.out_fn_root + "_" + name + ".partial"
+    
+    @stage_timing.timed("output")
+    def write(self, ids, **values):
+        """
+        Append records for ids. values holds one array per column, in the order of ids.
+        Columns are fixed by the first write if not given.
+        """
+        if self.columns is None:
+            self.columns = sorted(values.keys())
+        if len(self.streams) == 0:
+            for name in ["ids"] + list(self.columns):
+                self.streams[name] = open(self.stream_fn(name), "wb")
+        
+        self.streams["ids"].write(np.asarray(ids, np.int64).tobytes())
+        for name in self.columns:
+            self.streams[name].write(np.asarray(values[name], np.float_).tobytes())
+        self.nwritten += len(ids)
+    
+    @stage_timing.timed("output")
+    def close(self):
+        """
+        Sort the streamed records by healpix id and write them out as .npy files
+        """
+        if len(self.streams) == 0:
+            self.write([], **dict((name, []) for name in (self.columns or [])))
+        for f in self.streams.values():
+            f.close()
+        
+        ids = np.fromfile(self.stream_fn("ids"), np.int64)
+        order = np.argsort(ids, kind = "mergesort")
+        if np.any(np.diff(ids[order]) == 0):
+            raise ValueError("Pixels were written to {} more than once".format(self.out_fn_root))
+        np.save(self.out_fn_root + "_ids.npy", ids[order])
+        for name in self.columns:
+            np.save(sparse_map_fn(self.out_fn_root, name), np.fromfile(self.stream_fn(name), np.float_)[order])
+        for name in self.streams.keys():
+            os.remove(self.stream_fn(name))
+
+def sparse_map_fn(out_fn_root, name):
+    return out_fn_root + "_" + name + ".npy"
+
+def load_sparse_map(out_fn_root, name):
+    """
+    (ids, values) of one column written by SparseMapWriter, memory-mapped
+    """
+    return np.load(out_fn_root + "_ids.npy", mmap_mode = "r"), np.load(sparse_map_fn(out_fn_root, name), mmap_mode = "r")
+
+def sparse_to_hp_map(out_fn_root, name, Nside = 2048, fill = 0.0):
+    """
+    Full-sky NEST map of one column written by SparseMapWriter. Unsampled pixels are set to fill
+    (0 matches make_hp_map; hp.UNSEEN masks them).
+    """
+    ids, values = load_sparse_map(out_fn_root, name)
+    map_data = np.zeros(12*Nside**2, np.float_)
+    map_data[:] = fill
+    map_data[ids] = values
+    
+    return map_data
+
+@stage_timing.timed("output")
+def write_partial_fits(out_fn_root, fits_fn, columns = None, Nside = 2048, coord = "G"):
+    """
+    Write columns written by SparseMapWriter to a partial-sky HEALPix FITS binary table (explicit PIXEL index, NEST)
+    """
+    ids = np.load(out_fn_root + "_ids.npy")
+    if columns is None:
+        columns = ["pMB", "psiMB"]
+    
+    fits_columns = [fits.Column(name = "PIXEL", format = "K", array = ids)]
+    for name in columns:
+        fits_columns.append(fits.Column(name = name, format = "D", array = np.load(sparse_map_fn(out_fn_root, name))))
+    
+    hdu = fits.BinTableHDU.from_columns(fits_columns)
+    hdu.header["PIXTYPE"] = "HEALPIX"
+    hdu.header["ORDERING"] = "NESTED"
+    hdu.header["COORDSYS"] = coord
+    hdu.header["NSIDE"] = Nside
+    hdu.header["INDXSCHM"] = "EXPLICIT"
+    hdu.header["OBJECT"] = "PARTIAL"
+    hdu.header["FIRSTPIX"] = 0
+    hdu.header["LASTPIX"] = 12*Nside**2 - 1
+    hdu.writeto(fits_fn, overwrite = True)
+
 def sampled_data_to_hp(psiMB, pMB, hp_indices, nest = True):
     """
     Write data to healpix map. Wraps make_hp_map
@@ -1811,10 +4338,29 @@ def angle_residual(ang1, ang2, degrees = True):
     
     return dang
 
+# Set to False to silence update_progress (e.g. in worker processes)
+show_progress = True
+
+@contextlib.contextmanager
+def silence_progress():
+    """
+    Silence update_progress inside the block, then restore the caller's setting
+    """
+    global show_progress
+    caller_show_progress = show_progress
+    show_progress = False
+    try:
+        yield
+    finally:
+        show_progress = caller_show_progress
+
 def update_progress(progress, message='Progress:', final_message='Finished:'):
     # Create progress meter that looks like: 
     # message + ' ' + '[' + '#'*p + ' '*(length-p) + ']' + time_message
 
+    if not show_progress:
+        return
+
     if not 0.0 <= progress <= 1.0:
         # Fast fail for values outside the allowed range
         raise ValueError('Progress value outside allowed value in update_progress') 
@@ -0,0 +1,76 @@
+from __future__ import division, print_function
+import numpy as np
+
+"""
+ Fused mean Bayesian pMB, psiMB for batches of pixels whose prior is constant in p0.
+ One loop per pixel evaluates the Planck likelihood, multiplies in the prior and accumulates the normalization
+ and the pMB/psiMB moments, without storing the (psi0, p0) grid. Compiled with Numba if it is installed;
+ bayesian_machinery.mean_bayesian_posterior_fused falls back to NumPy otherwise.
+"""
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+have_numba = numba is not None
+
+if have_numba:
+    prange = numba.prange
+else:
+    prange = range
+
+def mean_bayes_kernel(meas0, meas1, invsig_QQ, invsig_QU, invsig_UU, sample_p0, cos2psi0, sin2psi0, prior, pMB, psiMB):
+    """
+    Fill pMB, psiMB (N,) for (N,) measured p cos 2psi, p sin 2psi and inverse covariances, (N, np) p0 grids and
+    (N, npsi) cos 2psi0, sin 2psi0 and priors. Same quadrature as mean_bayesian_posterior_batch: trapezoid weights
+    in psi0 and p0 for the normalization and pMB, trapezoid weights in psi0 and a plain sum over p0 for psiMB.
+    The likelihood is scaled by its maximum on the grid, which cancels.
+    """
+    npix, npsi = prior.shape
+    nps = sample_p0.shape[1]
+
+    for n in prange(npix):
+        # smallest chi^2 on the grid
+        chi2min = np.inf
+        for i in range(npsi):
+            for j in range(nps):
+                dQ = meas0[n] - sample_p0[n, j]*cos2psi0[n, i]
+                dU = meas1[n] - sample_p0[n, j]*sin2psi0[n, i]
+                chi2 = invsig_QQ[n]*dQ*dQ + 2*invsig_QU[n]*dQ*dU + invsig_UU[n]*dU*dU
+                if chi2 < chi2min:
+                    chi2min = chi2
+
+        norm = 0.0
+        p_moment = 0.0
+        sin_moment = 0.0
+        cos_moment = 0.0
+        for i in range(npsi):
+            L_int = 0.0
+            Lp_int = 0.0
+            L_sum = 0.0
+            for j in range(nps):
+                dQ = meas0[n] - sample_p0[n, j]*cos2psi0[n, i]
+                dU = meas1[n] - sample_p0[n, j]*sin2psi0[n, i]
+                chi2 = invsig_QQ[n]*dQ*dQ + 2*invsig_QU[n]*dQ*dU + invsig_UU[n]*dU*dU
+                L = np.exp(-0.5*(chi2 - chi2min))
+                L_sum += L
+                if (j == 0) or (j == nps - 1):
+                    L = 0.5*L
+                L_int += L
+                Lp_int += L*sample_p0[n, j]
+
+            weighted_prior = prior[n, i]
+            if (i == 0) or (i == npsi - 1):
+                weighted_prior = 0.5*weighted_prior
+            norm += weighted_prior*L_int
+            p_moment += weighted_prior*Lp_int
+            sin_moment += weighted_prior*L_sum*sin2psi0[n, i]
+            cos_moment += weighted_prior*L_sum*cos2psi0[n, i]
+
+        pMB[n] = p_moment/norm
+        psiMB[n] = np.mod(0.5*np.arctan2(sin_moment/norm, cos_moment/norm), np.pi)
+
+if have_numba:
+    mean_bayes_kernel_py = mean_bayes_kernel
+    mean_bayes_kernel = numba.njit(parallel = True, cache = True)(mean_bayes_kernel)
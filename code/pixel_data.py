@@ -0,0 +1,451 @@
+from __future__ import division, print_function
+import numpy as np
+import os
+import sqlite3
+import hashlib
+import threading
+import copy
+import cPickle as pickle
+import stage_timing
+
+"""
+ Block access to per-pixel Planck and RHT data.
+ All tables and arrays are indexed by healpix id in NESTED order.
+"""
+
+# SQLite limits the number of bound parameters per statement (999 by default)
+max_sql_variables = 900
+
+planck_tqu_tablename = "Planck_Nside_2048_TQU_Galactic"
+planck_cov_tablename = "Planck_Nside_2048_cov_Galactic"
+planck_tqu_columns = ["T", "Q", "U"]
+planck_cov_columns = ["TT", "TQ", "TU", "TQa", "QQ", "QU", "TUa", "QUa", "UU"]
+
+# Planck columns stored by the memory-mapped backend. The covariance is symmetric, so TQa, TUa, QUa are not stored.
+planck_memmap_columns = ["T", "Q", "U", "TT", "TQ", "TU", "QQ", "QU", "UU"]
+planck_cov_memmap_columns = ["TT", "TQ", "TU", "TQ", "QQ", "QU", "TU", "QU", "UU"]
+
+# Map products derived from the Planck arrays (see bayesian_machinery.planck_memmap_to_derived), stored next to them
+planck_derived_columns = ["sigpsq", "pmeas", "psimeas", "snr", "ellipticity", "sigpGsq", "invsig_QQ", "invsig_QU", "invsig_UU", "pgridmin", "pgridmax"]
+
+def connect_readonly(db_fn):
+    """
+    Open an SQLite database that will only be read from
+    """
+    conn = sqlite3.connect(db_fn, check_same_thread = False)
+    conn.execute("PRAGMA query_only = ON")
+
+    return conn
+
+def get_db_fn(cursor):
+    """
+    File name of the main database a cursor reads from
+    """
+    db_fn = cursor.connection.execute("PRAGMA database_list").fetchone()[2]
+    if not db_fn:
+        raise ValueError("In-memory or temporary databases cannot be reopened")
+    
+    return db_fn
+
+def get_readonly_cursor(cursor):
+    """
+    Cursor on a new read-only connection to the database cursor reads from, leaving the caller's connection as it is.
+    In-memory and temporary databases cannot be reopened, so their cursor is used as given.
+    """
+    try:
+        return connect_readonly(get_db_fn(cursor)).cursor()
+    except ValueError:
+        return cursor
+
+@stage_timing.timed("db fetch")
+def fetch_rows(cursor, tablename, ids, ncols, columns = "*"):
+    """
+    Fetch rows for many healpix ids in as few queries as possible.
+    Contiguous id blocks use a single range query, otherwise ids are sent in IN (...) batches.
+    Returns (ncols, len(ids)) array in the order of ids (id column dropped; NaN where missing) and a boolean found mask.
+    """
+    ids = np.asarray(ids, np.int64)
+    data = np.zeros((ncols, len(ids)), np.float_)
+    data[...] = np.nan
+    found = np.zeros(len(ids), np.bool_)
+    if len(ids) == 0:
+        return data, found
+
+    if columns != "*":
+        columns = "id, " + columns
+
+    lookup = {}
+    idmin, idmax = ids.min(), ids.max()
+    if idmax - idmin + 1 == len(ids):
+        rows = cursor.execute("SELECT "+columns+" FROM "+tablename+" WHERE id BETWEEN ? AND ?", (int(idmin), int(idmax))).fetchall()
+        lookup.update((row[0], row[1:]) for row in rows)
+    else:
+        for start in xrange(0, len(ids), max_sql_variables):
+            batch = [int(_id) for _id in ids[start:start+max_sql_variables]]
+            rows = cursor.execute("SELECT "+columns+" FROM "+tablename+" WHERE id IN ("+",".join("?"*len(batch))+")", batch).fetchall()
+            lookup.update((row[0], row[1:]) for row in rows)
+
+    for i, _id in enumerate(ids):
+        row = lookup.get(int(_id))
+        if row is not None:
+            data[:, i] = [np.nan if val is None else val for val in row]
+            found[i] = True
+
+    return data, found
+
+class PixelDataProvider():
+    """
+    Holds read-only connections to the Planck, zero-theta and RHT databases open for a whole run,
+    and hands back blocks of pixel data as numpy arrays.
+    """
+
+    def __init__(self, rht_cursor = None, rht_tablename = "RHT_weights", wlen = 75, nthets = 165,
+                 planck_tqu_fn = "planck_TQU_gal_2048_db.sqlite", planck_cov_fn = "planck_cov_gal_2048_db.sqlite"):
+
+        self.wlen = wlen
+        self.nthets = nthets
+
+        self.planck_tqu_cursor = connect_readonly(planck_tqu_fn).cursor()
+        self.planck_cov_cursor = connect_readonly(planck_cov_fn).cursor()
+        self.psi0_sample_cursor = connect_readonly("theta_bin_0_wlen"+str(wlen)+"_db.sqlite").cursor()
+        self.psi0_sample_tablename = "theta_bin_0_wlen"+str(wlen)
+
+        self.rht_cursor = None if rht_cursor is None else get_readonly_cursor(rht_cursor)
+        self.rht_tablename = rht_tablename
+
+    def get_planck_tqu(self, ids):
+        """
+        T, Q, U, each of shape (len(ids),), and found mask
+        """
+        data, found = fetch_rows(self.planck_tqu_cursor, planck_tqu_tablename, ids, 3)
+
+        return data[0], data[1], data[2], found
+
+    def get_planck_cov(self, ids):
+        """
+        (9, len(ids)) covariance terms in planck_cov_columns order, and found mask
+        """
+        return fetch_rows(self.planck_cov_cursor, planck_cov_tablename, ids, 9)
+
+    @stage_timing.timed("db fetch")
+    def get_planck_tqu_pixel(self, hp_index):
+        """
+        (T, Q, U) for a single pixel
+        """
+        return self.planck_tqu_cursor.execute("SELECT T, Q, U FROM "+planck_tqu_tablename+" WHERE id = ?", (hp_index,)).fetchone()
+
+    @stage_timing.timed("db fetch")
+    def get_planck_cov_pixel(self, hp_index):
+        """
+        Covariance terms for a single pixel, in planck_cov_columns order
+        """
+        return self.planck_cov_cursor.execute("SELECT * FROM "+planck_cov_tablename+" WHERE id = ?", (hp_index,)).fetchone()[1:]
+
+    def get_zero_theta(self, ids):
+        data, found = fetch_rows(self.psi0_sample_cursor, self.psi0_sample_tablename, ids, 1, columns = "zerotheta")
+
+        return data[0], found
+
+    def get_rht_weights(self, ids):
+        """
+        (len(ids), nthets) RHT weights, and found mask
+        """
+        data, found = fetch_rows(self.rht_cursor, self.rht_tablename, ids, self.nthets)
+
+        return data.T, found
+
+    def get_pixel_data(self, ids, rht = True):
+        """
+        Everything needed to build posteriors for a block of ids, as a dictionary of arrays.
+        'found' is True where every requested table has a row for that id.
+        """
+        pixel_data = {}
+        pixel_data["T"], pixel_data["Q"], pixel_data["U"], found = self.get_planck_tqu(ids)
+        cov, found_cov = self.get_planck_cov(ids)
+        for name, col in zip(planck_cov_columns, cov):
+            pixel_data[name] = col
+        found &= found_cov
+
+        if rht:
+            pixel_data["zero_theta"], found_zero = self.get_zero_theta(ids)
+            pixel_data["rht_data"], found_rht = self.get_rht_weights(ids)
+            found &= found_zero & found_rht
+
+        pixel_data["found"] = found
+
+        return pixel_data
+
+    def reopen(self):
+        """
+        Copy of this provider with its own read-only database connections, so it can be used from another thread
+        """
+        provider = copy.copy(self)
+        for name in ["planck_tqu_cursor", "planck_cov_cursor", "psi0_sample_cursor", "rht_cursor"]:
+            cursor = getattr(self, name, None)
+            if cursor is not None:
+                setattr(provider, name, connect_readonly(get_db_fn(cursor)).cursor())
+
+        return provider
+
+def block_nbytes(block):
+    """
+    Memory held by the arrays of a block (dictionary of arrays)
+    """
+    return sum(value.nbytes for value in block.values() if hasattr(value, "nbytes"))
+
+class BlockPrefetcher():
+    """
+    Reads blocks of pixel data ahead of the caller on background threads, so reads overlap with computation.
+    fetchers holds one callable per reader thread, each mapping an array of ids to a block (dictionary of arrays);
+    readers sharing a database connection must not run at once, so give each its own provider (see PixelDataProvider.reopen).
+    Iterating gives (batch_ids, block) in the order of id_batches. Readers stop taking new batches while the blocks waiting
+    for the caller hold max_bytes or more, unless theirs is the batch the caller needs next, so at most about max_bytes
+    plus one block per reader is held. An exception in a reader is raised in the caller.
+    """
+
+    def __init__(self, fetchers, id_batches, max_bytes = 256*1024**2):
+
+        self.id_batches = id_batches
+        self.max_bytes = max_bytes
+        self.condition = threading.Condition()
+        self.blocks = {}
+        self.queued_bytes = 0
+        self.next_read = 0
+        self.next_out = 0
+        self.error = None
+        self.stopped = False
+
+        self.threads = [threading.Thread(target = self.read, args = (fetch,)) for fetch in fetchers]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def read(self, fetch):
+        while True:
+            with self.condition:
+                while (not self.stopped) and (self.next_read < len(self.id_batches)) and (self.next_read > self.next_out) and (self.queued_bytes >= self.max_bytes):
+                    self.condition.wait()
+                if self.stopped or (self.next_read >= len(self.id_batches)):
+                    return
+                i = self.next_read
+                self.next_read += 1
+
+            try:
+                block = fetch(self.id_batches[i])
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                self.blocks[i] = block
+                self.queued_bytes += block_nbytes(block)
+                self.condition.notify_all()
+
+    def __iter__(self):
+        try:
+            for i in xrange(len(self.id_batches)):
+                with self.condition:
+                    while i not in self.blocks:
+                        if self.error is not None:
+                            raise self.error
+                        self.condition.wait()
+                    block = self.blocks.pop(i)
+                    self.queued_bytes -= block_nbytes(block)
+                    self.next_out = i + 1
+                    self.condition.notify_all()
+
+                yield self.id_batches[i], block
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop the readers (after any read in progress) and drop queued blocks
+        """
+        with self.condition:
+            self.stopped = True
+            self.blocks.clear()
+            self.queued_bytes = 0
+            self.condition.notify_all()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+class MemmapPixelDataProvider(PixelDataProvider):
+    """
+    PixelDataProvider that serves Planck T, Q, U and covariance from memory-mapped .npy arrays indexed by healpix id
+    (see planck_db_to_memmap). Zero-theta and RHT weights are still read from SQLite.
+    If up to date derived map products are found under planck_derived_root (default planck_memmap_root), blocks also hold them.
+    """
+
+    def __init__(self, planck_memmap_root, rht_cursor = None, rht_tablename = "RHT_weights", wlen = 75, nthets = 165, planck_derived_root = None):
+
+        self.wlen = wlen
+        self.nthets = nthets
+
+        self.planck = {}
+        for name in planck_memmap_columns:
+            self.planck[name] = np.load(planck_memmap_fn(planck_memmap_root, name), mmap_mode = "r")
+
+        if planck_derived_root is None:
+            planck_derived_root = planck_memmap_root
+        self.have_derived = have_planck_derived(planck_memmap_root, planck_derived_root)
+        if self.have_derived:
+            for name in planck_derived_columns:
+                self.planck[name] = np.load(planck_derived_fn(planck_derived_root, name), mmap_mode = "r")
+
+        self.psi0_sample_cursor = connect_readonly("theta_bin_0_wlen"+str(wlen)+"_db.sqlite").cursor()
+        self.psi0_sample_tablename = "theta_bin_0_wlen"+str(wlen)
+
+        self.rht_cursor = None if rht_cursor is None else get_readonly_cursor(rht_cursor)
+        self.rht_tablename = rht_tablename
+
+    @stage_timing.timed("db fetch")
+    def get_planck_columns(self, ids, names):
+        """
+        List of arrays, one per column name. Contiguous id blocks are returned as views into the memory map.
+        """
+        ids = np.asarray(ids, np.int64)
+        if len(ids) > 0 and ids.max() - ids.min() + 1 == len(ids) and np.all(np.diff(ids) == 1):
+            index = slice(ids[0], ids[-1] + 1)
+        else:
+            index = ids
+
+        return [self.planck[name][index] for name in names]
+
+    def get_planck_tqu(self, ids):
+        T, Q, U = self.get_planck_columns(ids, planck_tqu_columns)
+
+        return T, Q, U, ~np.isnan(T)
+
+    def get_planck_cov(self, ids):
+        cov = self.get_planck_columns(ids, planck_cov_memmap_columns)
+
+        return cov, ~np.isnan(cov[0])
+
+    def get_pixel_data(self, ids, rht = True):
+        """
+        As PixelDataProvider.get_pixel_data, plus the derived map products (planck_derived_columns) if there are any
+        """
+        pixel_data = PixelDataProvider.get_pixel_data(self, ids, rht = rht)
+        if self.have_derived:
+            pixel_data.update(zip(planck_derived_columns, self.get_planck_columns(ids, planck_derived_columns)))
+
+        return pixel_data
+
+    @stage_timing.timed("db fetch")
+    def get_planck_tqu_pixel(self, hp_index):
+        return tuple(float(self.planck[name][hp_index]) for name in planck_tqu_columns)
+
+    @stage_timing.timed("db fetch")
+    def get_planck_cov_pixel(self, hp_index):
+        return tuple(float(self.planck[name][hp_index]) for name in planck_cov_memmap_columns)
+
+class PriorStore():
+    """
+    Normalized priors along psi0 for one prior configuration, as written by bayesian_machinery.precompute_rht_priors.
+    Arrays are memory-mapped and sorted by healpix id.
+    """
+    
+    def __init__(self, prior_store_dir):
+        
+        self.prior_store_dir = prior_store_dir
+        self.config = pickle.load(open(prior_store_dir + "config.p", "rb"))
+        self.ids = np.load(prior_store_dir + "ids.npy", mmap_mode = "r")
+        self.zero_theta = np.load(prior_store_dir + "zero_theta.npy", mmap_mode = "r")
+        self.normed_prior = np.load(prior_store_dir + "normed_prior.npy", mmap_mode = "r")
+        
+    @stage_timing.timed("db fetch")
+    def get_priors(self, ids):
+        """
+        (len(ids), ntheta) priors normalized over psi0, (len(ids),) zero thetas, and found mask. NaN where missing,
+        including pixels that had no RHT data when the store was written.
+        """
+        ids = np.asarray(ids, np.int64)
+        indx = np.clip(np.searchsorted(self.ids, ids), 0, max(len(self.ids) - 1, 0))
+        found = np.zeros(len(ids), np.bool_)
+        if len(self.ids) > 0:
+            found = (self.ids[indx] == ids) & ~np.isnan(self.zero_theta[indx])
+        
+        normed_prior = np.zeros((len(ids), self.normed_prior.shape[1]), np.float_)
+        normed_prior[...] = np.nan
+        zero_theta = np.zeros(len(ids), np.float_)
+        zero_theta[...] = np.nan
+        normed_prior[found] = self.normed_prior[indx[found]]
+        zero_theta[found] = self.zero_theta[indx[found]]
+        
+        return normed_prior, zero_theta, found
+
+    def check_ids(self, ids):
+        """
+        Raise ValueError if any of ids was not part of the store when it was written. Such pixels would otherwise look like
+        pixels without RHT data and be quarantined.
+        """
+        ids = np.asarray(ids, np.int64)
+        indx = np.clip(np.searchsorted(self.ids, ids), 0, max(len(self.ids) - 1, 0))
+        missing = np.ones(len(ids), np.bool_)
+        if len(self.ids) > 0:
+            missing = self.ids[indx] != ids
+        if np.any(missing):
+            raise ValueError("{} of {} pixels are not in the prior store {}; precompute it for these ids".format(np.sum(missing), len(ids), self.prior_store_dir))
+
+def prior_store_fn(prior_store_root, config):
+    """
+    Directory holding the priors for a prior configuration (dictionary), keyed by a hash of the configuration
+    """
+    key = hashlib.sha1(repr(sorted(config.items())).encode("utf-8")).hexdigest()[:16]
+    
+    return prior_store_root + "prior_" + str(config.get("useprior", "")) + "_" + key + "/"
+
+def planck_memmap_fn(planck_memmap_root, name):
+    return planck_memmap_root + "planck_" + name + "_gal_2048.npy"
+
+def planck_derived_fn(planck_derived_root, name):
+    return planck_derived_root + "planck_derived_" + name + "_gal_2048.npy"
+
+def have_planck_derived(planck_memmap_root, planck_derived_root = None):
+    """
+    True if every derived map product exists and is newer than all the Planck arrays it is computed from
+    """
+    if planck_derived_root is None:
+        planck_derived_root = planck_memmap_root
+
+    derived_fns = [planck_derived_fn(planck_derived_root, name) for name in planck_derived_columns]
+    if not all(os.path.isfile(fn) for fn in derived_fns):
+        return False
+    
+    planck_mtime = max(os.path.getmtime(planck_memmap_fn(planck_memmap_root, name)) for name in planck_memmap_columns)
+    
+    return min(os.path.getmtime(fn) for fn in derived_fns) >= planck_mtime
+
+def planck_db_to_memmap(planck_memmap_root = "", Nside = 2048, planck_tqu_fn = "planck_TQU_gal_2048_db.sqlite",
+                        planck_cov_fn = "planck_cov_gal_2048_db.sqlite", chunksize = 1000000):
+    """
+    Convert the Planck SQLite tables written by planck_data_to_database into one .npy array per column,
+    indexed by healpix id (NESTED). Pixels missing from the tables are NaN.
+    """
+    Npix = 12*Nside**2
+
+    memmaps = {}
+    for name in planck_memmap_columns:
+        memmaps[name] = np.lib.format.open_memmap(planck_memmap_fn(planck_memmap_root, name), mode = "w+", dtype = np.float_, shape = (Npix,))
+        memmaps[name][:] = np.nan
+
+    for db_fn, tablename, columns in [(planck_tqu_fn, planck_tqu_tablename, planck_tqu_columns),
+                                      (planck_cov_fn, planck_cov_tablename, ["TT", "TQ", "TU", "QQ", "QU", "UU"])]:
+        cursor = connect_readonly(db_fn).cursor()
+        cursor.execute("SELECT id, "+", ".join(columns)+" FROM "+tablename)
+        print("Converting {} to memory-mapped arrays".format(tablename))
+
+        rows = cursor.fetchmany(chunksize)
+        while rows:
+            rows = np.array(rows, np.float_)
+            ids = rows[:, 0].astype(np.int64)
+            for i, name in enumerate(columns):
+                memmaps[name][ids] = rows[:, i + 1]
+            rows = cursor.fetchmany(chunksize)
+
+    for name in planck_memmap_columns:
+        memmaps[name].flush()
@@ -0,0 +1,330 @@
+from __future__ import division, print_function
+import numpy as np
+import os
+import json
+import time
+import socket
+import SocketServer
+import bayesian_machinery as bm
+import pixel_data
+import stage_timing
+
+"""
+ Long-lived local server for single-pixel posterior queries, e.g. from a notebook.
+ The Planck arrays (memory-mapped, with derived map products if there are any), zero-theta and RHT databases
+ and prior stores are opened once and kept open, so a query only reads and computes one pixel.
+ Protocol: one JSON object per line in each direction, over a Unix socket or TCP on localhost.
+   {"op": "posterior", "id": hp_index, "config": {...}, "products": [...]} -> {"result": {...}, "elapsed": seconds}
+   {"op": "ping"}, {"op": "stats"}, {"op": "shutdown"} (Unix socket only)
+ Failed requests get {"error": message}.
+ Requests only choose among the velocity ranges and prior stores the server was started with; they never name files.
+ The Unix socket is created readable and writable by its owner only (0600). TCP mode is not authenticated: any local
+ user can query it, so it refuses shutdown requests and is stopped with a signal (e.g. Ctrl-C) instead.
+"""
+
+# Posterior settings a query may give in its config, with their defaults.
+# velrangestring and prior_store select among those the server was started with (prior_store by name).
+default_config = {"useprior": "RHTPrior", "adaptivep0": True, "gausssmooth_prior": False, "deltafuncprior": False, "baseprioramp": 1E-8,
+                  "npsample": 165, "npsisample": 165, "velrangestring": None, "prior_store": None}
+
+# estimators : posterior_summary_batch point estimates and uncertainties
+# planck     : T, Q, U, covariance and the derived quantities of get_planck_derived_quantities
+# prior, likelihood, posterior : (npsi,) prior along psi0, (npsi, np) likelihood and normalized posterior, with their sample_psi0 and sample_p0 grids
+query_products = ["estimators", "planck", "prior", "likelihood", "posterior"]
+grid_products = ["prior", "likelihood", "posterior"]
+
+default_socket_fn = "posterior_server.sock"
+
+class PosteriorQueryEngine():
+    """
+    Warm state for single-pixel posterior queries: one data provider, RHT cursors by velocity range and prior stores by name,
+    all opened here. Queries only choose among them, so no query opens a file and the state does not grow.
+    planck_memmap_root : if not None, read Planck data from memory-mapped arrays (see bayesian_machinery.get_data_provider)
+    velrangestrings    : velocity ranges queries may choose, besides the default velrangestring
+    prior_stores       : dictionary of name: prior store directory (see bayesian_machinery.precompute_rht_priors)
+    """
+
+    def __init__(self, region = "SC_241", velrangestring = "-10_10", planck_memmap_root = None, velrangestrings = (), prior_stores = None):
+
+        self.region = region
+        self.velrangestring = velrangestring
+        self.rht_cursors = {}
+        for vel in [velrangestring] + list(velrangestrings):
+            if vel not in self.rht_cursors:
+                self.rht_cursors[vel] = bm.get_rht_cursor(region = region, velrangestring = vel)
+        self.data_provider = bm.get_data_provider(rht_cursor = self.rht_cursors[velrangestring][0], region = region, planck_memmap_root = planck_memmap_root)
+        self.prior_stores = {}
+        if prior_stores is not None:
+            for name, prior_store_dir in prior_stores.items():
+                self.prior_stores[name] = pixel_data.PriorStore(prior_store_dir)
+
+    def get_config(self, config = None):
+        """
+        default_config updated with config. Unknown settings, velocity ranges and prior stores raise ValueError.
+        """
+        full_config = dict(default_config)
+        if config is not None:
+            unknown = sorted(set(config) - set(default_config))
+            if len(unknown) > 0:
+                raise ValueError("Unknown posterior settings: {}".format(", ".join(unknown)))
+            full_config.update(config)
+
+        if full_config["useprior"] not in ["RHTPrior", None]:
+            raise ValueError("useprior must be 'RHTPrior' or None")
+        if full_config["velrangestring"] is None:
+            full_config["velrangestring"] = self.velrangestring
+        if full_config["velrangestring"] not in self.rht_cursors:
+            raise ValueError("velrangestring must be one of {}".format(", ".join(sorted(self.rht_cursors))))
+        if (full_config["prior_store"] is not None) and (full_config["prior_store"] not in self.prior_stores):
+            raise ValueError("prior_store must be one of {}".format(", ".join(sorted(self.prior_stores)) or "none (no prior stores configured)"))
+
+        return full_config
+
+    def get_block(self, hp_index, config):
+        """
+        get_pixel_data block for one pixel, with the RHT weights of config's velocity range or the priors of its prior store
+        (config from get_config)
+        """
+        ids = np.array([hp_index], np.int64)
+        useprior = config["useprior"]
+
+        block = self.data_provider.get_pixel_data(ids, rht = False)
+        if useprior == "RHTPrior" and config["prior_store"] is not None:
+            prior_store = self.prior_stores[config["prior_store"]]
+            prior_store.check_ids(ids)
+            block["normed_prior"], block["zero_theta"], found_prior = prior_store.get_priors(ids)
+            block["found"] &= found_prior
+        elif useprior == "RHTPrior":
+            rht_cursor, tablename = self.rht_cursors[config["velrangestring"]]
+            rht_data, found_rht = pixel_data.fetch_rows(rht_cursor, tablename, ids, self.data_provider.nthets)
+            block["rht_data"] = rht_data.T
+            block["zero_theta"], found_zero = self.data_provider.get_zero_theta(ids)
+            block["found"] &= found_rht & found_zero
+
+        if not block["found"][0]:
+            raise ValueError("Index {} not found".format(hp_index))
+
+        return block
+
+    def query(self, hp_index, config = None, products = None):
+        """
+        Dictionary of the requested products (query_products, default estimators only) for pixel hp_index under config
+        (settings from default_config), as numpy arrays and floats
+        """
+        config = self.get_config(config)
+        if products is None:
+            products = ["estimators"]
+        unknown = sorted(set(products) - set(query_products))
+        if len(unknown) > 0:
+            raise ValueError("Unknown products: {}".format(", ".join(unknown)))
+
+        block = self.get_block(int(hp_index), config)
+        found = block["found"]
+        result = {}
+
+        if "planck" in products:
+            planck = [block[name][found] for name in ["T", "Q", "U", "QQ", "QU", "UU"]]
+            for name, value in zip(["T", "Q", "U", "QQ", "QU", "UU"], planck):
+                result[name] = float(value[0])
+            for name, value in bm.get_planck_derived_quantities(*planck).items():
+                result[name] = float(value[0])
+
+        if any(product in products for product in ["estimators"] + grid_products):
+            stored_prior = block["normed_prior"][found] if "normed_prior" in block else None
+            rht_data = block["rht_data"][found] if ("rht_data" in block) and (stored_prior is None) else None
+            zero_theta = block["zero_theta"][found] if "zero_theta" in block else None
+            posterior_obj = bm.BatchPosterior(np.array([hp_index]), block["T"][found], block["Q"][found], block["U"][found], block["QQ"][found], block["QU"][found],
+                                              block["UU"][found], rht_data = rht_data, zero_theta = zero_theta, adaptivep0 = config["adaptivep0"],
+                                              useprior = config["useprior"], gausssmooth_prior = config["gausssmooth_prior"], deltafuncprior = config["deltafuncprior"],
+                                              baseprioramp = config["baseprioramp"], npsample = config["npsample"], npsisample = config["npsisample"],
+                                              wlen = self.data_provider.wlen, normed_prior_psi0 = stored_prior,
+                                              **bm.get_batch_posterior_planck_kwargs(block, found, adaptivep0 = config["adaptivep0"], npsample = config["npsample"]))
+
+        if "estimators" in products:
+            with stage_timing.stage("estimator"):
+                for name, value in bm.posterior_summary_batch(posterior_obj).items():
+                    result[name] = float(value[0])
+
+        if any(product in products for product in grid_products):
+            result["sample_p0"] = posterior_obj.sample_p0[0]
+            result["sample_psi0"] = posterior_obj.sample_psi0[0]
+        if "prior" in products:
+            result["prior"] = posterior_obj.normed_prior_1d[0]
+        if "likelihood" in products:
+            result["likelihood"] = posterior_obj.planck_likelihood[0]
+        if "posterior" in products:
+            result["posterior"] = posterior_obj.normed_posterior[0]
+
+        return result
+
+def to_json(result):
+    """
+    Query result with arrays as (nested) lists, for json.dumps
+    """
+    return dict((name, value.tolist() if isinstance(value, np.ndarray) else value) for name, value in result.items())
+
+def from_json(result):
+    """
+    Query result with lists as numpy arrays
+    """
+    return dict((name, np.asarray(value, np.float_) if isinstance(value, list) else value) for name, value in result.items())
+
+class PosteriorRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Answers requests from one connection, one JSON line each, until the client closes it
+    """
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b""):
+            start_time = time.time()
+            try:
+                request = json.loads(line.decode("utf-8"))
+                response = self.server.answer(request)
+            except Exception as e:
+                request = {}
+                response = {"error": "{}: {}".format(type(e).__name__, e)}
+            response["elapsed"] = time.time() - start_time
+
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+            if self.server.stopping:
+                return
+
+class PosteriorServerMixin():
+    """
+    Request dispatch shared by the Unix socket and localhost TCP servers. Requests are answered one at a time,
+    since the SQLite connections of the engine belong to the serving thread.
+    allow_shutdown : whether clients may stop the server, only where they are authenticated (the owner-only Unix socket)
+    """
+    allow_shutdown = False
+
+    def answer(self, request):
+        op = request.get("op", "posterior")
+        if op == "posterior":
+            if "id" not in request:
+                raise ValueError("Posterior requests need an id")
+            return {"result": to_json(self.engine.query(request["id"], config = request.get("config"), products = request.get("products")))}
+        elif op == "ping":
+            return {"region": self.engine.region, "velrangestring": self.engine.velrangestring, "velrangestrings": sorted(self.engine.rht_cursors),
+                    "prior_stores": sorted(self.engine.prior_stores), "uptime": time.time() - self.start_time}
+        elif op == "stats":
+            return {"stats": stage_timing.get_stats()}
+        elif op == "shutdown":
+            if not self.allow_shutdown:
+                raise ValueError("Shutdown requests are only accepted over the Unix socket")
+            self.stopping = True
+            return {}
+        else:
+            raise ValueError("Unknown op {}".format(op))
+
+    def serve_until_shutdown(self):
+        self.start_time = time.time()
+        self.stopping = False
+        while not self.stopping:
+            self.handle_request()
+
+class UnixPosteriorServer(PosteriorServerMixin, SocketServer.UnixStreamServer):
+    allow_shutdown = True
+
+class LocalTCPPosteriorServer(PosteriorServerMixin, SocketServer.TCPServer):
+    allow_reuse_address = True
+
+def make_posterior_server(address = default_socket_fn, region = "SC_241", velrangestring = "-10_10", planck_memmap_root = None, velrangestrings = (),
+                          prior_stores = None):
+    """
+    Posterior server with a warm PosteriorQueryEngine (see there for velrangestrings and prior_stores), not yet serving.
+    address : Unix socket file name, or (host, port) for TCP, where host must be localhost or 127.0.0.1.
+              The socket file is created with mode 0600, and one left behind by a server that is no longer running is replaced.
+              TCP connections are not authenticated, so any local user can query the server.
+    """
+    if isinstance(address, tuple):
+        if address[0] not in ["localhost", "127.0.0.1"]:
+            raise ValueError("The posterior server only listens on localhost")
+        server = LocalTCPPosteriorServer(address, PosteriorRequestHandler, bind_and_activate = False)
+    else:
+        if os.path.exists(address):
+            try:
+                send_requests([{"op": "ping"}], address = address)
+            except socket.error:
+                os.remove(address)
+            else:
+                raise ValueError("A posterior server is already listening on {}".format(address))
+        server = UnixPosteriorServer(address, PosteriorRequestHandler, bind_and_activate = False)
+
+    server.engine = PosteriorQueryEngine(region = region, velrangestring = velrangestring, planck_memmap_root = planck_memmap_root,
+                                         velrangestrings = velrangestrings, prior_stores = prior_stores)
+    if isinstance(address, tuple):
+        server.server_bind()
+    else:
+        # The socket file is created by bind, so the umask decides who may connect
+        old_umask = os.umask(0o177)
+        try:
+            server.server_bind()
+        finally:
+            os.umask(old_umask)
+    server.server_activate()
+
+    return server
+
+def serve_posteriors(address = default_socket_fn, region = "SC_241", velrangestring = "-10_10", planck_memmap_root = None, velrangestrings = (),
+                     prior_stores = None):
+    """
+    Answer posterior queries on address (see make_posterior_server) until a shutdown request (Unix socket) or an interrupt
+    """
+    server = make_posterior_server(address = address, region = region, velrangestring = velrangestring, planck_memmap_root = planck_memmap_root,
+                                   velrangestrings = velrangestrings, prior_stores = prior_stores)
+    print("Serving posteriors on {}".format(address))
+    try:
+        server.serve_until_shutdown()
+    except KeyboardInterrupt:
+        print("Stopped serving posteriors on {}".format(address))
+    finally:
+        server.server_close()
+        if not isinstance(address, tuple) and os.path.exists(address):
+            os.remove(address)
+
+def send_requests(requests, address = default_socket_fn, timeout = 60):
+    """
+    Send requests (dictionaries) to a posterior server over one connection, and return its responses
+    """
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address, timeout = timeout)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+
+    try:
+        f = sock.makefile("rwb")
+        responses = []
+        for request in requests:
+            f.write((json.dumps(request) + "\n").encode("utf-8"))
+            f.flush()
+            responses.append(json.loads(f.readline().decode("utf-8")))
+        f.close()
+    finally:
+        sock.close()
+
+    return responses
+
+def query_posterior(hp_index, config = None, products = None, address = default_socket_fn, timeout = 60):
+    """
+    Products (see query_products, default estimators only) for pixel hp_index under config (settings from default_config),
+    from the posterior server on address. Arrays come back as numpy arrays. Errors on the server raise RuntimeError.
+    """
+    response = send_requests([{"op": "posterior", "id": int(hp_index), "config": config, "products": products}], address = address, timeout = timeout)[0]
+    if "error" in response:
+        raise RuntimeError(response["error"])
+
+    return from_json(response["result"])
+
+def shutdown_posterior_server(address = default_socket_fn):
+    """
+    Stop the posterior server on the Unix socket address. Errors on the server raise RuntimeError.
+    """
+    response = send_requests([{"op": "shutdown"}], address = address)[0]
+    if "error" in response:
+        raise RuntimeError(response["error"])
+
+if __name__ == "__main__":
+    serve_posteriors()
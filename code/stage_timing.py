@@ -0,0 +1,154 @@
+from __future__ import division, print_function
+import time
+import sys
+import json
+import resource
+import functools
+import threading
+import contextlib
+
+"""
+ Wall time and call counts per stage of a posterior run (db fetch, prior, likelihood, normalization, estimator, output),
+ throughput, and peak memory.
+ Stages nest: time spent in an inner stage is not counted again in the stage around it, so stage times add up
+ to no more than the wall time. Entering a stage that is already the innermost one is not counted twice.
+ Nesting is tracked per thread; times from background threads (e.g. prefetching readers) add to the same totals.
+"""
+
+stage_times = {}
+stage_calls = {}
+stage_lock = threading.Lock()
+thread_state = threading.local()
+run_start = [time.time()]
+
+def get_stage_stack():
+    """
+    Stages open in the calling thread, innermost last
+    """
+    if not hasattr(thread_state, "stack"):
+        thread_state.stack = []
+    
+    return thread_state.stack
+
+def reset():
+    """
+    Clear all stage times and counts and restart the run clock
+    """
+    with stage_lock:
+        stage_times.clear()
+        stage_calls.clear()
+    del get_stage_stack()[:]
+    run_start[0] = time.time()
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Time the enclosed block as stage name:  with stage_timing.stage("likelihood"): ...
+    """
+    stage_stack = get_stage_stack()
+    if len(stage_stack) > 0 and stage_stack[-1][0] == name:
+        yield
+        return
+
+    # [name, start time, time spent in stages nested inside this one]
+    frame = [name, time.time(), 0.0]
+    stage_stack.append(frame)
+    try:
+        yield
+    finally:
+        stage_stack.pop()
+        elapsed = time.time() - frame[1]
+        with stage_lock:
+            stage_times[name] = stage_times.get(name, 0.0) + elapsed - frame[2]
+            stage_calls[name] = stage_calls.get(name, 0) + 1
+        if len(stage_stack) > 0:
+            stage_stack[-1][2] += elapsed
+
+def timed(name):
+    """
+    Decorator: every call of the function is timed as stage name
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def get_stats():
+    """
+    Copy of the stage times and call counts, e.g. to send back from a worker process
+    """
+    with stage_lock:
+        return {"times": dict(stage_times), "calls": dict(stage_calls)}
+
+def stats_since(before):
+    """
+    Stage times and call counts accumulated since get_stats() returned before
+    """
+    after = get_stats()
+    for key in ["times", "calls"]:
+        for name, value in before[key].items():
+            after[key][name] -= value
+
+    return after
+
+def merge_stats(stats):
+    """
+    Add stage times and call counts from another process
+    """
+    with stage_lock:
+        for name, value in stats["times"].items():
+            stage_times[name] = stage_times.get(name, 0.0) + value
+        for name, value in stats["calls"].items():
+            stage_calls[name] = stage_calls.get(name, 0) + value
+
+def peak_rss_mb(children = False):
+    """
+    Peak resident set size of this process (or of its largest finished child process) in MB
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+
+    # ru_maxrss is in bytes on macOS, kilobytes on Linux
+    if sys.platform == "darwin":
+        return usage.ru_maxrss/1024**2
+    else:
+        return usage.ru_maxrss/1024
+
+def summary(npix = None, **run_info):
+    """
+    Dictionary of wall time, throughput, peak RSS and per-stage time, calls and fraction of wall time.
+    Stage times from worker processes are summed over workers, so their fractions can exceed 1 in parallel runs.
+    run_info is stored as given (e.g. the run options).
+    """
+    wall_time = time.time() - run_start[0]
+    stages = {}
+    for name in sorted(stage_times.keys()):
+        stages[name] = {"time": stage_times[name], "calls": stage_calls[name], "fraction": stage_times[name]/wall_time}
+
+    run_summary = {"wall_time": wall_time, "stages": stages, "peak_rss_mb": peak_rss_mb(), "peak_rss_children_mb": peak_rss_mb(children = True)}
+    if npix is not None:
+        run_summary["npix"] = npix
+        run_summary["pixels_per_second"] = npix/wall_time
+    run_summary["run_info"] = run_info
+
+    return run_summary
+
+def print_summary(run_summary):
+    print("Finished in {:.1f} s, peak RSS {:.0f} MB (workers {:.0f} MB)".format(run_summary["wall_time"], run_summary["peak_rss_mb"], run_summary["peak_rss_children_mb"]))
+    if "npix" in run_summary:
+        print("{} pixels, {:.1f} pixels/s".format(run_summary["npix"], run_summary["pixels_per_second"]))
+    for name, stats in sorted(run_summary["stages"].items(), key = lambda item: -item[1]["time"]):
+        print("  {:<14} {:10.2f} s {:6.1f}% {:10d} calls".format(name, stats["time"], 100*stats["fraction"], stats["calls"]))
+
+def write_summary(fn, npix = None, **run_info):
+    """
+    Print the run summary and write it to fn as JSON
+    """
+    run_summary = summary(npix = npix, **run_info)
+    print_summary(run_summary)
+    with open(fn, "w") as f:
+        json.dump(run_summary, f, indent = 2, sort_keys = True, default = str)
+
+    return run_summary